@@ -0,0 +1,254 @@
+"""Offline stand-ins for OpenAI, the chat model and GCS used by the benchmarks."""
+
+import asyncio
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+import numpy as np
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# Vocabulary of the synthetic course materials
+_WORDS = (
+    "abstraction aggregation algorithm architecture assertion boundary cache class "
+    "cohesion compiler component concurrency constructor controller coupling database "
+    "deadlock dependency deployment design encapsulation entity exception factory "
+    "framework function gateway heap inheritance interface iterator kernel latency "
+    "lifecycle module mutex observer pattern pipeline polymorphism process protocol "
+    "queue recursion refactoring repository requirement scheduler schema singleton "
+    "stack strategy subsystem testing thread throughput transaction use-case validation"
+).split()
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings: texts sharing words are close.
+
+    Each word is hashed to a fixed random unit vector, so results are reproducible
+    across runs and machines without any model.
+    """
+
+    def __init__(self, dim=1536, latency=0.0):
+        self.dim = dim
+        self.latency = latency
+        self._word_vectors: dict[str, np.ndarray] = {}
+        self.calls = 0
+
+    def _word_vector(self, word):
+        vector = self._word_vectors.get(word)
+        if vector is None:
+            seed = int.from_bytes(hashlib.sha1(word.encode("utf-8")).digest()[:8], "big")
+            vector = np.random.default_rng(seed).standard_normal(self.dim)
+            vector = (vector / np.linalg.norm(vector)).astype(np.float32)
+            self._word_vectors[word] = vector
+        return vector
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            vector += self._word_vector(word)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+class StubChatModel(BaseChatModel):
+    """Chat model that answers after a fixed latency, standing in for OpenAI."""
+
+    latency: float = 0.0
+    answer: str = "The observer pattern notifies subscribers of changes. (Lecture 3, 12)"
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _result(self):
+        message = AIMessage(
+            content=self.answer,
+            usage_metadata={"input_tokens": 0, "output_tokens": 0, "total_tokens": 0},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._result()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._result()
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = bucket._generation(name)
+
+    def exists(self, client=None):
+        return os.path.exists(self.bucket._path(self.name))
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.generation = self.bucket._write(self.name, data, if_generation_match)
+
+    def upload_from_file(self, file_obj, content_type=None, if_generation_match=None):
+        self.upload_from_string(file_obj.read(), content_type, if_generation_match)
+
+    def download_as_bytes(self, client=None):
+        try:
+            with open(self.bucket._path(self.name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise NotFound(self.name)
+
+    def delete(self, client=None):
+        try:
+            os.remove(self.bucket._path(self.name))
+            os.remove(self.bucket._generation_path(self.name))
+        except FileNotFoundError:
+            raise NotFound(self.name)
+
+
+class LocalBucket:
+    """GCS bucket stored in a local directory, with generation numbers so that
+    conditional writes behave as on GCS."""
+
+    _lock = threading.Lock()
+
+    def __init__(self, root, name):
+        self.name = name
+        self.directory = os.path.join(root, name)
+
+    def _path(self, name):
+        return os.path.join(self.directory, "objects", name)
+
+    def _generation_path(self, name):
+        return os.path.join(self.directory, "generations", name)
+
+    def _generation(self, name):
+        try:
+            with open(self._generation_path(name), "r") as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def _write(self, name, data, if_generation_match=None):
+        with self._lock:
+            if if_generation_match is not None and (
+                self._generation(name) or 0
+            ) != if_generation_match:
+                raise PreconditionFailed(name)
+            generation = time.time_ns()
+            for path, content in (
+                (self._path(name), data),
+                (self._generation_path(name), str(generation).encode("utf-8")),
+            ):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(content)
+            return generation
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name, client=None):
+        blob = LocalBlob(self, name)
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix=""):
+        objects = os.path.join(self.directory, "objects")
+        names = []
+        for directory, _, files in os.walk(objects):
+            for file in files:
+                name = os.path.relpath(os.path.join(directory, file), objects)
+                if name.startswith(prefix):
+                    names.append(name)
+        return [LocalBlob(self, name) for name in sorted(names)]
+
+
+class LocalStorageClient:
+    """Drop-in for google.cloud.storage.Client backed by a local directory."""
+
+    root = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def bucket(self, name):
+        return LocalBucket(self.root, name)
+
+    def list_blobs(self, bucket_or_name, prefix=""):
+        bucket = (
+            bucket_or_name
+            if isinstance(bucket_or_name, LocalBucket)
+            else self.bucket(bucket_or_name)
+        )
+        return bucket.list_blobs(prefix)
+
+
+def synthetic_page(rng: random.Random, words=80) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def make_pdf(pages: list[str]) -> bytes:
+    """Builds a minimal PDF with one line of Helvetica text per page."""
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = {}
+
+    def write_object(number, body: bytes):
+        offsets[number] = out.tell()
+        out.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages)))
+    write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for i, text in enumerate(pages):
+        page, content = 4 + 2 * i, 5 + 2 * i
+        write_object(
+            page,
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {content} "
+            f"0 R /Resources << /Font << /F1 3 0 R >> >> >>".encode(),
+        )
+        escaped = text.replace("\\", "").replace("(", "").replace(")", "")
+        stream = f"BT /F1 10 Tf 72 720 Td ({escaped}) Tj ET".encode("latin-1")
+        write_object(
+            content,
+            f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream",
+        )
+
+    xref = out.tell()
+    total = 3 + 2 * len(pages)
+    out.write(f"xref\n0 {total + 1}\n0000000000 65535 f \n".encode())
+    for number in range(1, total + 1):
+        out.write(f"{offsets[number]:010d} 00000 n \n".encode())
+    out.write(
+        f"trailer\n<< /Size {total + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    )
+    return out.getvalue()
@@ -0,0 +1,532 @@
+"""Offline benchmarks of ingestion, loading and answering.
+
+OpenAI, the chat model and GCS are replaced by the stand-ins in benchmarks/fakes.py,
+so runs need no credentials or network and are reproducible for a given seed.
+Results are written as JSON so that runs can be compared.
+
+Usage:
+    python -m benchmarks.run
+    python -m benchmarks.run --scenarios ingest,query --pdfs 50 --output before.json
+    python -m benchmarks.run --scenarios memory --memory-sizes 10000,100000,1000000
+    python -m benchmarks.run --scenarios logging
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _REPO_ROOT)
+
+SCENARIOS = ("ingest", "cold_load", "query", "throughput", "memory", "logging")
+
+# Logging settings compared by the logging scenario: the former configuration (every
+# event at DEBUG with its callsite, colored console output written synchronously) and
+# the production one
+_LOGGING_CONFIGS = {
+    "before": {
+        "LOG_FORMAT": "console",
+        "LOG_LEVEL": "DEBUG",
+        "LOG_ASYNC": "false",
+        "LOG_CALLSITE_LEVEL": "DEBUG",
+        "LOG_MAX_FIELD_CHARS": "0",
+    },
+    "after": {
+        "LOG_FORMAT": "json",
+        "LOG_LEVEL": "INFO",
+        "LOG_ASYNC": "true",
+        "LOG_CALLSITE_LEVEL": "WARNING",
+        "LOG_MAX_FIELD_CHARS": "1000",
+    },
+}
+
+
+def _environment(root, args):
+    """Points the app at the fakes. Must run before models or main are imported."""
+    # The app loads .env from the working directory, which must not leak into runs
+    os.chdir(root)
+    os.environ.update(
+        {
+            "ENV": "PROD",
+            "EMBEDDING_BACKEND": "openai",
+            "OPENAI_API_KEY": "sk-benchmark",
+            "GCS_BUCKET_NAME": "benchmark",
+            "EDUVISOR_API_KEY": "benchmark",
+            "VECTORSTORE_CACHE_DIR": "",
+            "VECTORSTORE_RELOAD_INTERVAL_SECONDS": "0",
+            "EMBEDDING_CACHE_DIR": "",
+            "RESPONSE_CACHE_ENABLED": "false",
+            "TOKENIZER_MODEL": "gpt-4o-mini",
+        }
+    )
+
+    from google.cloud import storage
+    from benchmarks.fakes import HashEmbeddings, LocalStorageClient
+
+    LocalStorageClient.root = os.path.join(root, "gcs")
+    storage.Client = LocalStorageClient
+
+    from services.logger import configure_logger
+
+    configure_logger()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from models.embedding_cache import CachedEmbeddings
+    from models.vector_store import VectorStore
+
+    VectorStore._embedding_dim = args.dim
+    VectorStore.embeddings = CachedEmbeddings(
+        HashEmbeddings(args.dim, args.embedding_latency_ms / 1000),
+        namespace=f"benchmark-{args.dim}",
+    )
+
+
+def _percentiles(latencies: list[float]) -> dict[str, float]:
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    return {
+        "mean_ms": round(1000 * statistics.fmean(latencies), 3),
+        "p50_ms": round(1000 * percentile(0.5), 3),
+        "p95_ms": round(1000 * percentile(0.95), 3),
+        "p99_ms": round(1000 * percentile(0.99), 3),
+        "max_ms": round(1000 * latencies[-1], 3),
+    }
+
+
+def _rss_mb():
+    import psutil
+
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def _pdfs(args, rng):
+    from benchmarks.fakes import make_pdf, synthetic_page
+
+    return [
+        (
+            f"lecture-{i:04d}.pdf",
+            make_pdf([synthetic_page(rng) for _ in range(args.pages_per_pdf)]),
+        )
+        for i in range(args.pdfs)
+    ]
+
+
+def _queries(args, rng):
+    from benchmarks.fakes import synthetic_page
+
+    return [synthetic_page(rng, words=12) for _ in range(args.queries)]
+
+
+def _ingested_store(args):
+    """Returns the default shard, ingesting the synthetic PDFs if it is empty."""
+    from models.vector_store import VectorStore
+
+    store = VectorStore()
+    if store.vector_store.index.ntotal == 0:
+        store.add_documents(_pdfs(args, random.Random(args.seed)))
+    return store
+
+
+def bench_ingest(args):
+    from models.vector_store import VectorStore
+
+    files = _pdfs(args, random.Random(args.seed))
+    store = VectorStore(course_id="ingest")
+    start = time.perf_counter()
+    response = store.add_documents(files)
+    elapsed = time.perf_counter() - start
+    if response["code"] != 201:
+        raise RuntimeError(response)
+
+    chunks = store.vector_store.index.ntotal
+    return {
+        "pdfs": len(files),
+        "pages": len(files) * args.pages_per_pdf,
+        "chunks": chunks,
+        "seconds": round(elapsed, 3),
+        "chunks_per_second": round(chunks / elapsed, 1),
+    }
+
+
+def bench_cold_load(args):
+    from models.vector_store import VectorStore
+
+    store = _ingested_store(args)
+    # Production shards are mostly a compacted base with a few segments
+    store._compact(force=True)
+    results = {"chunks": store.vector_store.index.ntotal}
+
+    start = time.perf_counter()
+    VectorStore()
+    results["gcs_seconds"] = round(time.perf_counter() - start, 3)
+
+    # With a local snapshot: the first load writes it, the second one opens it
+    os.environ["VECTORSTORE_CACHE_DIR"] = os.path.join(os.getcwd(), "snapshots")
+    try:
+        VectorStore()
+        start = time.perf_counter()
+        VectorStore()
+        results["local_snapshot_seconds"] = round(time.perf_counter() - start, 3)
+    finally:
+        os.environ["VECTORSTORE_CACHE_DIR"] = ""
+    return results
+
+
+def bench_query(args):
+    from models.shard_router import VectorStoreRouter
+    from services.chat_service import ChatService
+    from benchmarks.fakes import StubChatModel
+
+    _ingested_store(args)
+    chat_service = ChatService(router=VectorStoreRouter(reload_interval=0))
+    chat_service.llm = StubChatModel(latency=args.llm_latency_ms / 1000)
+    queries = _queries(args, random.Random(args.seed + 1))
+
+    async def run():
+        # Warm up: loads the shard and the tokenizer
+        await chat_service.invoke_response("", "", "", "", queries[0])
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            await chat_service.invoke_response("", "", "", "", query)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    latencies = asyncio.run(run())
+    return {
+        "queries": len(queries),
+        "llm_latency_ms": args.llm_latency_ms,
+        **_percentiles(latencies),
+    }
+
+
+def bench_throughput(args):
+    import httpx
+    from benchmarks.fakes import StubChatModel
+
+    _ingested_store(args)
+    import main
+
+    # The lifespan does not run under ASGITransport
+    main.initialize()
+    # main configures logging again on import
+    logging.getLogger().setLevel(logging.WARNING)
+    main.chat_service.llm = StubChatModel(latency=args.llm_latency_ms / 1000)
+    queries = _queries(args, random.Random(args.seed + 2))
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies, errors = [], 0
+
+        async with httpx.AsyncClient(
+            transport=transport,
+            base_url="http://benchmark",
+            headers={"x-api-key": "benchmark"},
+            timeout=None,
+        ) as client:
+
+            async def request(query):
+                nonlocal errors
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.post(
+                        "/response",
+                        json=[{"title": "Question", "content": query, "author": "a"}],
+                    )
+                    latencies.append(time.perf_counter() - start)
+                    errors += response.status_code != 200
+
+            await request(queries[0])
+            latencies.clear()
+            start = time.perf_counter()
+            await asyncio.gather(*(request(query) for query in queries))
+            elapsed = time.perf_counter() - start
+        return latencies, errors, elapsed
+
+    latencies, errors, elapsed = asyncio.run(run())
+    return {
+        "requests": len(queries),
+        "concurrency": args.concurrency,
+        "llm_latency_ms": args.llm_latency_ms,
+        "errors": errors,
+        "requests_per_second": round(len(queries) / elapsed, 1),
+        **_percentiles(latencies),
+    }
+
+
+def _log_request(log, http_log, prompt, response):
+    """Logs what answering one /response request logs."""
+    log.info("Getting response for posts: What is the observer pattern?")
+    log.info(
+        "Context assembled: {'candidates': 20, 'contexts': 5, 'prompt_tokens': 900}"
+    )
+    log.debug(prompt)
+    http_log.info(
+        'HTTP Request: %s %s "%s"',
+        "POST",
+        "https://api.openai.com/v1/chat/completions",
+        "HTTP/1.1 200 OK",
+    )
+    log.info(f"Response generated: {response}")
+    log.info("Tokens used: 1234")
+    log.info("Main topic: lecture-0003")
+    for name in ("LLM limiter", "Vector store shards", "Context assembler"):
+        log.info(f"{name}: {{'requests': 1000, 'in_flight': 2, 'queue_depth': 0}}")
+
+
+def bench_logging(args):
+    """Time spent logging per request, in the request thread and including the writes
+    of a background writer, with the former and the production logging settings."""
+    import structlog
+    from benchmarks.fakes import synthetic_page
+    from services.logger import configure_logger, flush_logs
+
+    rng = random.Random(args.seed + 3)
+    prompt = " ".join(synthetic_page(rng) for _ in range(8))
+    response = " ".join(synthetic_page(rng) for _ in range(2))
+    requests = max(args.queries, 100)
+
+    results = {}
+    for name, config in _LOGGING_CONFIGS.items():
+        previous = {key: os.environ.get(key) for key in config}
+        os.environ.update(config)
+        path = os.path.abspath(f"logging-{name}.log")
+        with open(path, "w") as stream:
+            configure_logger(stream=stream)
+            log = structlog.stdlib.get_logger("benchmark")
+            http_log = logging.getLogger("httpx")
+            structlog.contextvars.bind_contextvars(request_id="benchmark")
+            for _ in range(10):
+                _log_request(log, http_log, prompt, response)
+            flush_logs()
+            start_size = stream.tell()
+
+            start = time.perf_counter()
+            for _ in range(requests):
+                _log_request(log, http_log, prompt, response)
+            request_thread = time.perf_counter() - start
+            flush_logs()
+            total = time.perf_counter() - start
+            stream.flush()
+            written = os.path.getsize(path) - start_size
+
+            structlog.contextvars.clear_contextvars()
+            for key, value in previous.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            configure_logger()
+            logging.getLogger().setLevel(logging.WARNING)
+
+        results[name] = {
+            "settings": config,
+            "request_thread_us": round(1e6 * request_thread / requests, 1),
+            "total_us": round(1e6 * total / requests, 1),
+            "bytes_per_request": round(written / requests),
+        }
+
+    results["requests"] = requests
+    results["request_thread_speedup"] = round(
+        results["before"]["request_thread_us"] / results["after"]["request_thread_us"],
+        1,
+    )
+    return results
+
+
+def bench_memory(args):
+    """Runs each size in a fresh process, so that sizes do not share allocations."""
+    results = []
+    for chunks in args.memory_sizes:
+        command = [
+            sys.executable,
+            "-m",
+            "benchmarks.run",
+            "--memory-worker",
+            str(chunks),
+            "--dim",
+            str(args.dim),
+            "--seed",
+            str(args.seed),
+        ]
+        process = subprocess.run(
+            command, cwd=_REPO_ROOT, capture_output=True, text=True
+        )
+        if process.returncode != 0:
+            results.append(
+                {"chunks": chunks, "error": process.stderr.strip().splitlines()[-1:]}
+            )
+            continue
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def memory_worker(args):
+    """Writes a base snapshot of `chunks` synthetic chunks and measures loading it."""
+    import faiss
+    import numpy as np
+    from langchain_core.documents import Document
+    from models.columnar_docstore import ColumnarDocstore
+    from models.vector_store import VectorStore
+    from benchmarks.fakes import synthetic_page
+
+    chunks = args.memory_worker
+    rng = random.Random(args.seed)
+    vector_rng = np.random.default_rng(args.seed)
+    index = faiss.IndexFlatL2(args.dim)
+    for start in range(0, chunks, 10_000):
+        index.add(
+            vector_rng.standard_normal(
+                (min(10_000, chunks - start), args.dim), dtype=np.float32
+            )
+        )
+
+    ids = [f"chunk-{i}" for i in range(chunks)]
+    docstore = ColumnarDocstore.from_documents(
+        (
+            doc_id,
+            Document(
+                page_content=synthetic_page(rng),
+                metadata={"title": f"lecture-{i // 40}", "page": i % 40 + 1, "chunk": 1},
+            ),
+        )
+        for i, doc_id in enumerate(ids)
+    )
+    docstore_bytes = docstore.to_bytes(np.arange(chunks, dtype=np.int64))
+    index_bytes = faiss.serialize_index(index).tobytes()
+    del index, docstore
+
+    from google.cloud import storage
+
+    bucket = storage.Client().bucket("benchmark")
+    base = "bases/benchmark"
+    index_blob, docstore_blob = VectorStore()._base_blob_names(base)
+    bucket.blob(index_blob).upload_from_string(index_bytes)
+    bucket.blob(docstore_blob).upload_from_string(docstore_bytes)
+    bucket.blob("vectorstore/manifest.json").upload_from_string(
+        json.dumps({"format": 1, "base": base, "segments": []})
+    )
+    index_mb, docstore_mb = len(index_bytes) / 2**20, len(docstore_bytes) / 2**20
+    del index_bytes, docstore_bytes
+
+    import gc
+
+    gc.collect()
+    before = _rss_mb()
+    start = time.perf_counter()
+    store = VectorStore()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    after = _rss_mb()
+    assert store.vector_store.index.ntotal == chunks
+
+    return {
+        "chunks": chunks,
+        "dim": args.dim,
+        "load_seconds": round(elapsed, 3),
+        "rss_mb": round(after - before, 1),
+        "index_blob_mb": round(index_mb, 1),
+        "docstore_blob_mb": round(docstore_mb, 1),
+    }
+
+
+def _metadata(args):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=_REPO_ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {key: value for key, value in vars(args).items() if key != "output"},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help=f"Comma separated scenarios to run: {','.join(SCENARIOS)}",
+    )
+    parser.add_argument("--pdfs", type=int, default=20, help="Synthetic PDFs to ingest")
+    parser.add_argument("--pages-per-pdf", type=int, default=30)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--dim",
+        type=int,
+        default=1536,
+        help="Embedding dimensions (1536 for OpenAI, 1024 for bge-m3)",
+    )
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--embedding-latency-ms", type=float, default=0)
+    parser.add_argument(
+        "--memory-sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[10_000, 100_000, 1_000_000],
+        help="Chunk counts of the memory scenario",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        help="Result file. Defaults to benchmarks/results/<timestamp>.json",
+    )
+    parser.add_argument("--memory-worker", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Resolved before the working directory changes to the temporary root
+    output = os.path.abspath(
+        args.output
+        or os.path.join(
+            _REPO_ROOT, "benchmarks", "results", time.strftime("%Y%m%d-%H%M%S") + ".json"
+        )
+    )
+
+    with tempfile.TemporaryDirectory(prefix="eduvisor-benchmark-") as root:
+        _environment(root, args)
+
+        if args.memory_worker:
+            print(json.dumps(memory_worker(args)))
+            return
+
+        results = {}
+        for scenario in args.scenarios.split(","):
+            if scenario not in SCENARIOS:
+                raise SystemExit(f"Unknown scenario {scenario}")
+            print(f"Running {scenario}...", file=sys.stderr)
+            results[scenario] = globals()[f"bench_{scenario}"](args)
+            print(json.dumps(results[scenario], indent=2), file=sys.stderr)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"meta": _metadata(args), "results": results}, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
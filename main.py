@@ -1,43 +1,110 @@
 from services.logger import Logger, configure_logger
 import uvicorn
-from fastapi import FastAPI, UploadFile, Request
-from fastapi.responses import JSONResponse
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Form, UploadFile, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from models.post import Post
 from dotenv import load_dotenv
+import json
 import os
-from services.materials import MaterialsController
-
-# For fastapi simple cache
-from fastapi_simple_cache.backends.inmemory import InMemoryBackend
-from fastapi_simple_cache import FastAPISimpleCache
-
-# LLM related
-from models.vector_store import VectorStore
-from services.chat_service import ChatService
+import time
+import uuid
+import psutil
+import structlog
+from services import metrics
+from services.startup import Startup
 
 # Load environment variables
 load_dotenv(".env", verbose=True, override=True)
 _eduvisor_api_key = os.getenv("EDUVISOR_API_KEY")
+_max_batch_threads = int(os.getenv("RESPONSE_BATCH_MAX_THREADS", "100"))
 
-app = FastAPI()
 configure_logger()
 
 log = Logger()
 
-# Load stores
-vector_store = VectorStore()
+# Time from process start until this module is imported: interpreter start up and
+# the imports of the web server
+startup = Startup()
+startup.record("import", time.time() - psutil.Process().create_time())
+
+# Created by initialize() in the background once the server is up, so that the port is
+# bound at once and /healthz answers while the embeddings, LLM and index load.
+vector_store_router = None
+material_controller = None
+chat_service = None
+
+
+def initialize():
+    """Creates the services and loads the default shard.
+
+    Runs in a worker thread started by the lifespan. Call it directly when the app is
+    not served by uvicorn (e.g. in benchmarks).
+    """
+    global vector_store_router, material_controller, chat_service
+    try:
+        # FAISS, LangChain, Google Cloud and Ollama are only imported here
+        with startup.phase("import_services"):
+            from models.shard_router import VectorStoreRouter
+            from services.chat_service import ChatService
+            from services.materials import MaterialsController
+
+        # Vector stores are sharded per course and loaded on first use
+        with startup.phase("router"):
+            router = VectorStoreRouter()
+        with startup.phase("chat_service"):
+            chat = ChatService(router=router)
+        with startup.phase("materials"):
+            materials = MaterialsController(router=router)
+        with startup.phase("default_shard"):
+            router.get()
+    except Exception as e:
+        startup.fail(e)
+        return
+
+    vector_store_router, chat_service, material_controller = router, chat, materials
+    startup.mark_ready()
+
 
-# Initialize controllers
-material_controller = MaterialsController(
-    vector_store=vector_store
-)
-chat_service = ChatService(vector_store=vector_store)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep a reference, the event loop only holds weak references to tasks
+    app.state.initialization = asyncio.create_task(asyncio.to_thread(initialize))
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Paths served without the API key. /metrics is scraped by Prometheus, /healthz and
+# /readyz are probed by the container platform.
+_public_paths = {"/metrics", "/healthz", "/readyz"}
+
+# Paths served before initialization has finished
+_startup_paths = _public_paths | {"/"}
+
+
+# Requests that need the services are rejected until they are initialized. Registered
+# before auth so that it runs after it.
+@app.middleware("http")
+async def require_ready(request: Request, call_next):
+    if not startup.ready and request.url.path not in _startup_paths:
+        return JSONResponse(
+            content={"error": "service is starting, retry shortly"},
+            status_code=503,
+            headers={"Retry-After": "5"},
+        )
+    return await call_next(request)
 
 
 # Simple middleware to ensure that only requests from OneMDP are accepted.
 # Set the API key in .env
 @app.middleware("http")
 async def auth(request: Request, call_next):
+    if request.url.path in _public_paths:
+        return await call_next(request)
+
     api_key = request.headers.get("x-api-key")
 
     if api_key != _eduvisor_api_key:
@@ -50,25 +117,88 @@ async def auth(request: Request, call_next):
     return response
 
 
+# Binds a request id to every log line of the request (from the X-Request-ID header if
+# the caller sent one) and records request metrics. Registered after auth so that it
+# also covers rejected requests.
+@app.middleware("http")
+async def observe(request: Request, call_next):
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    structlog.contextvars.clear_contextvars()
+    structlog.contextvars.bind_contextvars(request_id=request_id)
+
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        # Label by route template (/upload/{job_id}) to keep the number of series bounded
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", "unmatched")
+        metrics.REQUESTS.inc(method=request.method, endpoint=endpoint, status=status)
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - start, method=request.method, endpoint=endpoint
+        )
+
+
 @app.get("/")
 def read_root():
     log.info("Root endpoint accessed")
     return {"message": "Welcome to the Eduvisor API."}
 
 
-# Upload PDF to Google Cloud Storage
+# Liveness probe. Fails only if initialization failed, so that the container restarts.
+@app.get("/healthz")
+def healthz():
+    if startup.error is not None:
+        return JSONResponse(
+            status_code=503, content={"status": "failed", "error": startup.error}
+        )
+    return {"status": "alive"}
+
+
+# Readiness probe: traffic should only be routed here once the default index is loaded
+# and the LLM is configured. Reports the startup phase timings.
+@app.get("/readyz")
+def readyz():
+    checks = {
+        "index_loaded": startup.ready,
+        "llm_configured": chat_service is not None
+        and bool(os.getenv("OPENAI_API_KEY")),
+    }
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "checks": checks, **startup.report()},
+    )
+
+
+# Queue PDFs for ingestion into the vector store. Returns the id of the ingestion job.
+# With replace=true, pages of earlier versions of the PDFs that are no longer present are removed.
+# course_id selects the course's shard; without it the PDFs go to the default store.
 @app.post("/upload")
-def upload_pdf(files: list[UploadFile]):
-    response = material_controller.add(files)
+async def upload_pdf(
+    files: list[UploadFile],
+    replace: bool = Form(False),
+    course_id: str | None = Form(None),
+):
+    contents = [(file.filename, await file.read()) for file in files]
+    response = material_controller.add(contents, replace=replace, course_id=course_id)
     log.info(f"Add pdfs response: {response}")
-    return response
+    return JSONResponse(status_code=response["code"], content=response)
 
 
-# Get response from thread.
-@app.post("/response")
-def get_response(posts: list[Post]):
-    log.info(f"Getting response for posts: {posts[0].title}")
+# Get progress of an ingestion job
+@app.get("/upload/{job_id}")
+def get_upload_status(job_id: str):
+    response = material_controller.status(job_id)
+    return JSONResponse(status_code=response["code"], content=response)
+
 
+def build_prompt(posts: list[Post]):
+    """Returns the persona, task, conditions, output style and query for a thread."""
     # Initialize persona etc. (refer to chat_controller.py for reference)
     persona = """
     You are a virtual teaching assistant in Nanyang Technological University, Singapore. You are helpful, knowledgeable, and friendly.
@@ -89,17 +219,181 @@ def get_response(posts: list[Post]):
     You will give the response in a concise and clear manner, without any unnecessary information. Do not prompt the user for any further input or questions. Use HTML tags instead of markdown in your response (e.g. <b></b> to bold text instead of **).
     """
 
-    query = ""
-    for index, post in enumerate(posts):
-        query += f"Post number: {index + 1}, Post title: {post.title}, Post content: {post.content}, Post author: {post.author} "
+    # Posts are embedded separately and the query text is trimmed to a token budget
+    query = chat_service.thread_queries.build(posts)
+
+    return persona, task, conditions, output_style, query
 
-    response, token_used, main_topic = chat_service.invoke_response(
-        persona, task, conditions, output_style, query
-    )
+
+def collect_service_metrics():
+    """Reports the counters kept by the services, see metrics.Registry."""
+    if not startup.ready:
+        return []
+    limiter = chat_service.llm_limiter.stats()
+    embedding_cache = chat_service.embeddings.stats()
+    thread_queries = chat_service.thread_queries.stats()
+    singleflight = chat_service.singleflight.stats()
+    tiers = [(tier.model, tier.hedger.stats()) for tier in chat_service.llm_tiers()]
+    collected = [
+        (
+            "eduvisor_llm_in_flight",
+            "gauge",
+            "LLM calls in flight.",
+            [({}, limiter["in_flight"])],
+        ),
+        (
+            "eduvisor_llm_queue_depth",
+            "gauge",
+            "Calls waiting for an LLM slot.",
+            [({}, limiter["queue_depth"])],
+        ),
+        (
+            "eduvisor_embedding_cache_lookups_total",
+            "counter",
+            "Embedding cache lookups.",
+            [
+                ({"result": "hit"}, embedding_cache["hits"]),
+                ({"result": "miss"}, embedding_cache["misses"]),
+            ],
+        ),
+        (
+            "eduvisor_keyword_fast_path_total",
+            "counter",
+            "Queries answered from keyword search only.",
+            [({}, chat_service.keyword_fast_path_hits)],
+        ),
+        (
+            "eduvisor_response_requests_total",
+            "counter",
+            "Response requests, by whether they shared an identical in-flight request.",
+            [
+                (
+                    {"result": "executed"},
+                    singleflight["calls"] - singleflight["shared"],
+                ),
+                ({"result": "shared"}, singleflight["shared"]),
+            ],
+        ),
+        (
+            "eduvisor_llm_hedges_total",
+            "counter",
+            "Hedged LLM calls per model, and how many of them the hedge won.",
+            [
+                ({"model": model, "result": result}, hedger[key])
+                for model, hedger in tiers
+                for result, key in (("started", "hedges"), ("won", "hedge_wins"))
+            ],
+        ),
+        (
+            "eduvisor_retrieval_gated_total",
+            "counter",
+            "Queries answered without the LLM by the retrieval relevance gate.",
+            [({}, chat_service.gated)],
+        ),
+        (
+            "eduvisor_thread_post_embeddings_total",
+            "counter",
+            "Thread posts embedded, or reused from earlier requests of the thread.",
+            [
+                ({"result": "embedded"}, thread_queries["posts_embedded"]),
+                ({"result": "reused"}, thread_queries["posts_reused"]),
+            ],
+        ),
+        (
+            "eduvisor_prompt_tokens_saved_total",
+            "counter",
+            "Prompt tokens saved by context assembly.",
+            [({}, chat_service.context_assembler.stats()["prompt_tokens_saved"])],
+        ),
+        (
+            "eduvisor_index_vectors",
+            "gauge",
+            "Vectors in each resident shard.",
+            [
+                ({"course": course_id or "default"}, shard.vector_store.index.ntotal)
+                for course_id, shard in vector_store_router.shards()
+            ],
+        ),
+    ]
+    if chat_service.response_cache is not None:
+        response_cache = chat_service.response_cache.stats()
+        collected.append(
+            (
+                "eduvisor_response_cache_lookups_total",
+                "counter",
+                "Response cache lookups.",
+                [
+                    ({"result": "hit"}, response_cache["hits"]),
+                    ({"result": "miss"}, response_cache["misses"]),
+                ],
+            )
+        )
+    return collected
+
+
+metrics.REGISTRY.add_collector(collect_service_metrics)
+
+
+def collect_startup_metrics():
+    """Reports the startup phase timings and readiness."""
+    return [
+        (
+            "eduvisor_startup_phase_seconds",
+            "gauge",
+            "Duration of each phase of importing and initializing the service.",
+            [({"phase": name}, seconds) for name, seconds in startup.phases.items()],
+        ),
+        (
+            "eduvisor_ready",
+            "gauge",
+            "1 once the services are initialized and the default index is loaded.",
+            [({}, int(startup.ready))],
+        ),
+    ]
+
+
+metrics.REGISTRY.add_collector(collect_startup_metrics)
+
+
+def log_service_stats():
+    log.info(f"LLM limiter: {chat_service.llm_limiter.stats()}")
+    log.info(f"Vector store shards: {vector_store_router.stats()}")
+    log.info(f"Context assembler: {chat_service.context_assembler.stats()}")
+    log.info(f"Search batching: {chat_service.search_scheduler.stats()}")
+    log.info(f"Keyword fast path hits: {chat_service.keyword_fast_path_hits}")
+    log.info(f"Thread queries: {chat_service.thread_queries.stats()}")
+    log.info(f"Request coalescing: {chat_service.singleflight.stats()}")
+    for tier in chat_service.llm_tiers():
+        log.info(f"LLM {tier.model} hedging: {tier.hedger.stats()}")
+    log.info(f"Relevance gate answers: {chat_service.gated}")
+    if chat_service.response_cache is not None:
+        log.info(f"Response cache: {chat_service.response_cache.stats()}")
+
+
+# Get response from thread. course_id selects the course's shard to search.
+@app.post("/response")
+async def get_response(posts: list[Post], course_id: str | None = None):
+    log.info(f"Getting response for posts: {posts[0].title}")
+
+    try:
+        chat_service.router.validate_course_id(course_id)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    try:
+        response, token_used, main_topic = await chat_service.invoke_response(
+            *build_prompt(posts), course_id=course_id
+        )
+    except TimeoutError:
+        log.error(f"Timed out getting response for posts: {posts[0].title}")
+        return JSONResponse(
+            status_code=504, content={"error": "Timed out generating response"}
+        )
 
     log.info(f"Response generated: {response}")
     log.info(f"Tokens used: {token_used}")
     log.info(f"Main topic: {main_topic}")
+    log_service_stats()
 
     return JSONResponse(
         status_code=200,
@@ -109,10 +403,99 @@ def get_response(posts: list[Post]):
     )
 
 
-@app.on_event("startup")
-async def startup():
-    backend = InMemoryBackend()
-    FastAPISimpleCache.init(backend=backend)
+# Get responses for many threads in one call, e.g. to backfill unanswered threads.
+# Each result has the response, or an error if that thread failed.
+@app.post("/response/batch")
+async def get_batch_response(threads: list[list[Post]], course_id: str | None = None):
+    log.info(f"Getting responses for {len(threads)} threads")
+
+    try:
+        chat_service.router.validate_course_id(course_id)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    if not threads or any(not posts for posts in threads):
+        return JSONResponse(
+            status_code=400, content={"error": "Every thread needs at least one post"}
+        )
+    if len(threads) > _max_batch_threads:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"At most {_max_batch_threads} threads per batch"},
+        )
+
+    prompts = [build_prompt(posts) for posts in threads]
+    persona, task, conditions, output_style, _ = prompts[0]
+    answers = await chat_service.invoke_responses(
+        persona,
+        task,
+        conditions,
+        output_style,
+        [query for *_, query in prompts],
+        course_id=course_id,
+    )
+
+    results = []
+    for posts, answer in zip(threads, answers):
+        if isinstance(answer, Exception):
+            log.error(f"Error getting response for {posts[0].title}: {str(answer)}")
+            results.append({"error": "Error generating response"})
+            continue
+        response, token_used, main_topic = answer
+        results.append(
+            {"response": response, "tokens_used": token_used, "main_topic": main_topic}
+        )
+
+    log.info(
+        f"Batch of {len(threads)} threads answered, "
+        f"{sum('error' in result for result in results)} failed"
+    )
+    log_service_stats()
+
+    return JSONResponse(status_code=200, content={"results": results})
+
+
+# Stream the response to a thread as server-sent events. "token" events carry the text
+# as it is generated, followed by a "done" event with the full response and token usage.
+@app.post("/response/stream")
+async def stream_response(posts: list[Post], course_id: str | None = None):
+    log.info(f"Streaming response for posts: {posts[0].title}")
+
+    try:
+        chat_service.router.validate_course_id(course_id)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    async def events():
+        try:
+            async for event, data in chat_service.stream_response(
+                *build_prompt(posts), course_id=course_id
+            ):
+                if event == "token":
+                    data = {"text": data}
+                else:
+                    log.info(f"Response generated: {data['response']}")
+                    log.info(f"Tokens used: {data['tokens_used']}")
+                    log.info(f"Main topic: {data['main_topic']}")
+                    log_service_stats()
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            log.error(f"Error streaming response: {str(e)}")
+            yield f"event: error\ndata: {json.dumps({'error': 'Error generating response'})}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Stop proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Prometheus metrics: per-stage latency histograms, request, token and cache counters
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(
+        metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+import io
+import json
+import numpy as np
+import zstandard
+from langchain.docstore.document import Document
+from models.overlay_docstore import OverlayDocstore
+
+DOCSTORE_FORMAT = 1
+_MAGIC = b"EDVDOCS1"
+
+# Metadata written by the ingestion pipeline, stored as typed columns. Chunks with any
+# other metadata keep their full metadata in a JSON side table.
+_COLUMNS = ("title", "page", "chunk")
+
+
+class ColumnarDocstore(OverlayDocstore):
+    """Docstore holding chunks as columns instead of one Document per chunk.
+
+    Texts are kept as one contiguous UTF-8 buffer with offsets, titles as ids into a
+    title table, and pages and chunk numbers as int32 arrays. A Document is only built
+    when a search returns it. Added documents and deletions are kept in an overlay, see
+    OverlayDocstore.
+
+    Serialized with to_bytes() as zstd compressed numpy arrays, which can be loaded
+    without unpickling anything.
+    """
+
+    def __init__(
+        self,
+        ids: list[str],
+        text: bytes,
+        text_offsets: np.ndarray,
+        titles: list[str],
+        title_ids: np.ndarray,
+        pages: np.ndarray,
+        chunks: np.ndarray,
+        extra: dict[int, dict] | None = None,
+    ):
+        super().__init__(ids)
+        self._text = text
+        self._text_offsets = text_offsets
+        self._titles = titles
+        self._title_ids = title_ids
+        self._pages = pages
+        self._chunks = chunks
+        self._extra = extra or {}
+
+    @classmethod
+    def from_documents(cls, documents) -> "ColumnarDocstore":
+        """Builds a docstore from (doc_id, Document) pairs."""
+        ids, texts, offsets = [], [], [0]
+        titles: dict[str, int] = {}
+        title_ids, pages, chunks, extra = [], [], [], {}
+
+        for row, (doc_id, doc) in enumerate(documents):
+            ids.append(doc_id)
+            text = doc.page_content.encode("utf-8")
+            texts.append(text)
+            offsets.append(offsets[-1] + len(text))
+
+            metadata = doc.metadata
+            title, page, chunk = (metadata.get(key) for key in _COLUMNS)
+            typed = (
+                set(metadata) == set(_COLUMNS)
+                and isinstance(title, str)
+                and type(page) is int
+                and type(chunk) is int
+            )
+            if typed:
+                title_ids.append(titles.setdefault(title, len(titles)))
+                pages.append(page)
+                chunks.append(chunk)
+            else:
+                title_ids.append(-1)
+                pages.append(-1)
+                chunks.append(-1)
+                extra[row] = metadata
+
+        return cls(
+            ids,
+            b"".join(texts),
+            np.asarray(offsets, dtype=np.int64),
+            list(titles),
+            np.asarray(title_ids, dtype=np.int32),
+            np.asarray(pages, dtype=np.int32),
+            np.asarray(chunks, dtype=np.int32),
+            extra,
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """Loads a serialized docstore.
+
+        Returns:
+            tuple: The docstore and the index position of each document.
+        """
+        if not data.startswith(_MAGIC):
+            raise ValueError("Not a serialized columnar docstore")
+        payload = zstandard.ZstdDecompressor().decompress(data[len(_MAGIC) :])
+        arrays = np.load(io.BytesIO(payload), allow_pickle=False)
+
+        header = json.loads(arrays["header"].tobytes())
+        if header["format"] != DOCSTORE_FORMAT:
+            raise ValueError(f"Unsupported docstore format {header['format']}")
+
+        id_bytes = arrays["ids"].tobytes()
+        id_offsets = arrays["id_offsets"]
+        ids = [
+            id_bytes[id_offsets[row] : id_offsets[row + 1]].decode("utf-8")
+            for row in range(len(id_offsets) - 1)
+        ]
+        docstore = cls(
+            ids,
+            arrays["text"].tobytes(),
+            arrays["text_offsets"],
+            header["titles"],
+            arrays["title_ids"],
+            arrays["pages"],
+            arrays["chunks"],
+            {int(row): metadata for row, metadata in header["extra"].items()},
+        )
+        return docstore, arrays["positions"]
+
+    @classmethod
+    def serialize(cls, docstore, index_to_docstore_id: dict[int, str], level=3) -> bytes:
+        """Serializes the documents of a vector store, with their index positions.
+
+        Args:
+            docstore: Any LangChain docstore, e.g. an InMemoryDocstore.
+            index_to_docstore_id (dict[int, str]): Index position of each document.
+            level (int): zstd compression level.
+        """
+        positions = sorted(index_to_docstore_id)
+        columns = cls.from_documents(
+            (index_to_docstore_id[position], docstore.search(index_to_docstore_id[position]))
+            for position in positions
+        )
+        return columns.to_bytes(np.asarray(positions, dtype=np.int64), level)
+
+    def to_bytes(self, positions: np.ndarray | None = None, level=3) -> bytes:
+        """Serializes the docstore, including added and without deleted documents.
+
+        Args:
+            positions (optional): Index position of each document in order, or -1 for
+                documents that are not in an index yet (e.g. a segment).
+            level (int): zstd compression level.
+        """
+        columns = self
+        if self._added or self._deleted:
+            columns = ColumnarDocstore.from_documents(
+                (doc_id, self.search(doc_id)) for doc_id in self._live_ids()
+            )
+        if positions is None:
+            positions = np.full(len(columns.ids), -1, dtype=np.int64)
+
+        encoded_ids = [doc_id.encode("utf-8") for doc_id in columns.ids]
+        header = {
+            "format": DOCSTORE_FORMAT,
+            "titles": columns._titles,
+            "extra": {str(row): metadata for row, metadata in columns._extra.items()},
+        }
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            header=np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8),
+            ids=np.frombuffer(b"".join(encoded_ids), dtype=np.uint8),
+            id_offsets=np.cumsum([0] + [len(i) for i in encoded_ids], dtype=np.int64),
+            text=np.frombuffer(columns._text, dtype=np.uint8),
+            text_offsets=columns._text_offsets,
+            title_ids=columns._title_ids,
+            pages=columns._pages,
+            chunks=columns._chunks,
+            positions=positions,
+        )
+        return _MAGIC + zstandard.ZstdCompressor(level=level).compress(
+            buffer.getvalue()
+        )
+
+    def _read(self, row: int, doc_id: str) -> Document:
+        text = self._text[self._text_offsets[row] : self._text_offsets[row + 1]]
+        metadata = self._extra.get(row)
+        if metadata is None:
+            metadata = {
+                "title": self._titles[self._title_ids[row]],
+                "page": int(self._pages[row]),
+                "chunk": int(self._chunks[row]),
+            }
+        return Document(id=doc_id, page_content=text.decode("utf-8"), metadata=dict(metadata))
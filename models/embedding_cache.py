@@ -0,0 +1,318 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from services.logger import Logger
+
+logger = Logger()
+
+
+class DiskEmbeddingStore:
+    """Append-only on-disk embedding store.
+
+    Vectors are kept in a raw float32 file that is memory mapped for reads, with the
+    content hash of each row stored in a sidecar keys file and the vector dimension in
+    a meta file. Vectors are written before their keys, so a crash mid-append leaves
+    vectors without keys (or a partial key line) behind, which are truncated before the
+    store is read or appended to again.
+
+    Several processes (e.g. uvicorn workers) may share the directory. Appends and
+    truncation hold an exclusive file lock, and each process reads the rows appended
+    by the others before appending its own.
+    """
+
+    def __init__(self, directory: str, namespace: str, dim: int | None = None):
+        os.makedirs(directory, exist_ok=True)
+        safe_namespace = "".join(c if c.isalnum() else "_" for c in namespace)
+        self._vectors_path = os.path.join(directory, f"{safe_namespace}.f32")
+        self._keys_path = os.path.join(directory, f"{safe_namespace}.keys")
+        self._meta_path = os.path.join(directory, f"{safe_namespace}.meta")
+        self._lock_path = os.path.join(directory, f"{safe_namespace}.lock")
+
+        self._lock = threading.Lock()
+        self._rows: dict[str, int] = {}
+        self._row_count = 0
+        # Bytes of the keys file read into _rows
+        self._keys_size = 0
+        self._mmap: np.ndarray | None = None
+        self.dim = dim
+
+        self._load()
+
+    @contextmanager
+    def _file_lock(self):
+        """Holds an exclusive lock on the store, shared by all processes."""
+        with open(self._lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        with self._lock, self._file_lock():
+            self._sync()
+        if self._rows:
+            logger.info(
+                f"Loaded {self._row_count} cached embeddings from {self._vectors_path}"
+            )
+
+    def _sync(self):
+        """Reads the rows appended since the last sync and truncates a torn append.
+
+        Must be called with both locks held.
+        """
+        stored_dim = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r") as f:
+                stored_dim = int(json.load(f)["dim"])
+        if stored_dim is None or (self.dim is not None and stored_dim != self.dim):
+            # Without the meta file (e.g. a store written by an older version) the
+            # dimension of the rows is unknown, so the store starts over
+            if stored_dim is not None:
+                logger.warning(
+                    f"Embedding cache {self._vectors_path} has dimension {stored_dim}, "
+                    f"expected {self.dim}; clearing it"
+                )
+            self._reset()
+            return
+        self.dim = stored_dim
+
+        if _file_size(self._keys_path) < self._keys_size:
+            # Cleared by another process
+            self._rows, self._row_count, self._keys_size = {}, 0, 0
+            self._mmap = None
+
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._keys_size)
+            lines = f.read().split(b"\n")[:-1]
+        vector_rows = _file_size(self._vectors_path) // (4 * self.dim)
+        for line in lines[: max(0, vector_rows - self._row_count)]:
+            self._rows[line.decode("ascii")] = self._row_count
+            self._row_count += 1
+            self._keys_size += len(line) + 1
+
+        if _file_size(self._keys_path) > self._keys_size:
+            os.truncate(self._keys_path, self._keys_size)
+        if vector_rows > self._row_count:
+            logger.warning(
+                f"Dropping {vector_rows - self._row_count} cached embeddings without "
+                f"keys from {self._vectors_path}"
+            )
+        if _file_size(self._vectors_path) > 4 * self.dim * self._row_count:
+            os.truncate(self._vectors_path, 4 * self.dim * self._row_count)
+
+    def _reset(self):
+        for path in (self._vectors_path, self._keys_path):
+            with open(path, "wb"):
+                pass
+        self._rows, self._row_count, self._keys_size = {}, 0, 0
+        self._mmap = None
+        if self.dim is not None:
+            self._write_dim()
+
+    def _write_dim(self):
+        tmp_path = f"{self._meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def get(self, key: str) -> np.ndarray | None:
+        row = self._rows.get(key)
+        if row is None:
+            return None
+
+        with self._lock:
+            if self._mmap is None or row >= self._mmap.shape[0]:
+                # Mapped up to the known rows, as another process may be appending
+                self._mmap = np.memmap(
+                    self._vectors_path,
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(self._row_count, self.dim),
+                )
+            return np.array(self._mmap[row])
+
+    def put_many(self, items: list[tuple[str, np.ndarray]]):
+        with self._lock, self._file_lock():
+            self._sync()
+            items = [(key, vector) for key, vector in items if key not in self._rows]
+            if not items:
+                return
+            if self.dim is None:
+                self.dim = items[0][1].shape[0]
+                self._write_dim()
+
+            matrix = np.stack([vector for _, vector in items]).astype(np.float32)
+            keys = "".join(f"{key}\n" for key, _ in items).encode("ascii")
+            with open(self._vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(self._keys_path, "ab") as f:
+                f.write(keys)
+
+            for key, _ in items:
+                self._rows[key] = self._row_count
+                self._row_count += 1
+            self._keys_size += len(keys)
+
+
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embeddings model with a content-hash keyed cache.
+
+    Lookups go to a bounded in-memory LRU first and then, if a cache directory is
+    configured, to a memory-mapped on-disk store that survives restarts. Only texts
+    missing from both tiers are sent to the underlying model.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        namespace: str,
+        max_entries: int | None = None,
+        cache_dir: str | None = None,
+    ):
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self.max_entries = (
+            max_entries
+            if max_entries is not None
+            else int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+        )
+        cache_dir = cache_dir if cache_dir is not None else os.getenv("EMBEDDING_CACHE_DIR")
+
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._disk = DiskEmbeddingStore(cache_dir, namespace) if cache_dir else None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text: str, kind: str) -> str:
+        # Queries and documents are keyed separately since some models embed them
+        # differently (e.g. with an instruction prefix on queries).
+        return hashlib.sha256(
+            f"{self.namespace}\0{kind}\0{text}".encode("utf-8")
+        ).hexdigest()
+
+    def _get(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                return vector
+
+        if self._disk is not None:
+            vector = self._disk.get(key)
+            if vector is not None:
+                self._remember(key, vector)
+            return vector
+        return None
+
+    def _remember(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, texts: list[str], kind: str):
+        """Split texts into cached vectors and the positions that still need embedding."""
+        keys = [self._key(text, kind) for text in texts]
+        vectors: list[np.ndarray | None] = [self._get(key) for key in keys]
+
+        # Repeated texts within one call are only embedded once
+        missing, seen = [], set()
+        for i, vector in enumerate(vectors):
+            if vector is None and keys[i] not in seen:
+                seen.add(keys[i])
+                missing.append(i)
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return keys, vectors, missing
+
+    def _fill(self, keys, vectors, missing, embedded: list[list[float]]):
+        new_items = {}
+        for i, embedding in zip(missing, embedded):
+            vector = np.asarray(embedding, dtype=np.float32)
+            self._remember(keys[i], vector)
+            new_items[keys[i]] = vector
+
+        if self._disk is not None and new_items:
+            self._disk.put_many(list(new_items.items()))
+        return [
+            (vector if vector is not None else new_items[key]).tolist()
+            for key, vector in zip(keys, vectors)
+        ]
+
+    async def _alookup(self, texts: list[str], kind: str):
+        # The disk tier reads and appends to files, the latter under a lock shared with
+        # other workers, so it is kept off the event loop
+        if self._disk is None:
+            return self._lookup(texts, kind)
+        return await asyncio.to_thread(self._lookup, texts, kind)
+
+    async def _afill(self, keys, vectors, missing, embedded: list[list[float]]):
+        if self._disk is None or not missing:
+            return self._fill(keys, vectors, missing, embedded)
+        return await asyncio.to_thread(self._fill, keys, vectors, missing, embedded)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, vectors, missing = self._lookup(texts, "document")
+        embedded = (
+            self.embeddings.embed_documents([texts[i] for i in missing])
+            if missing
+            else []
+        )
+        return self._fill(keys, vectors, missing, embedded)
+
+    def embed_query(self, text: str) -> list[float]:
+        keys, vectors, missing = self._lookup([text], "query")
+        embedded = [self.embeddings.embed_query(text)] if missing else []
+        return self._fill(keys, vectors, missing, embedded)[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, vectors, missing = await self._alookup(texts, "document")
+        embedded = (
+            await self.embeddings.aembed_documents([texts[i] for i in missing])
+            if missing
+            else []
+        )
+        return await self._afill(keys, vectors, missing, embedded)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        keys, vectors, missing = await self._alookup([text], "query")
+        embedded = [await self.embeddings.aembed_query(text)] if missing else []
+        return (await self._afill(keys, vectors, missing, embedded))[0]
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Embeds several queries with one request to the underlying model.
+
+        Queries are cached separately from documents, but the uncached ones are sent as
+        one documents request. This assumes the model embeds queries and documents the
+        same way, which holds for the OpenAI and Ollama embeddings used here. Models
+        with their own aembed_queries (e.g. local models with a query prefix) use it.
+        """
+        keys, vectors, missing = await self._alookup(texts, "query")
+        embed = getattr(
+            self.embeddings, "aembed_queries", self.embeddings.aembed_documents
+        )
+        embedded = await embed([texts[i] for i in missing]) if missing else []
+        return await self._afill(keys, vectors, missing, embedded)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._memory),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
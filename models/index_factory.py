@@ -0,0 +1,285 @@
+import argparse
+import math
+import os
+import threading
+import time
+import faiss
+import numpy as np
+from services.logger import Logger
+
+logger = Logger()
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+# Corpus sizes at which "auto" switches to the next index type. Brute force search is
+# fast enough for a few tens of thousands of chunks, after which IVF keeps latency flat
+# and, for very large corpora, PQ keeps memory bounded.
+AUTO_IVF_FLAT_MIN_VECTORS = 50_000
+AUTO_IVF_PQ_MIN_VECTORS = 1_000_000
+
+# IVF and PQ need enough vectors to train their quantizers
+IVF_MIN_TRAINING_POINTS_PER_LIST = 39
+PQ_MIN_TRAINING_POINTS = 256 * IVF_MIN_TRAINING_POINTS_PER_LIST
+
+
+class IndexConfig:
+    """Index settings, read from the environment by default."""
+
+    def __init__(
+        self,
+        index_type=None,
+        hnsw_m=None,
+        hnsw_ef_search=None,
+        ivf_nlist=None,
+        ivf_nprobe=None,
+        pq_m=None,
+    ):
+        self.index_type = index_type or os.getenv("VECTORSTORE_INDEX_TYPE", "auto")
+        if self.index_type not in INDEX_TYPES + ("auto",):
+            raise ValueError(
+                f"Invalid index type {self.index_type}. Valid index types: auto,{','.join(INDEX_TYPES)}."
+            )
+        self.hnsw_m = hnsw_m or int(os.getenv("HNSW_M", "32"))
+        self.hnsw_ef_search = hnsw_ef_search or int(os.getenv("HNSW_EF_SEARCH", "64"))
+        # 0 picks the number of lists from the corpus size
+        self.ivf_nlist = (
+            ivf_nlist if ivf_nlist is not None else int(os.getenv("IVF_NLIST", "0"))
+        )
+        self.ivf_nprobe = ivf_nprobe or int(os.getenv("IVF_NPROBE", "16"))
+        self.pq_m = pq_m or int(os.getenv("PQ_M", "64"))
+
+    def resolve(self, n_vectors: int) -> str:
+        """Returns the index type to use for a corpus of the given size."""
+        index_type = self.index_type
+        if index_type == "auto":
+            if n_vectors >= AUTO_IVF_PQ_MIN_VECTORS:
+                index_type = "ivf_pq"
+            elif n_vectors >= AUTO_IVF_FLAT_MIN_VECTORS:
+                index_type = "ivf_flat"
+            else:
+                index_type = "flat"
+
+        # Fall back to brute force until there is enough data to train on
+        if index_type in ("ivf_flat", "ivf_pq"):
+            if n_vectors < self.nlist(n_vectors) * IVF_MIN_TRAINING_POINTS_PER_LIST:
+                return "flat"
+            if index_type == "ivf_pq" and n_vectors < PQ_MIN_TRAINING_POINTS:
+                return "flat"
+        return index_type
+
+    def nlist(self, n_vectors: int) -> int:
+        if self.ivf_nlist:
+            return self.ivf_nlist
+        return max(1, int(4 * math.sqrt(n_vectors)))
+
+
+def index_type_of(index) -> str:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def build_index(index_type: str, dim: int, vectors=None, config: IndexConfig = None):
+    """Builds an index of the given type, training it on and adding `vectors` if given.
+
+    Vectors are added in order, so position i in the index is row i of `vectors`.
+    """
+    config = config or IndexConfig()
+    n_vectors = 0 if vectors is None else len(vectors)
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, config.hnsw_m)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = config.nlist(n_vectors)
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            if dim % config.pq_m != 0:
+                raise ValueError(f"PQ_M={config.pq_m} does not divide dimension {dim}")
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, config.pq_m, 8)
+        index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+    else:
+        raise ValueError(f"Invalid index type {index_type}")
+
+    apply_search_params(index, config)
+    if n_vectors:
+        index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    return index
+
+
+def apply_search_params(index, config: IndexConfig = None):
+    """Applies the configured search-time parameters (efSearch, nprobe) to an index."""
+    config = config or IndexConfig()
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config.hnsw_ef_search
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = config.ivf_nprobe
+
+
+def reconstruct_all(index) -> np.ndarray:
+    """Returns the stored vectors of an index in position order.
+
+    Exact for flat, HNSW and IVF-Flat indexes, approximate for IVF-PQ.
+    """
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    downcast = faiss.downcast_index(index)
+    if isinstance(downcast, faiss.IndexIVF):
+        downcast.make_direct_map()
+    return downcast.reconstruct_n(0, index.ntotal)
+
+
+_direct_map_lock = threading.Lock()
+
+
+def reconstruct_positions(index, positions) -> np.ndarray:
+    """Returns the stored vectors at the given positions of an index.
+
+    Exact for flat, HNSW and IVF-Flat indexes, approximate for IVF-PQ.
+    """
+    downcast = faiss.downcast_index(index)
+    if isinstance(downcast, faiss.IndexIVF) and downcast.direct_map.no():
+        # IVF indexes need a map from positions to inverted lists, built once
+        with _direct_map_lock:
+            if downcast.direct_map.no():
+                downcast.make_direct_map()
+    return downcast.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+
+
+def rebuild_index(index, keep=None, index_type=None, config: IndexConfig = None):
+    """Rebuilds an index from its stored vectors.
+
+    Args:
+        index: The index to rebuild.
+        keep (optional): Sorted positions of the vectors to keep. Defaults to all.
+        index_type (optional): Index type of the new index. Defaults to the current type,
+            in which case trained quantizers are reused instead of retrained.
+    """
+    vectors = reconstruct_all(index)
+    if keep is not None:
+        vectors = vectors[keep]
+
+    if index_type is None or index_type == index_type_of(index):
+        new_index = faiss.clone_index(index)
+        new_index.reset()
+        apply_search_params(new_index, config)
+        if len(vectors):
+            new_index.add(vectors)
+        return new_index
+
+    return build_index(index_type, index.d, vectors, config)
+
+
+def supports_remove(index) -> bool:
+    """Whether remove_ids keeps the remaining positions contiguous, as LangChain's
+    FAISS.delete assumes. Only true for flat indexes; IVF keeps the old ids and HNSW
+    cannot remove at all."""
+    return index_type_of(index) == "flat"
+
+
+def recall_report(index, queries, k=5, baseline_vectors=None):
+    """Measures recall@k and search latency of an index against exact search.
+
+    Args:
+        index: The index to evaluate.
+        queries: Query vectors.
+        k (int): Number of neighbours.
+        baseline_vectors (optional): Vectors for the exact baseline. Defaults to the
+            vectors stored in the index.
+
+    Returns:
+        dict[str, float]: Recall@k and mean latency in milliseconds per query for the
+        index and for the flat baseline.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if baseline_vectors is None:
+        baseline_vectors = reconstruct_all(index)
+    baseline = faiss.IndexFlatL2(index.d)
+    baseline.add(np.ascontiguousarray(baseline_vectors, dtype=np.float32))
+
+    def timed_search(target):
+        start = time.perf_counter()
+        results = [target.search(query[None, :], k)[1][0] for query in queries]
+        latency = (time.perf_counter() - start) * 1000 / max(1, len(queries))
+        return results, latency
+
+    expected, flat_latency = timed_search(baseline)
+    actual, latency = timed_search(index)
+
+    hits = sum(
+        len(set(e[e >= 0]) & set(a[a >= 0])) for e, a in zip(expected, actual)
+    )
+    total = sum(len(e[e >= 0]) for e in expected)
+
+    return {
+        "index_type": index_type_of(index),
+        "vectors": index.ntotal,
+        "k": k,
+        "recall": round(hits / total, 4) if total else 1.0,
+        "latency_ms": round(latency, 4),
+        "flat_latency_ms": round(flat_latency, 4),
+    }
+
+
+def sample_queries(vectors: np.ndarray, n_queries=100, noise=0.01, seed=0):
+    """Samples stored vectors and perturbs them slightly to use as queries."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)
+    queries = vectors[rows]
+    scale = noise * np.linalg.norm(queries, axis=1, keepdims=True) / math.sqrt(
+        vectors.shape[1]
+    )
+    return (queries + rng.normal(size=queries.shape) * scale).astype(np.float32)
+
+
+def compare_index_types(vectors: np.ndarray, n_queries=100, k=5, configs=None):
+    """Builds each candidate index over `vectors` and reports recall and latency."""
+    queries = sample_queries(vectors, n_queries)
+    configs = configs or [
+        ("hnsw", IndexConfig("hnsw", hnsw_ef_search=ef)) for ef in (16, 64, 256)
+    ] + [
+        (index_type, IndexConfig(index_type, ivf_nprobe=nprobe))
+        for index_type in ("ivf_flat", "ivf_pq")
+        for nprobe in (4, 16, 64)
+    ]
+
+    reports = []
+    for index_type, config in configs:
+        if config.resolve(len(vectors)) != index_type:
+            logger.warning(f"Not enough vectors to train {index_type}, skipping")
+            continue
+        start = time.perf_counter()
+        index = build_index(index_type, vectors.shape[1], vectors, config)
+        report = recall_report(index, queries, k, baseline_vectors=vectors)
+        report["build_seconds"] = round(time.perf_counter() - start, 3)
+        report["hnsw_ef_search"] = config.hnsw_ef_search if index_type == "hnsw" else None
+        report["ivf_nprobe"] = config.ivf_nprobe if index_type != "hnsw" else None
+        reports.append(report)
+    return reports
+
+
+if __name__ == "__main__":
+    # Prints a recall vs latency report of the candidate index settings for the
+    # current vector store, e.g. python -m models.index_factory --queries 200
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--course-id", default=None)
+    args = parser.parse_args()
+
+    from models.vector_store import VectorStore
+
+    store_vectors = reconstruct_all(
+        VectorStore(course_id=args.course_id).vector_store.index
+    )
+    for row in compare_index_types(store_vectors, args.queries, args.k):
+        print(row)
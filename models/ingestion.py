@@ -0,0 +1,263 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from PyPDF2 import PdfReader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.docstore.document import Document
+from services.logger import Logger
+
+logger = Logger()
+
+# Forked workers would inherit the locks of the server's other threads (e.g. of the log
+# queue) in whatever state they were, and could block on one forever. Workers are
+# forked from a separate single-threaded server process instead, which has this module
+# imported already.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _mp_context = multiprocessing.get_context("forkserver")
+    _mp_context.set_forkserver_preload([__name__])
+else:
+    _mp_context = multiprocessing.get_context("spawn")
+
+
+def extract_pages(filename: str, content: bytes) -> list[tuple[int, str]]:
+    """Extracts the text of every page of a PDF.
+
+    Defined at module level so that it can be run in a worker process.
+
+    Returns:
+        list[tuple[int, str]]: (page number, page text) for each page, starting at 1.
+    """
+    pdf = PdfReader(io.BytesIO(content))
+    return [
+        (page_number, page.extract_text())
+        for page_number, page in enumerate(pdf.pages, start=1)
+    ]
+
+
+@dataclass
+class StageStats:
+    count: int = 0
+    started: float | None = None
+    finished: float | None = None
+
+    def record(self, count, started, finished):
+        self.count += count
+        self.started = started if self.started is None else min(self.started, started)
+        self.finished = (
+            finished if self.finished is None else max(self.finished, finished)
+        )
+
+    @property
+    def rate(self) -> float:
+        if self.started is None or self.finished <= self.started:
+            return 0.0
+        return self.count / (self.finished - self.started)
+
+
+@dataclass
+class IngestionStats:
+    """Per-stage throughput of an ingestion run."""
+
+    pages: StageStats = field(default_factory=StageStats)
+    chunks: StageStats = field(default_factory=StageStats)
+    embeddings: StageStats = field(default_factory=StageStats)
+    skipped: int = 0
+    retries: int = 0
+
+    def summary(self) -> dict[str, float]:
+        return {
+            "pages": self.pages.count,
+            "chunks": self.chunks.count,
+            "embeddings": self.embeddings.count,
+            "skipped_chunks": self.skipped,
+            "pages_per_second": round(self.pages.rate, 2),
+            "chunks_per_second": round(self.chunks.rate, 2),
+            "embeddings_per_second": round(self.embeddings.rate, 2),
+            "embedding_retries": self.retries,
+        }
+
+
+class IngestionPipeline:
+    """Turns PDFs into embedded chunks in three overlapping stages.
+
+    1. Page text is extracted in a process pool, one PDF per task.
+    2. As each PDF's pages arrive they are split into chunks, which are grouped into
+       batches of `batch_size`.
+    3. Each full batch is embedded on a thread pool while later PDFs are still being
+       extracted and chunked. Rate-limited batches are retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        chunk_size=3000,
+        chunk_overlap=100,
+        batch_size=None,
+        max_workers=None,
+        embedding_concurrency=None,
+        max_retries=None,
+    ):
+        self.embeddings = embeddings
+        self.chunk_size = chunk_size
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+        self.batch_size = batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+        self.max_workers = max_workers or int(
+            os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1))
+        )
+        self.embedding_concurrency = embedding_concurrency or int(
+            os.getenv("EMBEDDING_CONCURRENCY", "4")
+        )
+        self.max_retries = (
+            max_retries
+            if max_retries is not None
+            else int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+        )
+
+    def run(self, files: list[tuple[str, bytes]], on_progress=None, is_indexed=None):
+        """Extracts, chunks and embeds the given PDFs.
+
+        Args:
+            files (list[tuple[str, bytes]]): (filename, content) of each PDF.
+            on_progress (optional): Called as on_progress("parsed", 1) after each PDF
+                is parsed and on_progress("embedded", n) after each embedded batch.
+            is_indexed (optional): Called with the id of each chunk. Chunks for which it
+                returns True are already indexed and are not embedded again.
+
+        Returns:
+            tuple: The chunk documents to add, their embeddings (in the same order) and
+            the IngestionStats of the run.
+        """
+        on_progress = on_progress or (lambda stage, count=0: None)
+        stats = IngestionStats()
+        documents: list[Document] = []
+        batches = []
+        seen_ids = set()
+
+        with ThreadPoolExecutor(
+            max_workers=self.embedding_concurrency
+        ) as embed_pool, self._extraction_pool(len(files)) as extract_pool:
+            pending: list[Document] = []
+            extract_started = time.perf_counter()
+
+            mapper = extract_pool.map if extract_pool is not None else map
+            page_results = mapper(
+                extract_pages,
+                [filename for filename, _ in files],
+                [content for _, content in files],
+            )
+
+            for (filename, _), pages in zip(files, page_results):
+                stats.pages.record(len(pages), extract_started, time.perf_counter())
+                on_progress("parsed", 1)
+
+                chunk_started = time.perf_counter()
+                chunks = []
+                for chunk in self._chunk(filename, pages):
+                    # Skip chunks repeated within the upload or already in the store
+                    if chunk.id in seen_ids or (is_indexed and is_indexed(chunk.id)):
+                        stats.skipped += 1
+                        continue
+                    seen_ids.add(chunk.id)
+                    chunks.append(chunk)
+                stats.chunks.record(len(chunks), chunk_started, time.perf_counter())
+
+                documents.extend(chunks)
+                pending.extend(chunks)
+                while len(pending) >= self.batch_size:
+                    batch, pending = pending[: self.batch_size], pending[self.batch_size :]
+                    batches.append(
+                        embed_pool.submit(self._embed, batch, stats, on_progress)
+                    )
+
+            if pending:
+                batches.append(
+                    embed_pool.submit(self._embed, pending, stats, on_progress)
+                )
+
+            vectors = [vector for batch in batches for vector in batch.result()]
+
+        logger.info(f"Ingestion stats: {stats.summary()}")
+        return documents, vectors, stats
+
+    def _extraction_pool(self, file_count):
+        # Spawning worker processes is not worth it for a single PDF
+        workers = min(self.max_workers, file_count)
+        if workers <= 1:
+            return _NullPool()
+        return ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context)
+
+    @staticmethod
+    def title(filename: str) -> str:
+        return filename.replace(".pdf", "")
+
+    @staticmethod
+    def chunk_id(title: str, page: int, content: str) -> str:
+        """Stable chunk id, so that re-uploading an unchanged page yields the same ids."""
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+        return f"{title}:{page}:{content_hash}"
+
+    def _chunk(self, filename, pages) -> list[Document]:
+        title = self.title(filename)
+        documents = []
+
+        for page_number, page_content in pages:
+            if len(page_content) > self.chunk_size:
+                # Split page content into chunks if length of page content exceeds the chunk size setting.
+                chunks = self.text_splitter.split_text(page_content)
+            else:
+                chunks = [page_content]
+
+            for i, chunk in enumerate(chunks):
+                documents.append(
+                    Document(
+                        id=self.chunk_id(title, page_number, chunk),
+                        page_content=chunk,
+                        metadata={"title": title, "page": page_number, "chunk": i + 1},
+                    )
+                )
+        return documents
+
+    def _embed(self, batch: list[Document], stats: IngestionStats, on_progress):
+        texts = [doc.page_content for doc in batch]
+
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                vectors = self.embeddings.embed_documents(texts)
+                stats.embeddings.record(len(vectors), started, time.perf_counter())
+                on_progress("embedded", len(vectors))
+                return vectors
+            except Exception as e:
+                if not _is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                delay = min(60.0, 2**attempt) * (0.5 + random.random())
+                stats.retries += 1
+                logger.warning(
+                    f"Embedding batch rate limited, retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    return (
+        getattr(e, "status_code", None) == 429
+        or "RateLimit" in type(e).__name__
+        or "429" in str(e)
+    )
+
+
+class _NullPool:
+    """Stand-in for an executor that runs extraction in the calling thread."""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
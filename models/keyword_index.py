@@ -0,0 +1,169 @@
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+# Identifiers such as module codes (SC2006), function names (get_tokens_used) and
+# dotted names (np.array) are kept whole, in addition to their parts
+_TOKEN_PATTERN = re.compile(r"[a-z0-9_]+(?:[.\-][a-z0-9_]+)*")
+
+
+# Common English words, which match nearly every chunk and are not searched for
+STOPWORDS = frozenset(
+    """
+    a about above after again against all am an and any are as at be because been
+    before being below between both but by can could did do does doing down during
+    each few for from further had has have having he her here hers herself him
+    himself his how i if in into is it its itself just me more most my myself no nor
+    not now of off on once only or other our ours ourselves out over own same she
+    should so some such than that the their theirs them themselves then there these
+    they this those through to too under until up very was we were what when where
+    which while who whom why will with would you your yours yourself yourselves
+    """.split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if "." in token or "-" in token:
+            tokens.extend(part for part in re.split(r"[.\-]", token) if part)
+    return tokens
+
+
+class KeywordIndex:
+    """In-process BM25 inverted index over chunk texts.
+
+    Kept alongside the FAISS index so that exact terms students paste (module codes,
+    function names, error messages) are found even when the dense embedding misses
+    them. Updated incrementally as chunks are added and deleted.
+    """
+
+    def __init__(self, k1=1.5, b=0.75, max_df=None, max_query_terms=None):
+        self.k1 = k1
+        self.b = b
+        # Query terms found in more than this fraction of the chunks are skipped, as
+        # they add little to the ranking but score most of the corpus
+        self.max_df = (
+            max_df if max_df is not None else float(os.getenv("KEYWORD_MAX_DF", "0.5"))
+        )
+        # Only the rarest terms of a long query are searched
+        self.max_query_terms = max_query_terms or int(
+            os.getenv("KEYWORD_MAX_QUERY_TERMS", "32")
+        )
+
+        self._lock = threading.Lock()
+        self._postings: dict[str, dict[str, int]] = {}
+        self._doc_terms: dict[str, dict[str, int]] = {}
+        self._lengths: dict[str, int] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_terms)
+
+    def add(self, documents):
+        """Indexes (doc_id, text) pairs. Ids that are already indexed are skipped."""
+        with self._lock:
+            for doc_id, text in documents:
+                if doc_id not in self._doc_terms:
+                    self._add_terms(doc_id, dict(Counter(tokenize(text))))
+
+    def delete(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                terms = self._doc_terms.pop(doc_id, None)
+                if terms is None:
+                    continue
+                for term in terms:
+                    postings = self._postings[term]
+                    del postings[doc_id]
+                    if not postings:
+                        del self._postings[term]
+                self._total_length -= self._lengths.pop(doc_id)
+
+    def search(self, query: str, k=20) -> list[tuple[str, float]]:
+        """Returns up to k (doc_id, BM25 score) pairs, best first.
+
+        Stopwords, repeated terms and terms found in more than max_df of the chunks are
+        dropped from the query, and at most max_query_terms of the rarest remaining
+        terms are searched.
+        """
+        query_terms = {term for term in tokenize(query) if term not in STOPWORDS}
+
+        # The postings of the searched terms are copied under the lock and scored
+        # outside it, so that searches do not hold up each other or indexing
+        with self._lock:
+            n_docs = len(self._doc_terms)
+            if not n_docs:
+                return []
+            average_length = self._total_length / n_docs
+            max_df = max(1, self.max_df * n_docs)
+            term_postings = [
+                self._postings[term]
+                for term in query_terms
+                if 0 < len(self._postings.get(term, ())) <= max_df
+            ]
+            term_postings.sort(key=len)
+            term_postings = [
+                list(postings.items())
+                for postings in term_postings[: self.max_query_terms]
+            ]
+        lengths = self._lengths
+
+        scores: dict[str, float] = {}
+        for postings in term_postings:
+            df = len(postings)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for doc_id, tf in postings:
+                # Deleted since the postings were copied
+                length = lengths.get(doc_id)
+                if length is None:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * (
+                    tf * (self.k1 + 1) / (tf + norm)
+                )
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def to_json(self) -> bytes:
+        with self._lock:
+            return json.dumps({"format": 1, "documents": self._doc_terms}).encode(
+                "utf-8"
+            )
+
+    @classmethod
+    def from_json(cls, data: bytes) -> "KeywordIndex":
+        index = cls()
+        for doc_id, terms in json.loads(data)["documents"].items():
+            index._add_terms(doc_id, terms)
+        return index
+
+    def _add_terms(self, doc_id, terms: dict[str, int]):
+        self._doc_terms[doc_id] = terms
+        length = sum(terms.values())
+        self._lengths[doc_id] = length
+        self._total_length += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[doc_id] = tf
+
+
+def reciprocal_rank_fusion(rankings, k=60, weights=None) -> dict[str, float]:
+    """Fuses several rankings of doc ids into one score per id.
+
+    Args:
+        rankings: Lists of doc ids, best first.
+        k (int): Damping constant; 60 is the value from the original RRF paper.
+        weights (optional): Weight of each ranking. Defaults to 1 for all.
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+    scores: dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank + 1)
+    return scores
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from langchain_core.embeddings import Embeddings
+from services.logger import Logger
+
+logger = Logger()
+
+QUANTIZATION_MODES = ("none", "int8", "onnx")
+
+
+class LocalEmbeddings(Embeddings):
+    """Embeds texts in-process on CPU with sentence-transformers.
+
+    Queries arriving concurrently (from request handlers or worker threads) are
+    collected for up to `max_wait_ms` into one micro-batch, since encoding a batch of
+    queries costs little more than encoding one. Documents are already batched by the
+    ingestion pipeline and are encoded directly.
+
+    Quantization modes:
+        none: float32 PyTorch model.
+        int8: PyTorch dynamic int8 quantization of the linear layers.
+        onnx: ONNX Runtime backend. LOCAL_EMBEDDING_ONNX_FILE selects a pre-quantized
+            export such as onnx/model_qint8_avx512_vnni.onnx. Requires the optional
+            sentence-transformers[onnx] extra.
+    """
+
+    def __init__(
+        self,
+        model_name=None,
+        quantization=None,
+        max_batch_size=None,
+        max_wait_ms=None,
+        query_prefix=None,
+    ):
+        self.model_name = model_name or os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-m3")
+        self.quantization = quantization or os.getenv(
+            "LOCAL_EMBEDDING_QUANTIZATION", "none"
+        )
+        if self.quantization not in QUANTIZATION_MODES:
+            raise ValueError(
+                f"Invalid quantization {self.quantization}. Valid modes: {','.join(QUANTIZATION_MODES)}."
+            )
+        self.max_batch_size = max_batch_size or int(
+            os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32")
+        )
+        self.max_wait = (
+            max_wait_ms
+            if max_wait_ms is not None
+            else float(os.getenv("LOCAL_EMBEDDING_MAX_WAIT_MS", "5"))
+        ) / 1000
+        # Some models (e.g. bge-small-en) expect an instruction before queries
+        self.query_prefix = (
+            query_prefix
+            if query_prefix is not None
+            else os.getenv("LOCAL_EMBEDDING_QUERY_PREFIX", "")
+        )
+
+        start = time.perf_counter()
+        self.model = self._load_model()
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        logger.info(
+            f"Loaded local embedding model {self.model_name} ({self.quantization}, "
+            f"{self.dimension} dim) in {time.perf_counter() - start:.1f}s"
+        )
+
+        self.batches = 0
+        self.batched_queries = 0
+
+        self._queue: queue.Queue = queue.Queue()
+        self._worker = threading.Thread(
+            target=self._run, name="local-embeddings", daemon=True
+        )
+        self._worker.start()
+
+    def _load_model(self):
+        from sentence_transformers import SentenceTransformer
+
+        if self.quantization == "onnx":
+            model_kwargs = {}
+            if os.getenv("LOCAL_EMBEDDING_ONNX_FILE"):
+                model_kwargs["file_name"] = os.getenv("LOCAL_EMBEDDING_ONNX_FILE")
+            return SentenceTransformer(
+                self.model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs
+            )
+
+        model = SentenceTransformer(self.model_name, device="cpu")
+        if self.quantization == "int8":
+            import torch
+
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model
+
+    def _encode(self, texts: list[str]) -> list[list[float]]:
+        vectors = self.model.encode(
+            texts,
+            batch_size=self.max_batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return vectors.tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self._encode(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._submit(text).result()
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await asyncio.wrap_future(self._submit(text))
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        futures = [asyncio.wrap_future(self._submit(text)) for text in texts]
+        return list(await asyncio.gather(*futures))
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "batches": self.batches,
+            "queries": self.batched_queries,
+            "mean_batch_size": round(self.batched_queries / max(1, self.batches), 2),
+        }
+
+    def _submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((self.query_prefix + text, future))
+        return future
+
+    def _run(self):
+        # Micro-batching loop: waits for a query, then collects whatever else arrives
+        # within max_wait (up to max_batch_size) and encodes them together
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Callers that were cancelled while waiting (e.g. a client disconnected)
+            # are dropped. Once running, a future can no longer be cancelled.
+            batch = [
+                (text, future)
+                for text, future in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+
+            try:
+                vectors = self._encode([text for text, _ in batch])
+            except Exception as e:
+                logger.error(f"Local embedding batch failed: {str(e)}")
+                # Encoded one by one, so that one bad query fails only its own caller
+                for text, future in batch:
+                    try:
+                        future.set_result(self._encode([text])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.batched_queries += len(batch)
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
@@ -0,0 +1,61 @@
+from langchain.docstore.document import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+
+class OverlayDocstore(Docstore, AddableMixin):
+    """Base for docstores over an immutable set of stored documents.
+
+    The stored documents are never modified: added documents are kept in memory and
+    deletions are recorded. Subclasses implement _read() to build the Document of a
+    stored row when a search returns it.
+    """
+
+    def __init__(self, ids: list[str]):
+        self.ids = ids
+        self._rows = {doc_id: row for row, doc_id in enumerate(ids)}
+        self._added: dict[str, Document] = {}
+        self._deleted: set[str] = set()
+
+    def _read(self, row: int, doc_id: str) -> Document:
+        """Builds the Document stored in the given row."""
+        raise NotImplementedError
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._added or (
+            doc_id in self._rows and doc_id not in self._deleted
+        )
+
+    def __len__(self) -> int:
+        return len(self._rows) - len(self._deleted) + len(self._added)
+
+    def search(self, search: str) -> str | Document:
+        # Mirrors InMemoryDocstore, which returns an error message for unknown ids
+        if search in self._added:
+            return self._added[search]
+        if search not in self:
+            return f"ID {search} not found."
+        return self._read(self._rows[search], search)
+
+    def add(self, texts: dict[str, Document]) -> None:
+        overlapping = {doc_id for doc_id in texts if doc_id in self}
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        self._added.update(texts)
+
+    def delete(self, ids: list) -> None:
+        missing = [doc_id for doc_id in ids if doc_id not in self]
+        if missing:
+            raise ValueError(f"Tried to delete ids that do not exist: {missing}")
+        for doc_id in ids:
+            if self._added.pop(doc_id, None) is None:
+                self._deleted.add(doc_id)
+
+    @property
+    def _dict(self) -> dict[str, Document]:
+        # Same attribute as InMemoryDocstore, used when serializing the whole store
+        return {doc_id: self.search(doc_id) for doc_id in self._live_ids()}
+
+    def _live_ids(self) -> list[str]:
+        return [doc_id for doc_id in self.ids if doc_id not in self._deleted] + list(
+            self._added
+        )
@@ -0,0 +1,148 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from models.vector_store import VectorStore
+from services.logger import Logger
+
+logger = Logger()
+
+# Course ids become part of GCS blob names, so only allow a safe subset of characters
+_COURSE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class VectorStoreRouter:
+    """Routes requests to per-course vector store shards.
+
+    Shards are loaded from GCS on first use and kept in memory in LRU order. Once more
+    than `max_resident_shards` are loaded, the least recently used idle shard is dropped
+    and will be reloaded from GCS the next time it is needed.
+
+    The default shard (course id None) is the store under the original `vectorstore/`
+    prefix, so deployments without course ids keep working unchanged.
+
+    Every `reload_interval` seconds, a background thread checks whether another replica
+    changed the GCS manifest of a resident shard. If so, the shard is loaded again and
+    swapped in; requests that already hold the old store finish their search on it.
+    """
+
+    def __init__(self, max_resident_shards=None, reload_interval=None):
+        self.max_resident_shards = max_resident_shards or int(
+            os.getenv("VECTORSTORE_MAX_RESIDENT_SHARDS", "8")
+        )
+        self.reload_interval = (
+            reload_interval
+            if reload_interval is not None
+            else float(os.getenv("VECTORSTORE_RELOAD_INTERVAL_SECONDS", "30"))
+        )
+        self._lock = threading.Lock()
+        self._shards: OrderedDict[str | None, VectorStore] = OrderedDict()
+        self._loading: dict[str | None, threading.Lock] = {}
+
+        self.loads = 0
+        self.evictions = 0
+        self.reloads = 0
+
+        if self.reload_interval > 0:
+            threading.Thread(
+                target=self._poll, name="vectorstore-reload", daemon=True
+            ).start()
+
+    @staticmethod
+    def validate_course_id(course_id: str | None):
+        if course_id is not None and not _COURSE_ID_PATTERN.match(course_id):
+            raise ValueError(
+                "Invalid course id. Course ids may only contain letters, digits, '-' and '_'."
+            )
+
+    def get(self, course_id: str | None = None) -> VectorStore:
+        """Returns the shard of a course, loading it from GCS if it is not resident."""
+        self.validate_course_id(course_id)
+
+        with self._lock:
+            shard = self._shards.get(course_id)
+            if shard is not None:
+                self._shards.move_to_end(course_id)
+                return shard
+            loading = self._loading.setdefault(course_id, threading.Lock())
+
+        # Load outside the router lock so that other courses are not blocked, but only
+        # once per course even if several requests ask for it at the same time.
+        with loading:
+            with self._lock:
+                shard = self._shards.get(course_id)
+                if shard is not None:
+                    self._shards.move_to_end(course_id)
+                    return shard
+
+            logger.info(f"Loading vector store shard for course {course_id}")
+            shard = VectorStore(course_id=course_id)
+
+            with self._lock:
+                self._shards[course_id] = shard
+                self._loading.pop(course_id, None)
+                self.loads += 1
+                self._evict()
+            return shard
+
+    def resident(self) -> list[str | None]:
+        with self._lock:
+            return list(self._shards)
+
+    def shards(self) -> list[tuple[str | None, VectorStore]]:
+        """Returns the resident (course id, shard) pairs."""
+        with self._lock:
+            return list(self._shards.items())
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "resident_shards": len(self._shards),
+            "max_resident_shards": self.max_resident_shards,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "reloads": self.reloads,
+        }
+
+    def reload_stale(self):
+        """Reloads the resident shards whose manifest was changed by another replica."""
+        with self._lock:
+            shards = list(self._shards.items())
+
+        for course_id, shard in shards:
+            try:
+                # Shards being written to are checked again on the next poll, as the
+                # write itself changes the manifest
+                if shard.is_busy() or not shard.is_stale():
+                    continue
+
+                logger.info(f"Vector store shard for course {course_id} changed in GCS, reloading")
+                # Raises if the store cannot be loaded, so the old store keeps serving
+                fresh = VectorStore(course_id=course_id)
+            except Exception as e:
+                logger.error(f"Failed to reload shard for course {course_id}: {str(e)}")
+                continue
+
+            with self._lock:
+                # The shard may have been evicted, or written to, in the meantime
+                if self._shards.get(course_id) is not shard or shard.is_busy():
+                    continue
+                self._shards[course_id] = fresh
+                self.reloads += 1
+
+    def _poll(self):
+        while True:
+            time.sleep(self.reload_interval)
+            self.reload_stale()
+
+    def _evict(self):
+        # Shards that are being written to stay resident so that a reload cannot miss
+        # a segment that is still being saved. The most recently used shard is kept.
+        for course_id in list(self._shards)[:-1]:
+            if len(self._shards) <= self.max_resident_shards:
+                break
+            if self._shards[course_id].is_busy():
+                continue
+            del self._shards[course_id]
+            self.evictions += 1
+            logger.info(f"Evicted vector store shard for course {course_id}")
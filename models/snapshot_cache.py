@@ -0,0 +1,258 @@
+import fcntl
+import json
+import os
+import shutil
+import uuid
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from models.index_factory import index_type_of
+from models.overlay_docstore import OverlayDocstore
+from services.logger import Logger
+
+logger = Logger()
+
+SNAPSHOT_FORMAT = 1
+
+
+def _mmap_flags(index_type: str) -> int:
+    # IVF indexes map their inverted lists; flat and HNSW indexes map their codes,
+    # which needs IO_FLAG_MMAP_IFC (faiss >= 1.10). The two flags cannot be combined.
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return faiss.IO_FLAG_MMAP
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+
+class FileDocstore(OverlayDocstore):
+    """Docstore backed by the files of a local snapshot.
+
+    Documents are stored as JSON records in one memory mapped file, with their byte
+    offsets in a sidecar array, so a document is only decoded when a search returns it
+    and processes opening the same snapshot share its pages. The snapshot files are
+    never modified, see OverlayDocstore.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "ids.json"), "r") as f:
+            ids = json.load(f)
+        super().__init__(ids)
+        self._offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+
+        records_path = os.path.join(directory, "documents.bin")
+        self._records = (
+            np.memmap(records_path, dtype=np.uint8, mode="r")
+            if os.path.getsize(records_path)
+            else np.zeros(0, dtype=np.uint8)
+        )
+
+    @staticmethod
+    def write(directory: str, documents: dict[str, Document]):
+        """Writes documents in the layout read by FileDocstore."""
+        offsets = [0]
+        with open(os.path.join(directory, "documents.bin"), "wb") as f:
+            for doc_id, doc in documents.items():
+                record = json.dumps(
+                    {
+                        "id": doc_id,
+                        "page_content": doc.page_content,
+                        "metadata": doc.metadata,
+                    },
+                    ensure_ascii=False,
+                ).encode("utf-8")
+                f.write(record)
+                offsets.append(offsets[-1] + len(record))
+        np.save(os.path.join(directory, "offsets.npy"), np.asarray(offsets, np.int64))
+        with open(os.path.join(directory, "ids.json"), "w") as f:
+            json.dump(list(documents), f)
+
+    def _read(self, row: int, doc_id: str) -> Document:
+        record = json.loads(
+            bytes(self._records[self._offsets[row] : self._offsets[row + 1]])
+        )
+        return Document(
+            id=record["id"],
+            page_content=record["page_content"],
+            metadata=record["metadata"],
+        )
+
+
+class LocalSnapshotCache:
+    """Local on-disk copy of a vector store shard for fast cold starts.
+
+    A snapshot is the index, documents and id mapping of the store after a base and a
+    list of segments were applied. It is reused if the base blobs still have the same
+    GCS generation numbers and the manifest only appended segments since, in which case
+    only the newer segments are downloaded.
+
+    The index is opened memory mapped and the documents through a FileDocstore, so
+    replicas on one node share the pages. Mapped indexes are read-only: call writable()
+    before modifying the index. Snapshots are written to a new directory and published
+    by atomically replacing current.json. Each process holds a shared lock on the
+    snapshot it has open, so old snapshots are only removed once nobody uses them.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._snapshots_dir = os.path.join(directory, "snapshots")
+        os.makedirs(self._snapshots_dir, exist_ok=True)
+
+        self._lock_file = None
+        self._mmap_index = None
+        self._mmap_path = None
+
+    def load(self, base, generations: dict[str, int], segments: list[str]):
+        """Opens the current snapshot if it is valid for the given manifest state.
+
+        Args:
+            base: Base snapshot listed in the manifest.
+            generations: GCS generation number of each blob of the base.
+            segments: Segments listed in the manifest.
+
+        Returns:
+            tuple | None: The index, docstore, index to docstore id mapping, number of
+            leading segments already applied and serialized keyword index (None if the
+            snapshot has none), or None if there is no usable snapshot.
+        """
+        meta = self._read_current()
+        if meta is None:
+            return None
+        if (
+            meta.get("format") != SNAPSHOT_FORMAT
+            or meta["base"] != base
+            or meta["generations"] != generations
+            or segments[: len(meta["segments"])] != meta["segments"]
+        ):
+            logger.info(f"Local snapshot in {self.directory} is stale")
+            return None
+
+        snapshot_dir = os.path.join(self._snapshots_dir, meta["id"])
+        self._hold(snapshot_dir)
+
+        index_path = os.path.join(snapshot_dir, "index.faiss")
+        index = faiss.read_index(index_path, _mmap_flags(meta["index_type"]))
+        self._mmap_index, self._mmap_path = index, index_path
+
+        # Documents are stored in index order, see save()
+        docstore = FileDocstore(snapshot_dir)
+        index_to_docstore_id = dict(enumerate(docstore.ids[: index.ntotal]))
+
+        keywords = None
+        keywords_path = os.path.join(snapshot_dir, "keywords.json")
+        if os.path.exists(keywords_path):
+            with open(keywords_path, "rb") as f:
+                keywords = f.read()
+
+        logger.info(
+            f"Opened local snapshot {meta['id']} with {index.ntotal} vectors and "
+            f"{len(meta['segments'])} segments"
+        )
+        return (
+            index,
+            docstore,
+            index_to_docstore_id,
+            len(meta["segments"]),
+            keywords,
+        )
+
+    def save(
+        self,
+        vectorstore,
+        base,
+        generations: dict[str, int],
+        segments: list[str],
+        keywords: bytes | None = None,
+    ):
+        """Writes the state of a vector store as the current snapshot and reopens it.
+
+        Args:
+            vectorstore: The FAISS vector store, with `segments` applied on `base`.
+            base: Base snapshot listed in the manifest.
+            generations: GCS generation number of each blob of the base.
+            segments: Segments applied to the store.
+            keywords (optional): The serialized keyword index of the store.
+
+        Returns:
+            tuple: The memory mapped index and the FileDocstore to use in place of the
+            in-memory ones.
+        """
+        snapshot_id = uuid.uuid4().hex
+        snapshot_dir = os.path.join(self._snapshots_dir, snapshot_id)
+        tmp_dir = snapshot_dir + ".tmp"
+        os.makedirs(tmp_dir)
+
+        # Documents are written in index order, so the index to docstore id mapping
+        # does not need to be stored. This relies on positions being contiguous.
+        mapping = vectorstore.index_to_docstore_id
+        if sorted(mapping) != list(range(vectorstore.index.ntotal)):
+            raise ValueError("Index positions are not contiguous")
+        documents = vectorstore.docstore._dict
+        ordered_ids = [mapping[position] for position in range(len(mapping))]
+        FileDocstore.write(tmp_dir, {doc_id: documents[doc_id] for doc_id in ordered_ids})
+        faiss.write_index(vectorstore.index, os.path.join(tmp_dir, "index.faiss"))
+        if keywords is not None:
+            with open(os.path.join(tmp_dir, "keywords.json"), "wb") as f:
+                f.write(keywords)
+        os.rename(tmp_dir, snapshot_dir)
+
+        meta = {
+            "format": SNAPSHOT_FORMAT,
+            "id": snapshot_id,
+            "base": base,
+            "generations": generations,
+            "segments": segments,
+            "index_type": index_type_of(vectorstore.index),
+        }
+        current_path = os.path.join(self.directory, "current.json")
+        with open(current_path + f".{snapshot_id}", "w") as f:
+            json.dump(meta, f)
+        os.replace(current_path + f".{snapshot_id}", current_path)
+
+        self._hold(snapshot_dir)
+        self._remove_unused(keep=snapshot_id)
+
+        index_path = os.path.join(snapshot_dir, "index.faiss")
+        index = faiss.read_index(index_path, _mmap_flags(meta["index_type"]))
+        self._mmap_index, self._mmap_path = index, index_path
+
+        logger.info(f"Saved local snapshot {snapshot_id} with {index.ntotal} vectors")
+        return index, FileDocstore(snapshot_dir)
+
+    def writable(self, index):
+        """Returns an in-memory copy of the index if it is memory mapped.
+
+        Faiss aborts the process when a mapped index is modified, so this must be
+        called before adding to or removing from an index loaded by this cache.
+        """
+        if index is not self._mmap_index:
+            return index
+        logger.info(f"Loading memory mapped index {self._mmap_path} into memory")
+        index = faiss.read_index(self._mmap_path)
+        self._mmap_index = None
+        return index
+
+    def _read_current(self):
+        try:
+            with open(os.path.join(self.directory, "current.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _hold(self, snapshot_dir):
+        lock_file = open(os.path.join(snapshot_dir, ".lock"), "a")
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        if self._lock_file is not None:
+            self._lock_file.close()
+        self._lock_file = lock_file
+
+    def _remove_unused(self, keep):
+        for name in os.listdir(self._snapshots_dir):
+            if name == keep or name.endswith(".tmp"):
+                continue
+            snapshot_dir = os.path.join(self._snapshots_dir, name)
+            try:
+                with open(os.path.join(snapshot_dir, ".lock"), "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    shutil.rmtree(snapshot_dir)
+            except OSError:
+                # Still open in another process
+                continue
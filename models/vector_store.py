@@ -1,17 +1,40 @@
 import os
 import io
+import copy
+import itertools
+import json
 import pickle
+import threading
+import time
+import uuid
 import faiss
 import numpy as np
 from google.cloud import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from langchain_community.vectorstores import FAISS
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
 from response import response_handler
 from PyPDF2 import PdfReader
 from services.logger import Logger
+from services.metrics import stage
 from langchain_community.docstore.in_memory import InMemoryDocstore
-from fastapi import UploadFile
+from models.columnar_docstore import ColumnarDocstore
+from models.embedding_cache import CachedEmbeddings
+from models.ingestion import IngestionPipeline
+from models.keyword_index import KeywordIndex
+from models.snapshot_cache import LocalSnapshotCache
+from models.index_factory import (
+    IndexConfig,
+    apply_search_params,
+    build_index,
+    index_type_of,
+    rebuild_index,
+    recall_report,
+    reconstruct_all,
+    sample_queries,
+    supports_remove,
+)
 from dotenv import load_dotenv
 
 logger = Logger()
@@ -27,6 +50,9 @@ else:
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = path
 
+_corpus_versions = itertools.count(1)
+_embeddings_lock = threading.Lock()
+
 
 class VectorStore:
     # Class constants
@@ -39,59 +65,200 @@ class VectorStore:
     _env = os.getenv("ENV", "PROD")
     logger.debug(f"environment: {_env}")
 
-    if _env == "DEV":
-        from langchain_ollama import OllamaEmbeddings
+    # Embedding backend. Defaults to Ollama in DEV and OpenAI otherwise; "local" runs
+    # the model in-process on CPU, see models/local_embeddings.py
+    _backend = os.getenv("EMBEDDING_BACKEND", "ollama" if _env == "DEV" else "openai")
+    logger.debug(f"embedding backend: {_backend}")
+
+    # Created by initialize_embeddings() on first use rather than when this module is
+    # imported, which would construct API clients or load a local model on import
+    embeddings = None
+    _embedding_dim = None
+    _model = None
+
+    @classmethod
+    def initialize_embeddings(cls):
+        """Creates the embeddings of the configured backend, once per process.
+
+        Returns:
+            CachedEmbeddings: The embeddings shared by all shards and the chat service,
+            or None if the environment or backend is invalid.
+        """
+        with _embeddings_lock:
+            if cls.embeddings is not None:
+                return cls.embeddings
+
+            if cls._backend == "local":
+                from models.local_embeddings import LocalEmbeddings
+
+                local_embeddings = LocalEmbeddings()
+                cls._model = local_embeddings.model_name
+                cls._embedding_dim = local_embeddings.dimension
+                # Quantized models produce slightly different vectors, so they are
+                # cached apart
+                cls.embeddings = CachedEmbeddings(
+                    local_embeddings,
+                    namespace=f"local:{cls._model}:{local_embeddings.quantization}",
+                )
+            elif cls._backend == "ollama" and cls._env in ("DEV", "DEV_2", "PROD"):
+                from langchain_ollama import OllamaEmbeddings
+
+                cls._embedding_dim = 1024  # bge-m3 uses 1024 dim for embeddings
+                cls._model = "bge-m3:567m"  # retrieve model with ollama pull bge-m3:567m
+                cls.embeddings = CachedEmbeddings(
+                    OllamaEmbeddings(
+                        model=cls._model, base_url="http://host.docker.internal:11434"
+                    ),
+                    namespace=cls._model,
+                )
+            elif cls._backend == "openai" and cls._env in ("DEV", "DEV_2", "PROD"):
+                from langchain_openai import OpenAIEmbeddings
+
+                cls._embedding_dim = 1536  # OpenAI uses 1536 dim for emmbeddings
+                # Embedding model to use. See https://platform.openai.com/docs/models for list of embedding models available
+                cls._model = "text-embedding-3-small"
+                cls.embeddings = CachedEmbeddings(
+                    OpenAIEmbeddings(model=cls._model), namespace=cls._model
+                )
+            else:
+                # Invalid environment
+                logger.warning(
+                    "A donkey has set an invalid environment or embedding backend. Valid environment names: DEV,PROD. Valid backends: openai,ollama,local."
+                )
+            return cls.embeddings
+
+    # Number of delta segments after which they are merged into a new base snapshot
+    COMPACT_AFTER_SEGMENTS = int(os.getenv("VECTORSTORE_COMPACT_AFTER_SEGMENTS", "8"))
+
+    # Seconds that a base and the segments it replaced are kept after compaction, so
+    # that replicas still loading the previous manifest can finish downloading them
+    BASE_RETENTION_SECONDS = float(
+        os.getenv("VECTORSTORE_BASE_RETENTION_SECONDS", "3600")
+    )
+
+    # Attempts at a manifest update before giving up when other replicas keep winning
+    MANIFEST_WRITE_ATTEMPTS = int(os.getenv("VECTORSTORE_MANIFEST_WRITE_ATTEMPTS", "5"))
 
-        _embedding_dim = 1024  # bge-m3 uses 1024 dim for embeddings
-        _model = "bge-m3:567m"  # retrieve model with ollama pull bge-m3:567m
-        embeddings = OllamaEmbeddings(
-            model=_model, base_url="http://host.docker.internal:11434"
+    # Whether bases and segments written before the columnar docstore (as pickles) may
+    # be loaded. They are migrated on first load; disable once every shard is migrated,
+    # as unpickling blobs from a shared bucket can run arbitrary code.
+    LOAD_PICKLES = os.getenv("VECTORSTORE_LOAD_PICKLES", "true").lower() == "true"
+
+    def __init__(self, course_id=None):
+        self.initialize_embeddings()
+
+        # GCS prefix under which the manifest, base snapshots and segments are stored.
+        # Each course has its own shard; the default shard keeps the original prefix.
+        self.course_id = course_id
+        self.prefix = (
+            "vectorstore" if course_id is None else f"vectorstore/courses/{course_id}"
         )
-    elif _env == "PROD" or _env == "DEV_2":
-        from langchain_openai import OpenAIEmbeddings
-
-        _embedding_dim = 1536  # OpenAI uses 1536 dim for emmbeddings
-        # Embedding model to use. See https://platform.openai.com/docs/models for list of embedding models available
-        _model = "text-embedding-3-small"
-        embeddings = OpenAIEmbeddings(model=_model)
-    else:
-        # Invalid environment
-        logger.warning(
-            "A donkey has set an invalid environment. Valid environment names: DEV,PROD."
+
+        # Changes whenever the indexed corpus changes, so that caches built on top of
+        # the store can tell when their entries are stale. Drawn from a process-wide
+        # counter so that a reloaded shard never reuses an earlier version.
+        self.corpus_version = next(_corpus_versions)
+
+        # Serializes writers (ingestion and compaction) against each other
+        self._write_lock = threading.Lock()
+        # Ingestions that have started, including the ones still parsing and embedding
+        # before they take the write lock
+        self._ingests = 0
+        self._ingests_lock = threading.Lock()
+        self._compaction_thread = None
+
+        # Index type (flat, HNSW, IVF) and its parameters, see models/index_factory.py
+        self.index_config = IndexConfig()
+
+        # Local memory mapped copy of the store for fast restarts, see models/snapshot_cache.py
+        cache_dir = os.getenv("VECTORSTORE_CACHE_DIR")
+        self.snapshot_cache = (
+            LocalSnapshotCache(os.path.join(cache_dir, self.BUCKET_NAME, self.prefix))
+            if cache_dir
+            else None
         )
 
-    def __init__(self):
+        # BM25 index over the chunk texts, kept in step with the FAISS docstore
+        self.keyword_index = KeywordIndex()
+        self._positions = (None, {})
+
+        # Base and segments contained in this store, and the GCS generation of the
+        # manifest they were read from. Other replicas write to the same manifest, so a
+        # different generation in GCS means the store is out of date. None until the
+        # store was loaded successfully.
+        self.loaded_base = None
+        self.loaded_segments = []
+        self.manifest_generation = None
+
+        # Set when a pickled base or segment was loaded, see LOAD_PICKLES
+        self._loaded_pickles = False
+
         # Retrieve vectorstore from gcs
         response = self._load_vectorstore_from_gcs()
         logger.debug(response)
-        if response["code"] != 200:
+        if response["code"] == 404:
             logger.warning(
                 "error loading vectorstore from gcs - initializing vectorstore"
             )
-
-            # Step 2: Create an empty FAISS index
-            index = faiss.IndexFlatL2(self._embedding_dim)
-
-            # Step 3: Prepare the empty docstore and mapping
-            docstore = InMemoryDocstore({})
-            index_to_docstore_id = {}
-
-            # Step 4: Create the LangChain FAISS vectorstore
-            self.vector_store = FAISS(
-                embedding_function=self.embeddings,
-                index=index,
-                docstore=docstore,
-                index_to_docstore_id=index_to_docstore_id,
+            self.vector_store = self._create_empty_vectorstore()
+            self.keyword_index = KeywordIndex()
+        elif response["code"] != 200:
+            # Serving an empty store would look like a course without materials, and
+            # would never be replaced by a reload
+            raise RuntimeError(
+                f"Failed to load vector store {self.prefix}: {response['data']}"
             )
         else:
             self.vector_store = response["data"]
 
+            # An index built with a different embedding model cannot be searched with
+            # this one. Fail loudly instead of returning unrelated chunks.
+            if self.vector_store.index.d != self._embedding_dim:
+                raise ValueError(
+                    f"Vector store {self.prefix} has {self.vector_store.index.d} dim "
+                    f"embeddings but the {self._backend} model {self._model} produces "
+                    f"{self._embedding_dim}. Re-ingest the materials or switch back to "
+                    f"the model the index was built with."
+                )
+
+            # Rebuild the index if the configured index type (or, for "auto", the
+            # corpus size) calls for a different one, and persist the migrated index.
+            if self._migrate_index(self.vector_store):
+                self._maybe_start_compaction(force=True)
+            elif self._loaded_pickles:
+                # One-off migration: the new base replaces the pickled base and segments
+                logger.info(f"Migrating pickled docstores of {self.prefix}")
+                self._maybe_start_compaction(force=True)
+
         logger.info("Vector store initialized")
         pass
 
+    def _create_empty_vectorstore(self):
+        # Step 2: Create an empty FAISS index
+        index = build_index(
+            self.index_config.resolve(0), self._embedding_dim, config=self.index_config
+        )
+
+        # Step 3: Prepare the empty docstore and mapping
+        docstore = InMemoryDocstore({})
+        index_to_docstore_id = {}
+
+        # Step 4: Create the LangChain FAISS vectorstore
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
+
     # Add document to vectorstore
     def add_documents(
-        self, pdfs: list[UploadFile], chunk_size=3000, chunk_overlap=100
+        self,
+        files: list[tuple[str, bytes]],
+        chunk_size=3000,
+        chunk_overlap=100,
+        on_progress=None,
+        replace=False,
     ) -> dict[str, any]:
         """Add one or more PDF documents to the vector store.
 
@@ -100,10 +267,14 @@ class VectorStore:
         individual documents in the vector store, along with metadata about the
         document title, page number, and chunk index.
 
+        Parsing, chunking and embedding run as a staged pipeline (see IngestionPipeline),
+        after which all vectors are added to the FAISS index in one call.
+
+        Chunk ids are derived from the title, page and content of the chunk, so chunks
+        that are already indexed are skipped and re-uploading a PDF is idempotent.
+
         Args:
-            pdfs (list[tuple[str, BytesIO]]):
-                A list of tuples, where each tuple contains the filename (str) and
-                file content as a BytesIO object representing a PDF file.
+            files (list[tuple[str, bytes]]): (filename, content) of each PDF to add.
             chunk_size (int, optional):
                 The maximum number of characters in each text chunk.
                 If a page's text exceeds this length, it will be split into multiple chunks.
@@ -111,57 +282,95 @@ class VectorStore:
             chunk_overlap (int, optional):
                 The number of overlapping characters between consecutive chunks.
                 This helps preserve context between chunks. Defaults to 100.
+            on_progress (optional): Progress callback, see IngestionPipeline.run. Also
+                called as on_progress("persisted") once the new chunks are saved to GCS.
+            replace (bool, optional):
+                If True, indexed chunks with the same title as an uploaded PDF that are
+                not part of the new version are deleted. Defaults to False.
 
         Returns:
             dict[str, any]: 201 if successful.
         """
-        documents = []
-
+        with self._ingests_lock:
+            self._ingests += 1
         try:
-            for pdf in pdfs:
-                filename = pdf.filename
-                file = pdf.file
+            # Ids of every chunk in the upload, including the ones that are skipped
+            uploaded_ids = set()
 
-                pdf = PdfReader(file)
-                title = filename.replace(".pdf", "")
+            def is_indexed(doc_id):
+                uploaded_ids.add(doc_id)
+                return self._is_indexed(doc_id)
 
-                for page_number, page in enumerate(pdf.pages, start=1):
-                    page_content = page.extract_text()
+            # The pipeline embeds the chunks (rather than FAISS.add_documents) so that
+            # the new vectors can be persisted as a delta segment.
+            pipeline = IngestionPipeline(
+                self.embeddings, chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            with stage("ingest_pipeline"):
+                documents, vectors, stats = pipeline.run(
+                    files, on_progress, is_indexed
+                )
 
-                    if len(page_content) > chunk_size:
-                        # Split page content into chunks if length of page content exceeds the chunk size setting.
-                        text_splitter = RecursiveCharacterTextSplitter(
-                            chunk_size=chunk_size, chunk_overlap=chunk_overlap
-                        )
-                        chunks = text_splitter.split_text(page_content)
+            with self._write_lock:
+                # Another upload may have indexed the same chunks in the meantime
+                new = [
+                    (doc, vector)
+                    for doc, vector in zip(documents, vectors)
+                    if not self._is_indexed(doc.id)
+                ]
+                documents = [doc for doc, _ in new]
+                vectors = [vector for _, vector in new]
+                ids = [doc.id for doc in documents]
 
-                        for i, chunk in enumerate(chunks):
-                            doc = Document(
-                                page_content=chunk,
-                                metadata={
-                                    "title": title,
-                                    "page": page_number,
-                                    "chunk": i + 1,
-                                },
-                                # id=f"{title}{i}",
-                            )
-                            documents.append(doc)
-                    else:
-                        doc = Document(
-                            page_content=page_content,
-                            metadata={"title": title,
-                                      "page": page_number, "chunk": 1},
-                            # id=title,
+                deleted_ids = []
+                if replace:
+                    titles = {IngestionPipeline.title(filename) for filename, _ in files}
+                    deleted_ids = [
+                        doc_id
+                        for doc_id in self._ids_with_titles(titles)
+                        if doc_id not in uploaded_ids
+                    ]
+
+                if not documents and not deleted_ids:
+                    logger.info(f"{len(files)} document(s) already up to date")
+                    if on_progress is not None:
+                        on_progress("persisted")
+                    return response_handler(201, "Vector store already up to date")
+
+                # Update vectorstore
+                with stage("ingest_index"):
+                    if deleted_ids:
+                        self.vector_store = self._delete_chunks(
+                            self.vector_store, deleted_ids
+                        )
+                    if documents:
+                        self._make_writable(self.vector_store)
+                        self.vector_store.add_embeddings(
+                            zip([doc.page_content for doc in documents], vectors),
+                            metadatas=[doc.metadata for doc in documents],
+                            ids=ids,
+                        )
+                        self.keyword_index.add(
+                            (doc.id, doc.page_content) for doc in documents
                         )
-                        documents.append(doc)
+                self.corpus_version = next(_corpus_versions)
 
-            # Add documents into vectorstore
-            self.vector_store.add_documents(documents)
+                # Sync vectorstore with gcs. Only the changes are uploaded.
+                with stage("persist"):
+                    save_res = self._save_segment_to_gcs(
+                        ids, vectors, documents, deleted_ids
+                    )
+                if save_res["code"] != 201:
+                    raise RuntimeError(save_res["data"])
 
-            # Sync vectorstore with gcs
-            self._save_vectorstore_to_gcs_direct(self.vector_store)
+            if on_progress is not None:
+                on_progress("persisted")
+            self._maybe_start_compaction(save_res["data"])
 
-            logger.info(f"{len(pdfs)} document added to vectorstore")
+            logger.info(
+                f"{len(files)} document added to vectorstore: {len(ids)} chunks added, "
+                f"{stats.skipped} unchanged, {len(deleted_ids)} deleted"
+            )
 
             return response_handler(201, "Vector store updated")
         except Exception as e:
@@ -169,42 +378,434 @@ class VectorStore:
             return response_handler(
                 500, "Error adding document to vectorstore" + str(e)
             )
+        finally:
+            with self._ingests_lock:
+                self._ingests -= 1
+
+    def is_busy(self):
+        """Whether an ingestion or compaction is running on the store."""
+        compacting = (
+            self._compaction_thread is not None and self._compaction_thread.is_alive()
+        )
+        return compacting or self._ingests > 0 or self._write_lock.locked()
+
+    def positions(self):
+        """Returns the index position of each chunk id.
+
+        The reverse of index_to_docstore_id, rebuilt lazily when the corpus changes.
+        """
+        version, positions = self._positions
+        if version != self.corpus_version:
+            version = self.corpus_version
+            # list() copies the mapping in one step, so a concurrent write cannot
+            # change it while it is being read
+            items = list(self.vector_store.index_to_docstore_id.items())
+            positions = {doc_id: position for position, doc_id in items}
+            self._positions = (version, positions)
+        return positions
+
+    def _is_indexed(self, doc_id):
+        return isinstance(self.vector_store.docstore.search(doc_id), Document)
+
+    def _delete_chunks(self, vectorstore, ids):
+        """Returns a copy of a FAISS vector store without the given chunks.
+
+        Searches run without the write lock, so the index and mapping of the store are
+        never modified in place: the copy gets a new index and mapping, and the caller
+        swaps it in with one assignment. A search holding the old store keeps a
+        consistent index and mapping; the deleted chunks are only missing from the
+        shared docstore.
+
+        LangChain's FAISS.delete relies on remove_ids compacting the index, which only
+        flat indexes do, so other index types are rebuilt without the deleted vectors.
+        """
+        self._make_writable(vectorstore)
+        self.keyword_index.delete(ids)
+
+        ids = set(ids)
+        mapping = vectorstore.index_to_docstore_id
+        keep = [i for i in sorted(mapping) if mapping[i] not in ids]
+        removed = [i for i in mapping if mapping[i] in ids]
+        if supports_remove(vectorstore.index):
+            index = faiss.clone_index(vectorstore.index)
+            index.remove_ids(np.asarray(removed, dtype=np.int64))
+        else:
+            index = rebuild_index(vectorstore.index, keep=keep, config=self.index_config)
+
+        updated = copy.copy(vectorstore)
+        updated.index = index
+        updated.index_to_docstore_id = {
+            new_position: mapping[old_position]
+            for new_position, old_position in enumerate(keep)
+        }
+        vectorstore.docstore.delete([mapping[i] for i in removed])
+        return updated
+
+    def _make_writable(self, vectorstore):
+        """Loads a memory mapped index into memory so that it can be modified."""
+        if self.snapshot_cache is None:
+            return
+        index = self.snapshot_cache.writable(vectorstore.index)
+        if index is not vectorstore.index:
+            apply_search_params(index, self.index_config)
+            vectorstore.index = index
+
+    def _migrate_index(self, vectorstore):
+        """Rebuilds the index of a vector store as the configured index type.
+
+        Returns:
+            bool: True if the index was rebuilt.
+        """
+        current_type = index_type_of(vectorstore.index)
+        target_type = self.index_config.resolve(vectorstore.index.ntotal)
+        if current_type == target_type:
+            apply_search_params(vectorstore.index, self.index_config)
+            return False
+
+        start = time.perf_counter()
+        vectors = reconstruct_all(vectorstore.index)
+        new_index = build_index(
+            target_type, vectors.shape[1], vectors, config=self.index_config
+        )
+        report = recall_report(
+            new_index, sample_queries(vectors, n_queries=20), baseline_vectors=vectors
+        )
+        vectorstore.index = new_index
+
+        logger.info(
+            f"Migrated index from {current_type} to {target_type} in "
+            f"{time.perf_counter() - start:.1f}s: {report}"
+        )
+        return True
+
+    def _ids_with_titles(self, titles):
+        """Returns the ids of indexed chunks belonging to any of the given titles."""
+        docstore = self.vector_store.docstore
+        return [
+            doc_id
+            for doc_id in self.vector_store.index_to_docstore_id.values()
+            if docstore.search(doc_id).metadata.get("title") in titles
+        ]
+
+    def _blob_name(self, *parts):
+        return "/".join([self.prefix, *parts])
+
+    def _base_blob_names(self, base):
+        """Returns the index and docstore blob names of a base snapshot.
+
+        The "legacy" base refers to the snapshot written before segments were introduced.
+        """
+        base_prefix = [] if base == "legacy" else [base]
+        return (
+            self._blob_name(*base_prefix, "index.faiss"),
+            self._blob_name(*base_prefix, "docstore.zst"),
+        )
+
+    def _pickle_blob_names(self, base):
+        """Returns the metadata and mapping blob names of a pickled base snapshot."""
+        base_prefix = [] if base == "legacy" else [base]
+        return (
+            self._blob_name(*base_prefix, "metadata.pkl"),
+            self._blob_name(*base_prefix, "mapping.pkl"),
+        )
+
+    def _keywords_blob_name(self, base):
+        base_prefix = [] if base == "legacy" else [base]
+        return self._blob_name(*base_prefix, "keywords.json")
+
+    def _read_manifest(self, bucket):
+        """Returns the manifest listing the live base and segments (None if there is
+        none) and its GCS generation (0 if there is none)."""
+        blob = bucket.get_blob(self._blob_name("manifest.json"))
+        if blob is None:
+            return None, 0
+        return json.loads(blob.download_as_bytes()), blob.generation
+
+    def remote_manifest_generation(self):
+        """Returns the GCS generation of the manifest, 0 if there is none."""
+        client = storage.Client()
+        blob = client.bucket(self.BUCKET_NAME).get_blob(self._blob_name("manifest.json"))
+        return 0 if blob is None else blob.generation
+
+    def is_stale(self):
+        """Whether another replica changed the manifest since this store was loaded."""
+        return self.remote_manifest_generation() != self.manifest_generation
+
+    def _write_manifest(self, bucket, manifest, generation):
+        """Writes the manifest if it is still at the given generation (0: if it does not
+        exist yet) and returns its new generation.
+
+        Raises:
+            PreconditionFailed: Another replica wrote the manifest in the meantime.
+        """
+        blob = bucket.blob(self._blob_name("manifest.json"))
+        blob.upload_from_string(
+            json.dumps(manifest),
+            content_type="application/json",
+            if_generation_match=generation,
+        )
+        return blob.generation
 
-    def _save_vectorstore_to_gcs_direct(self, vectorstore):
+    def _update_manifest(self, bucket, update):
+        """Applies a change to the manifest without losing concurrent changes.
+
+        The manifest is read, changed with update(manifest) and written back only if it
+        was not modified in the meantime. On a conflict, the latest manifest is read and
+        the change applied again.
+
+        Args:
+            update: Function that modifies the manifest in place, or returns False to
+                abandon the update.
+
+        Returns:
+            dict | None: The written manifest, or None if the update was abandoned.
         """
-        Saves a FAISS vector store to Google Cloud Storage.
+        for _ in range(self.MANIFEST_WRITE_ATTEMPTS):
+            manifest, generation = self._read_manifest(bucket)
+            if manifest is None:
+                manifest = self._initial_manifest(bucket)
+            if update(manifest) is False:
+                return None
+            try:
+                new_generation = self._write_manifest(bucket, manifest, generation)
+            except PreconditionFailed:
+                logger.info(f"Manifest of {self.prefix} changed concurrently, retrying")
+                continue
+            # If the manifest only changed by this update, the store is still current.
+            # Otherwise the generation is left as is, so that the store gets reloaded
+            # with the changes of the other replicas.
+            if generation == self.manifest_generation:
+                self.manifest_generation = new_generation
+            return manifest
+        raise RuntimeError(
+            f"Failed to update the manifest of {self.prefix} after "
+            f"{self.MANIFEST_WRITE_ATTEMPTS} attempts"
+        )
+
+    def _initial_manifest(self, bucket):
+        # Stores written before segments were introduced become the base of the manifest
+        legacy_index_blob_name, _ = self._base_blob_names("legacy")
+        base = "legacy" if bucket.blob(legacy_index_blob_name).exists() else None
+        return {"format": 1, "base": base, "segments": []}
+
+    def _save_segment_to_gcs(self, ids, vectors, documents, deleted_ids=()):
+        """
+        Saves changed chunks to Google Cloud Storage as an append-only segment.
+
+        Only the new vectors and documents and the ids of deleted chunks are uploaded,
+        after which the segment is appended to the manifest. Must be called with the
+        write lock held.
 
         Args:
-            vectorstore: The FAISS vector store object.
-            course_id: The course ID.
+            ids: Docstore ids of the new chunks.
+            vectors: Embeddings of the new chunks.
+            documents: The new chunks.
+            deleted_ids: Docstore ids of deleted chunks.
+
+        Returns:
+            dict[str, any]: 201 with the number of live segments if successful.
         """
         try:
-            index_blob_name = "vectorstore/index.faiss"
-            metadata_blob_name = "vectorstore/metadata.pkl"
-            mapping_blob_name = "vectorstore/mapping.pkl"
-
-            faiss_index_buffer = faiss.serialize_index(vectorstore.index)
+            segment = f"segments/{time.time_ns()}-{uuid.uuid4().hex[:8]}"
 
-            metadata_buffer = io.BytesIO()
-            pickle.dump(vectorstore.docstore._dict, metadata_buffer)
-            metadata_buffer.seek(0)
+            vectors_buffer = io.BytesIO()
+            np.save(
+                vectors_buffer,
+                np.asarray(vectors, dtype=np.float32).reshape(
+                    len(ids), self.vector_store.index.d
+                ),
+            )
+            vectors_buffer.seek(0)
 
-            mapping_buffer = io.BytesIO()
-            pickle.dump(vectorstore.index_to_docstore_id, mapping_buffer)
-            mapping_buffer.seek(0)
+            documents_buffer = io.BytesIO(
+                ColumnarDocstore.from_documents(zip(ids, documents)).to_bytes()
+            )
 
             client = storage.Client()
             bucket = client.bucket(self.BUCKET_NAME)
 
-            bucket.blob(index_blob_name).upload_from_file(
-                io.BytesIO(faiss_index_buffer), content_type="application/octet-stream"
+            bucket.blob(self._blob_name(segment, "vectors.npy")).upload_from_file(
+                vectors_buffer, content_type="application/octet-stream"
+            )
+            bucket.blob(self._blob_name(segment, "documents.zst")).upload_from_file(
+                documents_buffer, content_type="application/octet-stream"
             )
-            bucket.blob(metadata_blob_name).upload_from_file(
-                metadata_buffer, content_type="application/octet-stream"
+            bucket.blob(self._blob_name(segment, "deleted.json")).upload_from_string(
+                json.dumps(list(deleted_ids)), content_type="application/json"
             )
-            bucket.blob(mapping_blob_name).upload_from_file(
-                mapping_buffer, content_type="application/octet-stream"
+
+            manifest = self._update_manifest(
+                bucket, lambda manifest: manifest["segments"].append(segment)
+            )
+            self.loaded_segments.append(segment)
+
+            logger.info(
+                f"Saved segment {segment} with {len(ids)} new and {len(deleted_ids)} deleted chunks"
             )
+            return response_handler(201, "Segment saved", len(manifest["segments"]))
+        except Exception as e:
+            return response_handler(500, "Failed to Save Segment", str(e))
+
+    def _maybe_start_compaction(self, segment_count=0, force=False):
+        if segment_count < self.COMPACT_AFTER_SEGMENTS and not force:
+            return
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+
+        self._compaction_thread = threading.Thread(
+            target=self._compact,
+            kwargs={"force": force},
+            name="vectorstore-compaction",
+            daemon=True,
+        )
+        self._compaction_thread.start()
+
+    def _compact(self, force=False):
+        """Merges the base and all segments into a new base snapshot.
+
+        The snapshot is serialized under the write lock, but uploaded without it so that
+        ingestion can continue. Segments written in the meantime stay in the manifest.
+        If the corpus has grown past the size for the current index type, the index is
+        migrated first.
+
+        The replaced base and segments are listed as retired in the manifest and deleted
+        by a later compaction, once VECTORSTORE_BASE_RETENTION_SECONDS have passed.
+
+        Args:
+            force (bool): Write a new base even if there are no segments, e.g. to
+                persist a migrated index.
+        """
+        try:
+            client = storage.Client()
+            bucket = client.bucket(self.BUCKET_NAME)
+
+            with self._write_lock:
+                manifest, _ = self._read_manifest(bucket)
+                # Stores written before the manifest are compacted into its first base
+                manifest = manifest or self._initial_manifest(bucket)
+                if not manifest["segments"] and (not force or manifest["base"] is None):
+                    return
+                # Only compact what this store contains. If another replica changed
+                # the manifest, the store is reloaded first (see VectorStoreRouter).
+                if manifest["base"] != self.loaded_base or not set(
+                    manifest["segments"]
+                ) <= set(self.loaded_segments):
+                    logger.info(
+                        f"Skipping compaction of {self.prefix}, the store is behind the manifest"
+                    )
+                    return
+                compacted_base = manifest["base"]
+                compacted_segments = list(manifest["segments"])
+                self._migrate_index(self.vector_store)
+                # Memory mapped IVF indexes cannot be serialized
+                self._make_writable(self.vector_store)
+                buffers = self._serialize_vectorstore(self.vector_store)
+                keywords = self.keyword_index.to_json()
+
+            base = f"bases/{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+            save_res = self._save_vectorstore_to_gcs_direct(buffers, base, keywords)
+            if save_res["code"] != 201:
+                logger.error(f"Compaction failed: {save_res['data']}")
+                return
+
+            # The legacy snapshot is kept so that replicas still running an older
+            # version can start
+            retired = {
+                "base": None if compacted_base == "legacy" else compacted_base,
+                "segments": compacted_segments,
+                "retired_at": time.time(),
+            }
+            expired = []
+
+            def swap_base(manifest):
+                # Another replica compacted first: its base replaces the same segments
+                if manifest["base"] != compacted_base:
+                    return False
+                manifest["base"] = base
+                manifest["segments"] = [
+                    segment
+                    for segment in manifest["segments"]
+                    if segment not in compacted_segments
+                ]
+                # Replicas may still be downloading the replaced base and segments, so
+                # they are only deleted by a compaction after the retention period
+                now = time.time()
+                expired.clear()
+                kept = []
+                for entry in [*manifest.get("retired", []), retired]:
+                    if now - entry["retired_at"] >= self.BASE_RETENTION_SECONDS:
+                        expired.append(entry)
+                    else:
+                        kept.append(entry)
+                manifest["retired"] = kept
+
+            with self._write_lock:
+                manifest = self._update_manifest(bucket, swap_base)
+                if manifest is not None:
+                    self.loaded_base = base
+                    self.loaded_segments = [
+                        segment
+                        for segment in self.loaded_segments
+                        if segment not in compacted_segments
+                    ]
+
+            if manifest is None:
+                logger.info(f"Base of {self.prefix} changed concurrently, discarding {base}")
+                stale_prefixes = [self._blob_name(base) + "/"]
+            else:
+                # Clean up the blobs whose retention has passed
+                stale_prefixes = [
+                    self._blob_name(name) + "/"
+                    for entry in expired
+                    for name in [entry["base"], *entry["segments"]]
+                    if name is not None
+                ]
+            for stale_prefix in stale_prefixes:
+                for blob in client.list_blobs(self.BUCKET_NAME, prefix=stale_prefix):
+                    blob.delete()
+
+            if manifest is not None:
+                logger.info(f"Compacted {len(compacted_segments)} segments into {base}")
+        except Exception as e:
+            logger.error(f"Compaction failed: {str(e)}")
+
+    def _serialize_vectorstore(self, vectorstore):
+        """Serializes a FAISS vector store into index and docstore buffers.
+
+        The docstore buffer holds the documents and their index positions, see
+        ColumnarDocstore.
+        """
+        faiss_index_buffer = faiss.serialize_index(vectorstore.index)
+        docstore_buffer = ColumnarDocstore.serialize(
+            vectorstore.docstore, vectorstore.index_to_docstore_id
+        )
+        return io.BytesIO(faiss_index_buffer), io.BytesIO(docstore_buffer)
+
+    def _save_vectorstore_to_gcs_direct(self, buffers, base, keywords=None):
+        """
+        Saves a serialized FAISS vector store to Google Cloud Storage as a base snapshot.
+
+        Args:
+            buffers: The index and docstore buffers from _serialize_vectorstore.
+            base: Name of the base snapshot.
+            keywords (optional): The serialized keyword index.
+        """
+        try:
+            client = storage.Client()
+            bucket = client.bucket(self.BUCKET_NAME)
+
+            # Base snapshots are never overwritten (generation 0: create only), so a
+            # replica can not replace blobs that another one is reading or listing
+            for blob_name, buffer in zip(self._base_blob_names(base), buffers):
+                bucket.blob(blob_name).upload_from_file(
+                    buffer,
+                    content_type="application/octet-stream",
+                    if_generation_match=0,
+                )
+            if keywords is not None:
+                bucket.blob(self._keywords_blob_name(base)).upload_from_string(
+                    keywords, content_type="application/json", if_generation_match=0
+                )
 
             return response_handler(201, "Vectorstore updated ")
         except Exception as e:
@@ -264,42 +865,238 @@ class VectorStore:
             return response_handler(500, "Failed to Generate Vectorstore", str(e))
 
     def _load_vectorstore_from_gcs(self):
+        """Loads the base snapshot listed in the manifest and applies its segments on top.
+
+        If a local snapshot of the same base exists, it is opened instead and only the
+        segments written since are downloaded.
+        """
         try:
-            index_blob_name = "vectorstore/index.faiss"
-            metadata_blob_name = "vectorstore/metadata.pkl"
-            mapping_blob_name = "vectorstore/mapping.pkl"  # New blob for mapping
+            start = time.perf_counter()
 
             # Initialize GCS client
             client = storage.Client()
             bucket = client.bucket(self.BUCKET_NAME)
 
-            # Download FAISS index
-            faiss_index_buffer = bucket.blob(
-                index_blob_name).download_as_bytes()
-            faiss_index = faiss.deserialize_index(
-                np.frombuffer(faiss_index_buffer, dtype=np.uint8)
-            )
+            manifest, manifest_generation = self._read_manifest(bucket)
+            manifest = manifest or self._initial_manifest(bucket)
+            if manifest["base"] is None and not manifest["segments"]:
+                self.manifest_generation = manifest_generation
+                return response_handler(404, "No Vectorstore Found")
 
-            # Download metadata
-            metadata_buffer = bucket.blob(
-                metadata_blob_name).download_as_bytes()
-            metadata = pickle.loads(metadata_buffer)
+            generations = self._base_generations(bucket, manifest["base"])
+            cached = self._load_local_snapshot(manifest, generations)
+            if cached is not None:
+                vectorstore, applied = cached
+            elif manifest["base"] is None:
+                vectorstore, applied = self._create_empty_vectorstore(), 0
+                self.keyword_index = KeywordIndex()
+            else:
+                vectorstore, applied = self._load_base(bucket, manifest["base"]), 0
 
-            # Download index_to_docstore_id
-            mapping_buffer = bucket.blob(mapping_blob_name).download_as_bytes()
-            index_to_docstore_id = pickle.loads(mapping_buffer)
+            for segment in manifest["segments"][applied:]:
+                vectorstore = self._apply_segment(bucket, vectorstore, segment)
 
-            # Reconstruct the docstore
-            docstore = InMemoryDocstore(metadata)
+            if cached is None or applied < len(manifest["segments"]):
+                self._save_local_snapshot(vectorstore, manifest, generations)
 
-            # Reconstruct the FAISS vectorstore
-            vectorstore = FAISS(
-                embedding_function=self.embeddings,
-                index=faiss_index,
-                docstore=docstore,
-                index_to_docstore_id=index_to_docstore_id,
+            self.loaded_base = manifest["base"]
+            self.loaded_segments = list(manifest["segments"])
+            self.manifest_generation = manifest_generation
+
+            logger.info(
+                f"Loaded base {manifest['base']} with {len(manifest['segments'])} segments "
+                f"({len(manifest['segments']) - applied} downloaded) in "
+                f"{time.perf_counter() - start:.2f}s"
             )
             return response_handler(200, "Vectorstore Loaded Successfully", vectorstore)
         except Exception as e:
             logger.error(f"failed to load vector store, {str(e)}")
             return response_handler(500, "Failed to Load Vectorstore", str(e))
+
+    def _base_generations(self, bucket, base):
+        """Returns the GCS generation number of each blob of a base snapshot."""
+        if self.snapshot_cache is None or base is None:
+            return {}
+        generations = {}
+        # Pickled bases have metadata and mapping blobs instead of a docstore blob
+        for blob_name in self._base_blob_names(base) + self._pickle_blob_names(base):
+            blob = bucket.get_blob(blob_name)
+            if blob is not None:
+                generations[blob_name] = blob.generation
+        return generations
+
+    def _load_local_snapshot(self, manifest, generations):
+        if self.snapshot_cache is None:
+            return None
+        try:
+            cached = self.snapshot_cache.load(
+                manifest["base"], generations, manifest["segments"]
+            )
+        except Exception as e:
+            logger.warning(f"Failed to open local snapshot: {str(e)}")
+            return None
+        if cached is None:
+            return None
+
+        index, docstore, index_to_docstore_id, applied, keywords = cached
+        vectorstore = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
+        self.keyword_index = self._keyword_index_for(vectorstore, keywords)
+        return vectorstore, applied
+
+    def _save_local_snapshot(self, vectorstore, manifest, generations):
+        if self.snapshot_cache is None:
+            return
+        try:
+            index, docstore = self.snapshot_cache.save(
+                vectorstore,
+                manifest["base"],
+                generations,
+                manifest["segments"],
+                self.keyword_index.to_json(),
+            )
+        except Exception as e:
+            logger.warning(f"Failed to save local snapshot: {str(e)}")
+            return
+        # Switch to the memory mapped copy so that the in-memory one can be freed
+        vectorstore.index = index
+        vectorstore.docstore = docstore
+
+    def _load_base(self, bucket, base):
+        index_blob_name, docstore_blob_name = self._base_blob_names(base)
+
+        # Download FAISS index
+        faiss_index_buffer = bucket.blob(index_blob_name).download_as_bytes()
+        faiss_index = faiss.deserialize_index(
+            np.frombuffer(faiss_index_buffer, dtype=np.uint8)
+        )
+
+        # Download the documents and their index positions
+        try:
+            docstore, positions = ColumnarDocstore.from_bytes(
+                bucket.blob(docstore_blob_name).download_as_bytes()
+            )
+            index_to_docstore_id = dict(zip(positions.tolist(), docstore.ids))
+        except NotFound:
+            docstore, index_to_docstore_id = self._load_pickled_docstore(bucket, base)
+
+        # Reconstruct the FAISS vectorstore
+        vectorstore = FAISS(
+            embedding_function=self.embeddings,
+            index=faiss_index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
+
+        try:
+            keywords = bucket.blob(self._keywords_blob_name(base)).download_as_bytes()
+        except NotFound:
+            keywords = None
+        self.keyword_index = self._keyword_index_for(vectorstore, keywords)
+        return vectorstore
+
+    def _load_pickled_docstore(self, bucket, base):
+        """Loads the docstore and mapping of a base written before ColumnarDocstore."""
+        if not self.LOAD_PICKLES:
+            raise RuntimeError(
+                f"Base {base} of {self.prefix} is pickled and VECTORSTORE_LOAD_PICKLES is off"
+            )
+        metadata_blob_name, mapping_blob_name = self._pickle_blob_names(base)
+        metadata = pickle.loads(bucket.blob(metadata_blob_name).download_as_bytes())
+        index_to_docstore_id = pickle.loads(
+            bucket.blob(mapping_blob_name).download_as_bytes()
+        )
+        self._loaded_pickles = True
+        return InMemoryDocstore(metadata), index_to_docstore_id
+
+    def _keyword_index_for(self, vectorstore, keywords=None):
+        """Loads a serialized keyword index, or builds one from the docstore for
+        snapshots written before keyword indexes were persisted."""
+        if keywords is not None:
+            return KeywordIndex.from_json(keywords)
+        logger.info("Building keyword index from the docstore")
+        keyword_index = KeywordIndex()
+        docstore = vectorstore.docstore
+        keyword_index.add(
+            (doc_id, docstore.search(doc_id).page_content)
+            for doc_id in vectorstore.index_to_docstore_id.values()
+        )
+        return keyword_index
+
+    def _load_segment_documents(self, bucket, segment):
+        """Returns the (doc_id, Document) pairs added by a segment."""
+        try:
+            docstore, _ = ColumnarDocstore.from_bytes(
+                bucket.blob(self._blob_name(segment, "documents.zst")).download_as_bytes()
+            )
+            return [(doc_id, docstore.search(doc_id)) for doc_id in docstore.ids]
+        except NotFound:
+            pass
+        # Segments written before ColumnarDocstore
+        if not self.LOAD_PICKLES:
+            raise RuntimeError(
+                f"Segment {segment} of {self.prefix} is pickled and VECTORSTORE_LOAD_PICKLES is off"
+            )
+        self._loaded_pickles = True
+        return pickle.loads(
+            bucket.blob(self._blob_name(segment, "documents.pkl")).download_as_bytes()
+        )
+
+    def _apply_segment(self, bucket, vectorstore, segment):
+        """Applies a delta segment to a vector store and returns the updated store."""
+        # Deletions refer to chunks of earlier segments, so they are applied first
+        try:
+            deleted_ids = json.loads(
+                bucket.blob(self._blob_name(segment, "deleted.json")).download_as_bytes()
+            )
+        except NotFound:
+            deleted_ids = []
+        if deleted_ids:
+            vectorstore = self._delete_chunks(vectorstore, deleted_ids)
+
+        documents = self._load_segment_documents(bucket, segment)
+        if not documents:
+            return vectorstore
+        vectors = np.load(
+            io.BytesIO(
+                bucket.blob(self._blob_name(segment, "vectors.npy")).download_as_bytes()
+            )
+        )
+
+        # Chunk ids are derived from their content, so replicas uploading the same file
+        # at the same time both append a segment with the same chunks. Only the first
+        # copy is added.
+        seen = set()
+        keep = []
+        for i, (docstore_id, _) in enumerate(documents):
+            if docstore_id not in seen and not isinstance(
+                vectorstore.docstore.search(docstore_id), Document
+            ):
+                keep.append(i)
+            seen.add(docstore_id)
+        if len(keep) < len(documents):
+            logger.info(
+                f"Skipping {len(documents) - len(keep)} chunks of segment {segment} "
+                f"that are already indexed"
+            )
+            documents = [documents[i] for i in keep]
+            vectors = vectors[keep]
+            if not documents:
+                return vectorstore
+
+        # Append to the index and docstore directly to avoid converting the vectors to lists
+        self._make_writable(vectorstore)
+        start = vectorstore.index.ntotal
+        vectorstore.index.add(vectors)
+        vectorstore.docstore.add(dict(documents))
+        vectorstore.index_to_docstore_id.update(
+            {start + i: docstore_id for i, (docstore_id, _) in enumerate(documents)}
+        )
+        self.keyword_index.add(
+            (docstore_id, document.page_content) for docstore_id, document in documents
+        )
+        return vectorstore
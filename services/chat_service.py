@@ -1,88 +1,536 @@
 from langchain_openai import OpenAI
+from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_community.callbacks import get_openai_callback
 from langchain_openai import ChatOpenAI
+import asyncio
+import hashlib
+import math
 import os
+import numpy as np
+import time
+from dataclasses import dataclass, replace
+from services.concurrency import ConcurrencyLimiter
+from services.context_assembler import (
+    Candidate,
+    ContextAssembler,
+    format_context,
+    to_context,
+)
+from services.hedging import Hedger
 from services.logger import Logger
+from services.metrics import (
+    ANSWERS,
+    LLM_CALLS,
+    LLM_TIMEOUTS,
+    RETRIEVAL_BEST_DISTANCE,
+    STREAM_FIRST_TOKEN_SECONDS,
+    record_llm_tokens,
+    stage,
+)
+from services.response_cache import SemanticResponseCache
+from services.search_scheduler import SearchScheduler
+from services.singleflight import SingleFlight
+from services.thread_query import ThreadQuery, ThreadQueryBuilder
+from models.shard_router import VectorStoreRouter
 from models.vector_store import VectorStore
+from models.index_factory import reconstruct_positions
+from models.keyword_index import reciprocal_rank_fusion
 
 logger = Logger()
 
+# Role markers the model sometimes echoes, removed from responses
+RESPONSE_MARKERS = ("System:", "Human:", "Answer:")
+
+
+class StreamingMarkerFilter:
+    """Removes role markers from a response that arrives in chunks.
+
+    A marker can be split across chunks, so text that could be the start of a marker is
+    held back until a later chunk shows whether it is one. Leading and trailing
+    whitespace of the whole response is dropped, like str.strip() on the full text.
+    """
+
+    def __init__(self, markers=RESPONSE_MARKERS):
+        self.markers = markers
+        self._buffer = ""
+        self._started = False
+
+    def feed(self, text: str) -> str:
+        """Adds a chunk and returns the text that is safe to emit."""
+        buffer = self._remove_markers(self._buffer + text)
+
+        held = self._marker_prefix_length(buffer)
+        safe, self._buffer = buffer[: len(buffer) - held], buffer[len(buffer) - held :]
+
+        # Trailing whitespace is only emitted once more text follows it
+        stripped = safe.rstrip()
+        self._buffer = safe[len(stripped) :] + self._buffer
+        return self._emit(stripped)
+
+    def flush(self) -> str:
+        """Returns the held back text at the end of the response."""
+        rest = self._remove_markers(self._buffer).rstrip()
+        self._buffer = ""
+        return self._emit(rest)
+
+    def _emit(self, text):
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+    def _remove_markers(self, text):
+        for marker in self.markers:
+            text = text.replace(marker, "")
+        return text
+
+    def _marker_prefix_length(self, text):
+        # Length of the longest suffix of text that is a proper prefix of a marker
+        for length in range(min(len(text), max(map(len, self.markers)) - 1), 0, -1):
+            suffix = text[-length:]
+            if any(marker.startswith(suffix) for marker in self.markers):
+                return length
+        return 0
+
+
+@dataclass
+class PreparedQuery:
+    """A query with its retrieved context, ready to be sent to the LLM."""
+
+    embedding: list[float] | None  # None if retrieval did not need the embedding
+    prompt_key: str
+    corpus_version: int
+    conversation: list | None = None
+    main_topic: str | None = None
+    # (response, tokens used, main topic) when the query is answered without the LLM
+    answer: tuple | None = None
+
+
+@dataclass
+class LLMTier:
+    """A model of the LLM cascade."""
+
+    model: str
+    llm: ChatOpenAI
+    hedger: Hedger
+
 
 class ChatService:
-    def __init__(self, vector_store: VectorStore):
+    def __init__(self, router: VectorStoreRouter):
         OpenAI.api_key = os.getenv("OPENAI_API_KEY")
         if not OpenAI.api_key:
             raise ValueError(
                 "OpenAI API key is not set. Please set the OPENAI_API_KEY environment variable."
             )
-        self.vector_store = vector_store.vector_store
-        self.llm = self._initialize_llm()
+        self.router = router
+        self.embeddings = VectorStore.initialize_embeddings()
+
+        # Deadline of an LLM call in seconds, including hedged attempts and escalations.
+        # 0 disables it.
+        self.llm_timeout = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+
+        # Models tried in order, cheapest first. An answer of a cheaper model that is
+        # not confident enough is escalated to the next one; the last model always
+        # answers and is the one used for streaming.
+        models = [
+            model.strip()
+            for model in os.getenv("LLM_MODELS", "gpt-4o-mini").split(",")
+            if model.strip()
+        ]
+        self.llm_model = models[-1]
+        self.llm = self._initialize_llm(self.llm_model)
+        self.llm_hedger = self._initialize_hedger()
+        self.llm_cascade = [
+            LLMTier(
+                model,
+                self._initialize_llm(model, logprobs=True),
+                self._initialize_hedger(),
+            )
+            for model in models[:-1]
+        ]
+        # Geometric mean token probability below which a cheaper model's answer is
+        # escalated
+        self.cascade_min_confidence = float(
+            os.getenv("LLM_CASCADE_MIN_CONFIDENCE", "0.8")
+        )
+
+        # Bound the number of concurrent LLM calls so that a burst of threads queues
+        # on the event loop instead of piling up requests against OpenAI.
+        self.llm_limiter = ConcurrencyLimiter(
+            "llm", int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+        )
+
+        # Queries whose best chunk is further than this squared L2 distance are answered
+        # "I don't know." without calling the LLM, unless a post has a decisive keyword
+        # match (see the keyword fast path). 0 disables the gate.
+        self.gate_max_distance = float(os.getenv("RETRIEVAL_GATE_MAX_DISTANCE", "0"))
+        self.gated = 0
+
+        # Concurrent requests for the same thread share one retrieval and LLM call
+        self.singleflight = SingleFlight("response")
+
+        # Per-call bound on concurrent LLM calls of a batch, so that one large batch does
+        # not take every slot of the LLM limiter.
+        self.batch_llm_concurrency = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+
+        # Batches the FAISS searches of concurrent requests into one search
+        self.search_scheduler = SearchScheduler()
+
+        # Embeds the posts of a thread separately and trims the prompt query text
+        self.thread_queries = ThreadQueryBuilder(self.embeddings)
+
+        # Picks which retrieved chunks go into the prompt, within a token budget
+        self.context_assembler = ContextAssembler()
+
+        # Queries whose best keyword match clearly beats the rest skip the embedding
+        # call and dense search. Set the ratio to 0 to always use hybrid retrieval.
+        self.keyword_fast_path_min_score = float(
+            os.getenv("KEYWORD_FAST_PATH_MIN_SCORE", "5")
+        )
+        self.keyword_fast_path_ratio = float(os.getenv("KEYWORD_FAST_PATH_RATIO", "3"))
+        self.keyword_fast_path_hits = 0
+
+        # Near-identical questions are answered from cache instead of calling the LLM.
+        self.response_cache = None
+        if os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true":
+            self.response_cache = SemanticResponseCache(
+                threshold=float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.97")),
+                ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+                max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024")),
+            )
 
     # 4o is a good model as well
-    def _initialize_llm(self, model="gpt-4o-mini", temperature=0.6):
-        """Function to initialize LLM"""
-        llm = ChatOpenAI(model=model, max_tokens=800, temperature=temperature)
+    def _initialize_llm(self, model="gpt-4o-mini", temperature=0.6, logprobs=False):
+        """Function to initialize LLM. Models of the cascade below the last one return
+        log probabilities, from which the confidence of their answer is estimated."""
+        llm = ChatOpenAI(
+            model=model, max_tokens=800, temperature=temperature, logprobs=logprobs
+        )
 
         logger.info(
             f"LLM initialized with model: {model}, temperature: {temperature}")
         return llm
 
-    def query_vectorstore(self, query, k=5):
-        """Function to query vector store"""
-        results = self.vector_store.similarity_search_with_score(query, k=k)
-        # Return the context along with metadata
-        context_with_metadata = []
-        for doc, _ in results:
-            # Extract content, title, and page number from metadata
-            title = doc.metadata.get("title", "Unknown Title")
-            page = doc.metadata.get("page", "Unknown Page")
-            context_with_metadata.append(
-                {
-                    "content": doc.page_content,
-                    "title": title,
-                    "page": page,
-                }
+    @staticmethod
+    def _initialize_hedger():
+        # Calls slower than the LLM_HEDGE_QUANTILE of recent latencies are repeated and
+        # the first response wins. Costs an extra completion for the slowest calls.
+        return Hedger(
+            enabled=os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true",
+            quantile=float(os.getenv("LLM_HEDGE_QUANTILE", "0.95")),
+            initial_delay=float(os.getenv("LLM_HEDGE_INITIAL_DELAY_SECONDS", "3")),
+            min_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "1")),
+        )
+
+    def llm_tiers(self) -> list[LLMTier]:
+        """The models of the cascade, cheapest first."""
+        return [*self.llm_cascade, LLMTier(self.llm_model, self.llm, self.llm_hedger)]
+
+    async def get_store(self, course_id=None) -> VectorStore:
+        """Returns the vector store shard of a course, loading it off the event loop."""
+        return await asyncio.to_thread(self.router.get, course_id)
+
+    async def query_vectorstore(self, query, k=5, embedding=None, store=None):
+        """Function to query vector store.
+
+        The query is embedded asynchronously (unless its embedding is passed in) and the
+        FAISS search, which is CPU bound, runs in a worker thread so that it does not
+        block the event loop. Searches the default shard unless a store is given.
+        """
+        if store is None:
+            store = await self.get_store()
+        if embedding is None:
+            embedding = await self.embeddings.aembed_query(query)
+        candidates = (await self.search_candidates([embedding], store, k))[0]
+        # Return the context along with metadata and its squared L2 distance
+        return [
+            {**to_context(candidate.doc), "distance": candidate.distance}
+            for candidate in candidates
+        ]
+
+    async def keyword_search(self, queries, store, k):
+        """Returns the BM25 hits (doc_id, score) of each query, best first."""
+        return await asyncio.to_thread(
+            lambda: [store.keyword_index.search(query, k) for query in queries]
+        )
+
+    async def search_candidates(self, embeddings, store, k, keyword_hits=None):
+        """Searches the vector store for several query embeddings in one FAISS call.
+
+        If keyword hits are given, they are fused with the dense results of the same
+        query by reciprocal rank fusion.
+
+        Returns:
+            list[list[Candidate]]: The best chunks of each query with their distances
+            and vectors, in the same order as the embeddings.
+        """
+        # Deletions swap in a new index and mapping (see VectorStore._delete_chunks), so
+        # both are taken together and the positions found are resolved with the mapping
+        # of the same index
+        vector_store = store.vector_store
+        index, mapping = vector_store.index, vector_store.index_to_docstore_id
+        # FAISS searches all rows of a query matrix in one call, which LangChain's
+        # wrapper does not expose. Searches of concurrent requests are batched too.
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(
+            len(embeddings), index.d
+        )
+        distances, positions = await self.search_scheduler.search(index, queries, k)
+        return await asyncio.to_thread(
+            self._to_candidates,
+            store,
+            index,
+            mapping,
+            vector_store.docstore,
+            queries,
+            distances,
+            positions,
+            keyword_hits,
+        )
+
+    def _to_candidates(
+        self,
+        store,
+        index,
+        mapping,
+        docstore,
+        queries,
+        distances,
+        positions,
+        keyword_hits=None,
+    ):
+        # FAISS pads with -1 when there are fewer than k vectors
+        dense = [
+            [int(position) for position in row if position != -1] for row in positions
+        ]
+        keyword = [[] for _ in dense]
+        if keyword_hits is not None:
+            # The positions of the store may already belong to a newer index
+            store_positions = store.positions()
+            keyword = [
+                [
+                    store_positions[doc_id]
+                    for doc_id, _ in hits
+                    if mapping.get(store_positions.get(doc_id)) == doc_id
+                ]
+                for hits in keyword_hits
+            ]
+
+        found = sorted({position for row in dense + keyword for position in row})
+        vectors = (
+            dict(zip(found, reconstruct_positions(index, found)))
+            if found
+            else {}
+        )
+
+        results = []
+        for query, dense_row, dense_distances, keyword_row in zip(
+            queries, dense, distances, keyword
+        ):
+            row_distances = dict(zip(dense_row, map(float, dense_distances)))
+            order = dense_row
+            scores = None
+            if keyword_hits is not None:
+                scores = reciprocal_rank_fusion([dense_row, keyword_row])
+                order = sorted(scores, key=scores.get, reverse=True)
+
+            candidates = []
+            for position in order:
+                # Chunks being added are in the index before they are in the mapping
+                doc_id = mapping.get(position)
+                doc = docstore.search(doc_id) if doc_id is not None else None
+                if not isinstance(doc, Document):
+                    continue
+                distance = row_distances.get(position)
+                if distance is None:
+                    # Found by keyword only
+                    distance = float(((vectors[position] - query) ** 2).sum())
+                candidates.append(
+                    Candidate(
+                        doc,
+                        distance,
+                        vectors[position],
+                        score=scores[position] if scores else None,
+                        keyword_match=position in keyword_row,
+                        position=position,
+                    )
+                )
+            results.append(candidates)
+        return results
+
+    @staticmethod
+    def _fuse_posts(post_candidates, weights, k):
+        """Fuses the candidates of the posts of a thread into one ranking.
+
+        Chunks are scored by reciprocal rank fusion of the per-post rankings, weighted
+        by post recency. A chunk keeps its smallest distance to any of the posts.
+        """
+        if len(post_candidates) == 1:
+            return post_candidates[0]
+        best: dict[int, Candidate] = {}
+        keyword_matches = set()
+        for candidates in post_candidates:
+            for candidate in candidates:
+                current = best.get(candidate.position)
+                if current is None or candidate.distance < current.distance:
+                    best[candidate.position] = candidate
+                if candidate.keyword_match:
+                    keyword_matches.add(candidate.position)
+
+        rankings = [
+            [candidate.position for candidate in candidates]
+            for candidates in post_candidates
+        ]
+        scores = reciprocal_rank_fusion(rankings, weights=weights)
+        order = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [
+            replace(
+                best[position],
+                score=scores[position],
+                keyword_match=position in keyword_matches,
             )
-        return context_with_metadata
+            for position in order
+        ]
 
-    def format_contexts(self, contexts):
-        final_contexts = []
+    def _below_relevance_gate(self, candidates, keyword_hits) -> bool:
+        """Returns True if no retrieved chunk is close enough to the query to be worth
+        an LLM call, using the FAISS distances of the search.
 
-        for context in contexts:
-            title = context.get("title", "Untitled")
-            page = context.get("page", "Unknown")
-            content = context.get("content", "")
-            context_str = f"Slide Title: {title}, Slide Page: {page}\n{content}\n"
-            final_contexts.append(context_str)
+        Args:
+            candidates (list[Candidate]): The fused candidates of the thread.
+            keyword_hits (list[list[tuple[str, float]]]): The keyword hits of each post.
+                A decisive match exempts the thread from the gate; a weak one does not,
+                as nearly every query shares some common words with the materials.
+        """
+        distances = [c.distance for c in candidates if c.distance is not None]
+        if not distances:
+            return False
+        best = min(distances)
+        RETRIEVAL_BEST_DISTANCE.observe(best)
+        if (
+            not self.gate_max_distance
+            or best <= self.gate_max_distance
+            or any(self._decisive_keyword_hit(hits) for hits in keyword_hits)
+        ):
+            return False
+
+        self.gated += 1
+        logger.info(
+            f"Best chunk distance {best:.3f} exceeds RETRIEVAL_GATE_MAX_DISTANCE "
+            f"{self.gate_max_distance}"
+        )
+        ANSWERS.inc(source="gated")
+        return True
 
-        return "".join(final_contexts)
+    def _decisive_keyword_hit(self, hits) -> bool:
+        """Returns True if the best keyword hit scores at least the minimum score and
+        clearly beats the runner-up."""
+        if not hits:
+            return False
+        best = hits[0][1]
+        runner_up = hits[1][1] if len(hits) > 1 else 0.0
+        return best >= self.keyword_fast_path_min_score and not (
+            runner_up and best / runner_up < self.keyword_fast_path_ratio
+        )
+
+    def _keyword_fast_path(self, hits, store):
+        """Returns the keyword hits as candidates if the best one is decisive."""
+        if not self.keyword_fast_path_ratio or not self._decisive_keyword_hit(hits):
+            return None
+
+        docstore = store.vector_store.docstore
+        candidates = []
+        for doc_id, _ in hits:
+            doc = docstore.search(doc_id)
+            if isinstance(doc, Document):
+                candidates.append(Candidate(doc, None, None, keyword_match=True))
+        return candidates or None
+
+    def format_contexts(self, contexts):
+        return "".join(format_context(context) for context in contexts)
 
-    def invoke_response(self, persona, task, conditions, output_style, query):
+    async def prepare_query(
+        self, persona, task, conditions, output_style, query, course_id=None
+    ) -> PreparedQuery:
         """
-        Generates a response from the LLM using the given persona, task, and context from a vectorstore. Builds persona of gpt.
+        Builds the conversation for a query from the persona, task and context from a
+        vectorstore, unless the query can be answered from the cache.
 
         Args:
-            llm: The language model instance.
             persona (str): Persona description for the assistant.
             task (str): The task or topic scope.
             conditions (str): Additional conditions or constraints.
             output_style (str): Desired output style for the response.
-            query (str): The user's query.
+            query (ThreadQuery | str): The thread being answered, see ThreadQueryBuilder,
+                or a plain query.
+            course_id (str, optional): Course whose materials are searched. Defaults to
+                the default shard.
 
         Returns:
-            tuple: Clean response, tokens used, and main topic (if available).
+            PreparedQuery: The conversation to send, or the answer if no LLM call is needed.
         """
+        if isinstance(query, str):
+            query = ThreadQuery.from_text(query)
+        store = await self.get_store(course_id)
+        corpus_version = store.corpus_version
 
         # Construct initial system message
         sysmsg = f"{persona} {task} {conditions} {output_style}"
         conversation = [SystemMessage(content=sysmsg)]
 
-        # Retrieve context from vectorstore
-        raw_contexts = self.query_vectorstore(query, k=5)
+        prompt_key = SemanticResponseCache.prompt_key(sysmsg, course_id)
+        k = self.context_assembler.fetch_k
+        with stage("keyword_search"):
+            keyword_hits = await self.keyword_search(query.post_texts, store, k)
+
+        # A decisive keyword match for the latest post is answered without embedding the
+        # thread. This also skips the response cache, which is keyed by the embedding.
+        candidates = self._keyword_fast_path(keyword_hits[-1], store)
+        if candidates is not None:
+            self.keyword_fast_path_hits += 1
+            logger.info(
+                f"Keyword fast path, best BM25 score {keyword_hits[-1][0][1]:.2f}"
+            )
+            prepared = PreparedQuery(None, prompt_key, corpus_version)
+            with stage("format"):
+                raw_contexts, _ = self.context_assembler.assemble(None, candidates)
+                self.add_context(prepared, conversation, query.text, raw_contexts)
+            return prepared
+
+        # Answer from the cache if a near-identical thread was already answered
+        with stage("embed"):
+            post_embeddings = (await self.thread_queries.embed([query]))[0]
+        embedding = ThreadQueryBuilder.thread_embedding(post_embeddings, query.weights)
+        prepared = PreparedQuery(embedding, prompt_key, corpus_version)
+        if self.response_cache is not None:
+            cached = self.response_cache.lookup(embedding, prompt_key, corpus_version)
+            if cached is not None:
+                logger.info("Response served from cache")
+                ANSWERS.inc(source="response_cache")
+                prepared.answer = (cached.response, 0, cached.main_topic)
+                return prepared
+
+        # Retrieve candidate chunks for every post by hybrid search, fuse them and pick
+        # the ones to send
+        with stage("vector_search"):
+            post_candidates = await self.search_candidates(
+                post_embeddings, store, k, keyword_hits
+            )
+        candidates = self._fuse_posts(post_candidates, query.weights, k)
+        if self._below_relevance_gate(candidates, keyword_hits):
+            prepared.answer = ("I don't know.", 0, None)
+            return prepared
+        with stage("format"):
+            raw_contexts, _ = self.context_assembler.assemble(embedding, candidates)
+            self.add_context(prepared, conversation, query.text, raw_contexts)
+        return prepared
+
+    def add_context(self, prepared, conversation, query, raw_contexts):
+        """Completes a prepared query with the retrieved context."""
         if not raw_contexts:
             logger.warning("No relevant context found")
-            return "I don't know.", 0, None
+            ANSWERS.inc(source="no_context")
+            prepared.answer = ("I don't know.", 0, None)
+            return
         trimmed_contexts = self.format_contexts(raw_contexts)
 
         # determine the main topic
@@ -106,8 +554,60 @@ class ChatService:
         logger.debug(context_query)
         conversation.append(HumanMessage(content=context_query))
 
+        prepared.conversation = conversation
+        prepared.main_topic = maintopic
+
+    async def invoke_response(
+        self, persona, task, conditions, output_style, query, course_id=None
+    ):
+        """
+        Generates a response from the LLM using the given persona, task, and context from a vectorstore. Builds persona of gpt.
+
+        Args:
+            persona (str): Persona description for the assistant.
+            task (str): The task or topic scope.
+            conditions (str): Additional conditions or constraints.
+            output_style (str): Desired output style for the response.
+            query (ThreadQuery | str): The thread being answered, or a plain query.
+            course_id (str, optional): Course whose materials are searched. Defaults to
+                the default shard.
+
+        Returns:
+            tuple: Clean response, tokens used, and main topic (if available).
+        """
+        if isinstance(query, str):
+            query = ThreadQuery.from_text(query)
+        sysmsg = f"{persona} {task} {conditions} {output_style}"
+        key = self._flight_key(sysmsg, query, course_id)
+
+        async def answer():
+            prepared = await self.prepare_query(
+                persona, task, conditions, output_style, query, course_id
+            )
+            return await self.generate(prepared)
+
+        return await self.singleflight.do(key, answer)
+
+    @staticmethod
+    def _flight_key(sysmsg, query: ThreadQuery, course_id):
+        """Key of identical requests: same prompt, course and (normalized) thread."""
+        normalized = " ".join(query.text.split()).casefold()
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"{SemanticResponseCache.prompt_key(sysmsg, course_id)}:{digest}"
+
+    async def generate(self, prepared: PreparedQuery):
+        """Calls the LLM for a prepared query and caches the clean response.
+
+        Returns:
+            tuple: Clean response, tokens used, and main topic (if available).
+        """
+        if prepared.answer is not None:
+            return prepared.answer
+
         # generate response from the LLM
-        response, tokens_used = self.get_tokens_used(conversation)
+        start = time.perf_counter()
+        response, tokens_used = await self.get_tokens_used(prepared.conversation)
+        latency = time.perf_counter() - start
 
         # clean up the response
         clean_response = (
@@ -117,11 +617,320 @@ class ChatService:
             .strip()
         )
 
-        return clean_response, tokens_used, maintopic
+        self._cache_response(prepared, clean_response, tokens_used, latency)
+        return clean_response, tokens_used, prepared.main_topic
+
+    async def invoke_responses(
+        self, persona, task, conditions, output_style, queries, course_id=None
+    ):
+        """
+        Batch variant of invoke_response for many threads at once.
+
+        The new posts of all threads are embedded in one request and searched in one
+        FAISS call. The LLM calls then run concurrently, at most BATCH_LLM_CONCURRENCY
+        at a time. If the shared embedding or search fails, each thread is prepared on
+        its own, so a failure only affects the threads it belongs to.
+
+        Args:
+            queries (list[ThreadQuery | str]): The query of each thread.
+            Other arguments as in invoke_response; they are shared by all threads.
+
+        Returns:
+            list: For each query, a (clean response, tokens used, main topic) tuple, or
+            the exception raised while answering it.
+        """
+        queries = [
+            ThreadQuery.from_text(query) if isinstance(query, str) else query
+            for query in queries
+        ]
+        sysmsg = f"{persona} {task} {conditions} {output_style}"
+        semaphore = asyncio.Semaphore(self.batch_llm_concurrency)
+
+        try:
+            prepared = await self._prepare_batch(sysmsg, queries, course_id)
+        except Exception as e:
+            # A failure of a shared stage (e.g. the embedding request) would fail every
+            # thread, so each thread is prepared on its own instead
+            logger.error(
+                f"Preparing a batch of {len(queries)} threads failed, preparing them "
+                f"one by one: {str(e)}"
+            )
+
+            async def prepare(query):
+                async with semaphore:
+                    return await self.prepare_query(
+                        persona, task, conditions, output_style, query, course_id
+                    )
+
+            prepared = await asyncio.gather(
+                *(prepare(query) for query in queries), return_exceptions=True
+            )
+
+        async def generate(query_prepared):
+            async with semaphore:
+                return await self.generate(query_prepared)
+
+        # Threads also being answered by another request, or twice in this batch, share
+        # that LLM call
+        async def answer(query, query_prepared):
+            if isinstance(query_prepared, Exception):
+                raise query_prepared
+            if query_prepared.answer is not None:
+                return query_prepared.answer
+            key = self._flight_key(sysmsg, query, course_id)
+            return await self.singleflight.do(key, lambda: generate(query_prepared))
+
+        return await asyncio.gather(
+            *(answer(*item) for item in zip(queries, prepared)),
+            return_exceptions=True,
+        )
+
+    async def _prepare_batch(self, sysmsg, queries, course_id):
+        """Prepares the queries of a batch with one embedding request and one search.
+
+        Returns:
+            list: For each query, a PreparedQuery or the exception raised while
+            preparing that thread. Failures of the shared stages are raised.
+        """
+        store = await self.get_store(course_id)
+        corpus_version = store.corpus_version
+
+        prompt_key = SemanticResponseCache.prompt_key(sysmsg, course_id)
+        with stage("embed"):
+            post_embeddings = await self.thread_queries.embed(queries)
+
+        prepared = []
+        for query, vectors in zip(queries, post_embeddings):
+            embedding = ThreadQueryBuilder.thread_embedding(vectors, query.weights)
+            query_prepared = PreparedQuery(embedding, prompt_key, corpus_version)
+            if self.response_cache is not None:
+                cached = self.response_cache.lookup(
+                    embedding, prompt_key, corpus_version
+                )
+                if cached is not None:
+                    ANSWERS.inc(source="response_cache")
+                    query_prepared.answer = (cached.response, 0, cached.main_topic)
+            prepared.append(query_prepared)
+
+        uncached = [i for i, item in enumerate(prepared) if item.answer is None]
+        logger.info(
+            f"Answering {len(queries)} threads, {len(queries) - len(uncached)} from cache"
+        )
+        if uncached:
+            # The posts of all uncached threads, searched together
+            posts = [
+                (i, j) for i in uncached for j in range(len(queries[i].post_texts))
+            ]
+            k = self.context_assembler.fetch_k
+            with stage("keyword_search"):
+                keyword_hits = await self.keyword_search(
+                    [queries[i].post_texts[j] for i, j in posts], store, k
+                )
+            with stage("vector_search"):
+                candidates = await self.search_candidates(
+                    [post_embeddings[i][j] for i, j in posts], store, k, keyword_hits
+                )
+            post_candidates = {i: [] for i in uncached}
+            post_keyword_hits = {i: [] for i in uncached}
+            for (i, _), query_candidates, hits in zip(posts, candidates, keyword_hits):
+                post_candidates[i].append(query_candidates)
+                post_keyword_hits[i].append(hits)
+
+            for i in uncached:
+                try:
+                    thread_candidates = self._fuse_posts(
+                        post_candidates[i], queries[i].weights, k
+                    )
+                    if self._below_relevance_gate(
+                        thread_candidates, post_keyword_hits[i]
+                    ):
+                        prepared[i].answer = ("I don't know.", 0, None)
+                        continue
+                    with stage("format"):
+                        raw_contexts, _ = self.context_assembler.assemble(
+                            prepared[i].embedding, thread_candidates
+                        )
+                        self.add_context(
+                            prepared[i],
+                            [SystemMessage(content=sysmsg)],
+                            queries[i].text,
+                            raw_contexts,
+                        )
+                except Exception as e:
+                    logger.error(f"Failed to prepare thread {i} of the batch: {str(e)}")
+                    prepared[i] = e
+        return prepared
+
+    async def stream_response(
+        self, persona, task, conditions, output_style, query, course_id=None
+    ):
+        """
+        Streaming variant of invoke_response. Yields the response as it is generated.
+
+        Args:
+            See invoke_response.
+
+        Yields:
+            tuple: ("token", text) for each piece of the response, then ("done", dict)
+            with the clean response, tokens used and main topic.
+        """
+        prepared = await self.prepare_query(
+            persona, task, conditions, output_style, query, course_id
+        )
+        if prepared.answer is not None:
+            response, tokens_used, main_topic = prepared.answer
+            yield "token", response
+            yield "done", {
+                "response": response,
+                "tokens_used": tokens_used,
+                "main_topic": main_topic,
+            }
+            return
+
+        marker_filter = StreamingMarkerFilter()
+        parts = []
+        usage = None
+        first_token_latency = None
+
+        start = time.perf_counter()
+        deadline = start + self.llm_timeout if self.llm_timeout else None
+        async with self.llm_limiter.acquire():
+            with stage("llm"):
+                # stream_usage asks OpenAI to report token usage in the last chunk
+                stream = aiter(
+                    self.llm.astream(prepared.conversation, stream_usage=True)
+                )
+                while True:
+                    timeout = (
+                        deadline - time.perf_counter() if deadline is not None else None
+                    )
+                    try:
+                        chunk = await asyncio.wait_for(anext(stream), timeout)
+                    except StopAsyncIteration:
+                        break
+                    except TimeoutError:
+                        LLM_TIMEOUTS.inc()
+                        logger.warning(
+                            f"LLM stream timed out after {self.llm_timeout:.0f}s"
+                        )
+                        await stream.aclose()
+                        raise
+                    if chunk.usage_metadata:
+                        usage = chunk.usage_metadata
+                    text = marker_filter.feed(chunk.content)
+                    if not text:
+                        continue
+                    if first_token_latency is None:
+                        first_token_latency = time.perf_counter() - start
+                        STREAM_FIRST_TOKEN_SECONDS.observe(first_token_latency)
+                        logger.info(f"Time to first token: {first_token_latency:.3f}s")
+                    parts.append(text)
+                    yield "token", text
+        latency = time.perf_counter() - start
+
+        text = marker_filter.flush()
+        if text:
+            parts.append(text)
+            yield "token", text
+
+        clean_response = "".join(parts)
+        tokens_used = usage["total_tokens"] if usage else 0
+        if usage:
+            record_llm_tokens(
+                usage["input_tokens"], usage["output_tokens"], self.llm_model
+            )
+        LLM_CALLS.inc(model=self.llm_model, outcome="answered")
+        ANSWERS.inc(source="llm")
+        logger.info(f"Streamed response in {latency:.3f}s")
+
+        self._cache_response(prepared, clean_response, tokens_used, latency)
+        yield "done", {
+            "response": clean_response,
+            "tokens_used": tokens_used,
+            "main_topic": prepared.main_topic,
+        }
+
+    def _cache_response(self, prepared, clean_response, tokens_used, latency):
+        if self.response_cache is None or prepared.embedding is None:
+            return
+        self.response_cache.store(
+            prepared.embedding,
+            prepared.prompt_key,
+            prepared.corpus_version,
+            clean_response,
+            tokens_used,
+            prepared.main_topic,
+            latency,
+        )
+
+    async def get_tokens_used(self, conversation):
+        """Calls the LLM cascade within the deadline.
+
+        Returns:
+            tuple: The response text and the total tokens used by all models called.
+        """
+        try:
+            return await asyncio.wait_for(
+                self._call_cascade(conversation), self.llm_timeout or None
+            )
+        except TimeoutError:
+            LLM_TIMEOUTS.inc()
+            logger.warning(f"LLM call timed out after {self.llm_timeout:.0f}s")
+            raise
+
+    async def _call_cascade(self, conversation):
+        tiers = self.llm_tiers()
+        tokens_used = 0
+        for tier in tiers:
+            last = tier is tiers[-1]
+
+            async def attempt(llm=tier.llm):
+                async with self.llm_limiter.acquire():
+                    with stage("llm"):
+                        return await llm.ainvoke(conversation)
+
+            try:
+                response = await tier.hedger.run(
+                    # Hedging while calls are queued for the limiter would only add load
+                    attempt,
+                    can_hedge=lambda: not self.llm_limiter.queue_depth,
+                )
+            except Exception as e:
+                if last:
+                    raise
+                LLM_CALLS.inc(model=tier.model, outcome="failed")
+                logger.warning(f"{tier.model} failed, escalating: {str(e)}")
+                continue
+
+            # Read from the response rather than a callback, which would also count the
+            # tokens of a cancelled hedge
+            usage = response.usage_metadata or {}
+            record_llm_tokens(
+                usage.get("input_tokens", 0), usage.get("output_tokens", 0), tier.model
+            )
+            tokens_used += usage.get("total_tokens", 0)
+
+            if not last:
+                confidence = self._confidence(response)
+                if "I don't know" in response.content or (
+                    confidence is not None
+                    and confidence < self.cascade_min_confidence
+                ):
+                    LLM_CALLS.inc(model=tier.model, outcome="escalated")
+                    logger.info(
+                        f"Escalating from {tier.model}, confidence: {confidence}"
+                    )
+                    continue
+
+            LLM_CALLS.inc(model=tier.model, outcome="answered")
+            ANSWERS.inc(source="llm")
+            return response.content, tokens_used
 
-    def get_tokens_used(self, conversation):
-        """Function to check API usage"""
-        with get_openai_callback() as cb:
-            response = self.llm.invoke(conversation)
-            tokens_used = cb.total_tokens  # get total tokens used in this query
-        return response.content, tokens_used
+    @staticmethod
+    def _confidence(response) -> float | None:
+        """Geometric mean probability of the response tokens, or None if the model did
+        not return log probabilities."""
+        logprobs = (response.response_metadata.get("logprobs") or {}).get("content")
+        if not logprobs:
+            return None
+        return math.exp(sum(token["logprob"] for token in logprobs) / len(logprobs))
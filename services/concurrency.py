@@ -0,0 +1,57 @@
+import asyncio
+from contextlib import asynccontextmanager
+from services.logger import Logger
+
+logger = Logger()
+
+
+class ConcurrencyLimiter:
+    """Bounds the number of in-flight calls to a slow dependency (e.g. the LLM).
+
+    Callers that exceed the limit wait on the event loop instead of holding a
+    worker thread, and the number of waiting callers is tracked as the queue depth.
+    """
+
+    def __init__(self, name: str, max_in_flight: int):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.peak_queue_depth = 0
+        self.total_calls = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Wait for a free slot, then hold it for the duration of the block."""
+        self.queue_depth += 1
+        self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+        if self.queue_depth > 1 or self.in_flight >= self.max_in_flight:
+            logger.debug(
+                f"{self.name} limiter saturated, queue depth: {self.queue_depth}"
+            )
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queue_depth -= 1
+
+        self.in_flight += 1
+        self.total_calls += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "peak_queue_depth": self.peak_queue_depth,
+            "total_calls": self.total_calls,
+        }
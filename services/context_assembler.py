@@ -0,0 +1,204 @@
+import os
+from dataclasses import dataclass
+import numpy as np
+from langchain_core.documents import Document
+from services.logger import Logger
+from services.tokens import count_tokens, truncate_to_tokens
+
+logger = Logger()
+
+
+@dataclass
+class Candidate:
+    """A chunk returned by the vector store search."""
+
+    doc: Document
+    distance: float | None  # squared L2 distance to the query
+    vector: np.ndarray | None
+    # Fused hybrid retrieval score, used as relevance instead of the vector similarity
+    score: float | None = None
+    keyword_match: bool = False
+    # Position of the chunk in the FAISS index, None if not found by the vector store
+    position: int | None = None
+
+
+def format_context(context: dict) -> str:
+    title = context.get("title", "Untitled")
+    page = context.get("page", "Unknown")
+    content = context.get("content", "")
+    return f"Slide Title: {title}, Slide Page: {page}\n{content}\n"
+
+
+def to_context(doc: Document) -> dict:
+    # Extract content, title, and page number from metadata
+    return {
+        "content": doc.page_content,
+        "title": doc.metadata.get("title", "Unknown Title"),
+        "page": doc.metadata.get("page", "Unknown Page"),
+    }
+
+
+class ContextAssembler:
+    """Picks the chunks to put into a prompt from an over-fetched candidate list.
+
+    1. Candidates much further from the query than the best match are dropped, unless
+       they matched the query's keywords.
+    2. Near-duplicate chunks (e.g. the same slide in two decks) are dropped.
+    3. The rest are ordered by maximal marginal relevance, which trades relevance to
+       the query against similarity to the chunks already picked.
+    4. Chunks are packed in that order until the token budget is used up.
+    """
+
+    def __init__(
+        self,
+        token_budget=None,
+        fetch_k=None,
+        max_contexts=None,
+        max_distance=None,
+        max_distance_gap=None,
+        duplicate_similarity=None,
+        mmr_lambda=None,
+    ):
+        def setting(value, name, default, cast=float):
+            return value if value is not None else cast(os.getenv(name, default))
+
+        self.token_budget = setting(token_budget, "CONTEXT_TOKEN_BUDGET", "2000", int)
+        self.fetch_k = setting(fetch_k, "CONTEXT_FETCH_K", "20", int)
+        self.max_contexts = setting(max_contexts, "CONTEXT_MAX_CHUNKS", "5", int)
+        # 0 disables the absolute distance cut-off
+        self.max_distance = setting(max_distance, "CONTEXT_MAX_DISTANCE", "0")
+        self.max_distance_gap = setting(
+            max_distance_gap, "CONTEXT_MAX_DISTANCE_GAP", "0.3"
+        )
+        self.duplicate_similarity = setting(
+            duplicate_similarity, "CONTEXT_DUPLICATE_SIMILARITY", "0.95"
+        )
+        self.mmr_lambda = setting(mmr_lambda, "CONTEXT_MMR_LAMBDA", "0.7")
+
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.prompt_tokens_saved = 0
+
+    def assemble(self, query_embedding, candidates: list[Candidate], baseline_k=5):
+        """Selects and orders the contexts for a query.
+
+        Args:
+            query_embedding: Embedding of the query. If None (keyword-only retrieval),
+                candidates are packed in the given order without filtering or MMR.
+            candidates (list[Candidate]): Search results, best first.
+            baseline_k (int): Number of nearest chunks the prompt would contain without
+                assembly, used to report the tokens saved.
+
+        Returns:
+            tuple: The contexts (dicts with content, title and page), most relevant
+            first, and a report of the tokens used and saved.
+        """
+        baseline_tokens = sum(
+            count_tokens(format_context(to_context(candidate.doc)))
+            for candidate in candidates[:baseline_k]
+        )
+
+        if query_embedding is None:
+            candidates = candidates[: self.max_contexts]
+            selected = self._pack(candidates)
+        else:
+            candidates = self._filter_by_distance(candidates)
+            selected = []
+            if candidates:
+                vectors = _normalize(np.stack([c.vector for c in candidates]))
+                if candidates[0].score is not None:
+                    scores = np.array([c.score for c in candidates])
+                    relevance = scores / scores.max()
+                else:
+                    query = np.asarray(query_embedding, dtype=np.float32)[None, :]
+                    relevance = vectors @ _normalize(query)[0]
+                similarity = vectors @ vectors.T
+
+                order = self._mmr(relevance, similarity)
+                selected = self._pack([candidates[i] for i in order])
+
+        tokens = sum(count_tokens(format_context(context)) for context in selected)
+        report = {
+            "candidates": len(candidates),
+            "contexts": len(selected),
+            "prompt_tokens": tokens,
+            "baseline_tokens": baseline_tokens,
+            "tokens_saved": baseline_tokens - tokens,
+        }
+
+        self.requests += 1
+        self.prompt_tokens += tokens
+        self.prompt_tokens_saved += baseline_tokens - tokens
+        logger.info(f"Context assembled: {report}")
+        return selected, report
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "prompt_tokens_saved": self.prompt_tokens_saved,
+        }
+
+    def _filter_by_distance(self, candidates):
+        if not candidates:
+            return []
+        best = min(candidate.distance for candidate in candidates)
+        return [
+            candidate
+            for candidate in candidates
+            if candidate.keyword_match
+            or (
+                candidate.distance - best <= self.max_distance_gap
+                and (not self.max_distance or candidate.distance <= self.max_distance)
+            )
+        ]
+
+    def _mmr(self, relevance, similarity):
+        """Returns candidate indices in maximal marginal relevance order, skipping
+        near-duplicates of already picked candidates."""
+        remaining = list(range(len(relevance)))
+        order = []
+        while remaining and len(order) < self.max_contexts:
+            if order:
+                redundancy = similarity[np.ix_(remaining, order)].max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining))
+            scores = (
+                self.mmr_lambda * relevance[remaining]
+                - (1 - self.mmr_lambda) * redundancy
+            )
+            best = remaining[int(np.argmax(scores))]
+            order.append(best)
+            remaining = [
+                i
+                for i in remaining
+                if i != best and similarity[i, best] < self.duplicate_similarity
+            ]
+        return order
+
+    def _pack(self, candidates):
+        contexts, seen_content, used = [], set(), 0
+        for candidate in candidates:
+            context = to_context(candidate.doc)
+            if context["content"] in seen_content:
+                continue
+            tokens = count_tokens(format_context(context))
+            if used + tokens > self.token_budget:
+                if contexts:
+                    # Skip chunks that do not fit; a later, shorter one still might
+                    continue
+                # Always include the best chunk, truncated to the budget
+                header_tokens = count_tokens(format_context({**context, "content": ""}))
+                context["content"] = truncate_to_tokens(
+                    context["content"], self.token_budget - header_tokens
+                )
+                tokens = count_tokens(format_context(context))
+            contexts.append(context)
+            seen_content.add(context["content"])
+            used += tokens
+        return contexts
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from collections import deque
+import numpy as np
+from services.logger import Logger
+
+logger = Logger()
+
+
+class Hedger:
+    """Runs a call and, if it is slower than usual, a second attempt of it.
+
+    The hedge starts once the first attempt has taken longer than the given quantile
+    (p95 by default) of recent call latencies, so only the slowest calls are repeated.
+    Whichever attempt finishes first wins and the other one is cancelled. Until enough
+    latencies are known the initial delay is used.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        quantile=0.95,
+        initial_delay=2.0,
+        min_delay=0.5,
+        min_samples=20,
+        window=200,
+    ):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self) -> float:
+        """Seconds after which a call is hedged."""
+        if len(self._latencies) < self.min_samples:
+            return self.initial_delay
+        return max(self.min_delay, float(np.quantile(self._latencies, self.quantile)))
+
+    async def run(self, attempt, can_hedge=lambda: True):
+        """Returns the result of the first successful attempt.
+
+        The latency of the call is recorded whether it succeeds, fails or is cancelled.
+
+        Args:
+            attempt: Coroutine function taking no arguments, called once per attempt.
+            can_hedge: Called before hedging; return False to not start a second
+                attempt, e.g. while the LLM limiter has callers waiting.
+        """
+        self.calls += 1
+        start = time.perf_counter()
+        pending = {asyncio.create_task(attempt())}
+        hedge = None
+        try:
+            if self.enabled:
+                done, _ = await asyncio.wait(pending, timeout=self.delay())
+                if not done and can_hedge():
+                    self.hedges += 1
+                    logger.info(f"Hedging call after {self.delay():.2f}s")
+                    hedge = asyncio.create_task(attempt())
+                    pending.add(hedge)
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is hedge:
+                        self.hedge_wins += 1
+                    return task.result()
+            raise error
+        finally:
+            # The latency the caller saw, from the start of the first attempt. Failed
+            # and cancelled (e.g. timed out) calls count too, so that slow calls that
+            # never succeed still raise the hedge delay.
+            self._latencies.append(time.perf_counter() - start)
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_delay": round(self.delay(), 3),
+        }
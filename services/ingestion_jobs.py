@@ -0,0 +1,146 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from services.logger import Logger
+
+logger = Logger()
+
+
+@dataclass
+class IngestionJob:
+    """Tracks an upload that is being ingested in the background."""
+
+    id: str
+    content_hash: str
+    filenames: list[str]
+    status: str = "queued"  # queued -> running -> succeeded | failed
+    files_parsed: int = 0
+    chunks_embedded: int = 0
+    persisted: bool = False
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+
+    def on_progress(self, stage: str, count: int = 0):
+        if stage == "parsed":
+            self.files_parsed += count
+        elif stage == "embedded":
+            self.chunks_embedded += count
+        elif stage == "persisted":
+            self.persisted = True
+
+    def to_dict(self) -> dict[str, any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "files": self.filenames,
+            "files_total": len(self.filenames),
+            "files_parsed": self.files_parsed,
+            "chunks_embedded": self.chunks_embedded,
+            "persisted": self.persisted,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionJobRunner:
+    """Runs ingestion jobs on a bounded in-process worker pool.
+
+    Submitting the same files again while an earlier job for them is queued or running
+    returns that job instead of ingesting them twice. Once it has finished, the files
+    are ingested again, e.g. to roll back to an earlier version with a replace-upload;
+    chunks that are already indexed are skipped by the vector store.
+    """
+
+    def __init__(self, ingest, max_concurrency=1, max_finished_jobs=1000):
+        """
+        Args:
+            ingest: Called as ingest(files, on_progress, **options) to ingest a list of
+                (filename, content) tuples. Must return a response_handler dict.
+            max_concurrency (int): Maximum number of jobs ingesting at once.
+            max_finished_jobs (int): Number of finished jobs kept for status queries.
+        """
+        self._ingest = ingest
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="ingestion-job"
+        )
+        self.max_finished_jobs = max_finished_jobs
+
+        self._lock = threading.Lock()
+        self._jobs: OrderedDict[str, IngestionJob] = OrderedDict()
+        # Queued and running jobs by content hash
+        self._jobs_by_hash: dict[str, IngestionJob] = {}
+
+    @staticmethod
+    def content_hash(files: list[tuple[str, bytes]], options: dict) -> str:
+        # Filenames are part of the key, as the title of the chunks is taken from them
+        file_hashes = sorted(
+            f"{filename}\0{hashlib.sha256(content).hexdigest()}"
+            for filename, content in files
+        )
+        key = "\0".join(file_hashes) + repr(sorted(options.items()))
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def submit(
+        self, files: list[tuple[str, bytes]], **options
+    ) -> tuple[IngestionJob, bool]:
+        """Queues the files for ingestion.
+
+        Options are passed on to the ingest function and are part of the dedup key.
+
+        Returns:
+            tuple: The job, and whether it was newly created (False if the same upload
+            is still queued or running).
+        """
+        content_hash = self.content_hash(files, options)
+
+        with self._lock:
+            existing = self._jobs_by_hash.get(content_hash)
+            if existing is not None:
+                logger.info(f"Upload matches existing job {existing.id}")
+                return existing, False
+
+            job = IngestionJob(
+                id=uuid.uuid4().hex,
+                content_hash=content_hash,
+                filenames=[filename for filename, _ in files],
+            )
+            self._jobs[job.id] = job
+            self._jobs_by_hash[content_hash] = job
+            self._prune()
+
+        self._executor.submit(self._run, job, files, options)
+        logger.info(f"Queued ingestion job {job.id} for {len(files)} file(s)")
+        return job, True
+
+    def get(self, job_id: str) -> IngestionJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: IngestionJob, files: list[tuple[str, bytes]], options: dict):
+        job.status = "running"
+        try:
+            response = self._ingest(files, job.on_progress, **options)
+            if response["code"] != 201:
+                raise RuntimeError(response["status"])
+            job.status = "succeeded"
+        except Exception as e:
+            logger.error(f"Ingestion job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if self._jobs_by_hash.get(job.content_hash) is job:
+                    del self._jobs_by_hash[job.content_hash]
+
+    def _prune(self):
+        # Forget the oldest finished jobs once too many are kept
+        finished = [job for job in self._jobs.values() if job.finished_at is not None]
+        for job in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job.id]
@@ -1,4 +1,9 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import random
 import structlog
 
 
@@ -23,29 +28,59 @@ class Logger:
         return self.logger.critical(*args, **kwargs)
 
 
-def configure_logger(enable_json_logs: bool = False):
+_LEVELS = logging.getLevelNamesMapping()
+
+# Handler and background writer installed by the last configure_logger() call
+_handler = None
+_listener = None
+
+
+def configure_logger(enable_json_logs: bool | None = None, stream=None):
+    """Configures structlog and the standard library logging.
+
+    Settings are read from the environment, see .env.template: LOG_FORMAT (console or
+    json, defaults to json in PROD), LOG_LEVEL, LOG_LEVELS (per logger, e.g.
+    httpx=WARNING), LOG_ASYNC (write from a background thread), LOG_CALLSITE_LEVEL,
+    LOG_SAMPLE_RATES and LOG_MAX_FIELD_CHARS.
+
+    Can be called again to apply other settings; the previous handler is replaced.
+
+    Args:
+        enable_json_logs (bool, optional): Overrides LOG_FORMAT.
+        stream (optional): Where logs are written. Defaults to stderr.
+    """
+    env = os.getenv("ENV", "PROD")
+    dev = env in ("DEV", "DEV_2")
+    if enable_json_logs is None:
+        enable_json_logs = (
+            os.getenv("LOG_FORMAT") or ("console" if dev else "json")
+        ) == "json"
+    level = _LEVELS[(os.getenv("LOG_LEVEL") or ("DEBUG" if dev else "INFO")).upper()]
+
     timestamper = structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S")
+    callsite = _CallsiteFromLevel(
+        _LEVELS[(os.getenv("LOG_CALLSITE_LEVEL") or "WARNING").upper()]
+    )
+    truncate = _Truncate(int(os.getenv("LOG_MAX_FIELD_CHARS", "1000")))
 
     shared_processors = [
         timestamper,
         structlog.stdlib.add_log_level,
         structlog.stdlib.add_logger_name,
-        structlog.contextvars.merge_contextvars,
-        structlog.processors.CallsiteParameterAdder(
-            {
-                structlog.processors.CallsiteParameter.FILENAME,
-                structlog.processors.CallsiteParameter.MODULE,
-                structlog.processors.CallsiteParameter.FUNC_NAME,
-            }
-        ),
+        callsite,
         structlog.stdlib.ExtraAdder(),
     ]
 
     structlog.configure(
-        processors=shared_processors
-        + [structlog.stdlib.ProcessorFormatter.wrap_for_formatter],
+        processors=[
+            # Drop events below the level before any other processor runs
+            structlog.stdlib.filter_by_level,
+            *shared_processors,
+            structlog.contextvars.merge_contextvars,
+            truncate,
+            structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
+        ],
         logger_factory=structlog.stdlib.LoggerFactory(),
-        # @TODO Experiment with AsyncBoundLogger in future to squeeze out a bit more performance.
         wrapper_class=structlog.stdlib.BoundLogger,
         cache_logger_on_first_use=True,
     )
@@ -56,11 +91,16 @@ def configure_logger(enable_json_logs: bool = False):
         else structlog.dev.ConsoleRenderer(colors=True)
     )
 
-    _configure_default_logging_by_custom(shared_processors, logs_render)
+    # Records of other libraries (uvicorn, httpx) are formatted by the writer, which
+    # may be a background thread, so their context variables are taken from the record
+    foreign_processors = [*shared_processors, _merge_record_contextvars, truncate]
+    _configure_default_logging_by_custom(foreign_processors, logs_render, level, stream)
 
 
-def _configure_default_logging_by_custom(shared_processors, logs_render):
-    handler = logging.StreamHandler()
+def _configure_default_logging_by_custom(shared_processors, logs_render, level, stream):
+    global _handler, _listener
+
+    handler = logging.StreamHandler(stream)
 
     # Use `ProcessorFormatter` to format all `logging` entries.
     formatter = structlog.stdlib.ProcessorFormatter(
@@ -68,14 +108,170 @@ def _configure_default_logging_by_custom(shared_processors, logs_render):
         processors=[
             _extract_from_record,
             structlog.stdlib.ProcessorFormatter.remove_processors_meta,
+            # The console renderer prints tracebacks itself
+            *(
+                [structlog.processors.format_exc_info]
+                if isinstance(logs_render, structlog.processors.JSONRenderer)
+                else []
+            ),
             logs_render,
         ],
     )
-
     handler.setFormatter(formatter)
+
     root_uvicorn_logger = logging.getLogger()
+    if _handler is not None:
+        root_uvicorn_logger.removeHandler(_handler)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    # Formatting and writing happen in a background thread, so that a log call only
+    # puts the record on a queue
+    if os.getenv("LOG_ASYNC", "true").lower() == "true":
+        _listener = logging.handlers.QueueListener(
+            queue.Queue(int(os.getenv("LOG_QUEUE_SIZE", "10000"))), handler
+        )
+        handler = _QueueHandler(_listener.queue)
+        _listener.start()
+
+    handler.addFilter(_capture_contextvars)
+    sample_rates = _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))
+    if sample_rates:
+        handler.addFilter(_Sampler(sample_rates))
+
+    _handler = handler
     root_uvicorn_logger.addHandler(handler)
-    root_uvicorn_logger.setLevel(logging.DEBUG)
+    root_uvicorn_logger.setLevel(level)
+
+    for name, logger_level in _parse_levels(os.getenv("LOG_LEVELS", "")).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+
+def flush_logs():
+    """Waits until the queued records are written."""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+
+@atexit.register
+def _stop():
+    # Writes the records still queued when the process exits
+    if _listener is not None:
+        _listener.stop()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the background writer without blocking the caller."""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # The default formats the message into a string, which would turn structlog's
+        # event dicts into text before ProcessorFormatter sees them
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Dropping a record beats blocking a request when the writer falls behind
+            _QueueHandler.dropped += 1
+
+
+class _CallsiteFromLevel:
+    """Adds the file, module and function of the log call to events at or above a
+    level. Finding the caller of a structlog event inspects the stack, which is too slow
+    to do for every event."""
+
+    def __init__(self, level):
+        self.level = level
+        self._adder = structlog.processors.CallsiteParameterAdder(
+            {
+                structlog.processors.CallsiteParameter.FILENAME,
+                structlog.processors.CallsiteParameter.MODULE,
+                structlog.processors.CallsiteParameter.FUNC_NAME,
+            },
+            # Skip the Logger wrapper, which would otherwise be reported as the caller
+            additional_ignores=["services.logger"],
+        )
+
+    def __call__(self, logger, method_name, event_dict):
+        if _LEVELS.get(event_dict.get("level", "").upper(), 0) < self.level:
+            return event_dict
+        return self._adder(logger, method_name, event_dict)
+
+
+class _Truncate:
+    """Shortens string fields, e.g. prompts and responses, to at most max_chars. 0
+    disables truncation."""
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+
+    def __call__(self, _, __, event_dict):
+        if not self.max_chars:
+            return event_dict
+        for key, value in event_dict.items():
+            if isinstance(value, str) and len(value) > self.max_chars:
+                event_dict[key] = (
+                    f"{value[: self.max_chars]}... "
+                    f"[{len(value) - self.max_chars} more chars]"
+                )
+        return event_dict
+
+
+class _Sampler(logging.Filter):
+    """Keeps only a fraction of the events starting with a given text, e.g. 10% of
+    "Context assembled". Warnings and errors are always kept."""
+
+    def __init__(self, rates: list[tuple[str, float]]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        # structlog events carry their event dict, other records their format string
+        event = record.msg.get("event") if isinstance(record.msg, dict) else record.msg
+        event = str(event)
+        for prefix, rate in self.rates:
+            if event.startswith(prefix):
+                return random.random() < rate
+        return True
+
+
+def _capture_contextvars(record):
+    # Runs in the thread of the log call, where the request's context variables are
+    # set. structlog events already have them merged.
+    if not isinstance(record.msg, dict):
+        record.contextvars = structlog.contextvars.get_contextvars()
+    return True
+
+
+def _merge_record_contextvars(_, __, event_dict):
+    for key, value in event_dict.pop("contextvars", {}).items():
+        event_dict.setdefault(key, value)
+    return event_dict
+
+
+def _parse_sample_rates(value: str) -> list[tuple[str, float]]:
+    """Parses "Context assembled=0.1,HTTP Request=0.01"."""
+    rates = []
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        prefix, _, rate = item.rpartition("=")
+        rates.append((prefix.strip(), float(rate)))
+    return rates
+
+
+def _parse_levels(value: str) -> dict[str, int]:
+    """Parses "httpx=WARNING,uvicorn.access=WARNING"."""
+    levels = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = _LEVELS[level.strip().upper()]
+    return levels
 
 
 def _extract_from_record(_, __, event_dict):
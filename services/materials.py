@@ -1,18 +1,59 @@
-from models.vector_store import VectorStore
+import os
+from models.shard_router import VectorStoreRouter
+from services.ingestion_jobs import IngestionJobRunner
 from services.logger import Logger
-from fastapi import UploadFile
 from response import response_handler
 
 logger = Logger()
 
 
 class MaterialsController:
-    def __init__(self, vector_store: VectorStore):
-        self.vector_store = vector_store
+    def __init__(self, router: VectorStoreRouter):
+        self.router = router
+
+        # Uploads are ingested in the background so that the request returns at once
+        self.jobs = IngestionJobRunner(
+            ingest=self._ingest,
+            max_concurrency=int(os.getenv("INGEST_JOB_CONCURRENCY", "1")),
+        )
         logger.debug("Materials controller initialized")
         pass
 
-    def add(self, files: list[UploadFile]):
+    def add(self, files: list[tuple[str, bytes]], replace=False, course_id=None):
+        """Queues PDFs for ingestion and returns the id of the ingestion job.
+
+        Args:
+            files (list[tuple[str, bytes]]): (filename, content) of each PDF.
+            replace (bool): Replace previously indexed versions of the PDFs.
+            course_id (str, optional): Course whose shard the PDFs are added to.
+        """
+        try:
+            self.router.validate_course_id(course_id)
+        except ValueError as e:
+            return response_handler(400, str(e))
+
+        job, created = self.jobs.submit(files, replace=replace, course_id=course_id)
+        if not created:
+            return response_handler(
+                200, "Files already submitted for ingestion", job.to_dict()
+            )
+
+        return response_handler(202, "Files queued for ingestion", job.to_dict())
+
+    def status(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return response_handler(404, "Ingestion job not found")
+
+        return response_handler(200, "Ingestion job status", job.to_dict())
+
+    def _ingest(
+        self,
+        files: list[tuple[str, bytes]],
+        on_progress,
+        replace=False,
+        course_id=None,
+    ):
         # Upload PDFs onto Google Cloud Storage for retrieval in the future
         # upload_res = self.pdf_store.upload(files)
         # if upload_res["code"] != 201:
@@ -20,7 +61,9 @@ class MaterialsController:
         #     return response_handler(500, "Error uploading to Google Cloud Storage")
 
         # Update vectorstore
-        vectorstore_res = self.vector_store.add_documents(files)
+        vectorstore_res = self.router.get(course_id).add_documents(
+            files, on_progress=on_progress, replace=replace
+        )
         if vectorstore_res["code"] != 201:
             logger.error("Error updating vectorstore")
             return response_handler(500, "Error updating vectorstore")
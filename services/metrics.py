@@ -0,0 +1,271 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus text exposition format, see
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Spans from sub-millisecond keyword searches to multi-second LLM calls.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+        + "}"
+    )
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.labelnames, key))
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. requests or tokens."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        return [
+            f"{self.name}{_format_labels(self._labels(key))} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies, in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label set: count per bucket (not cumulative), sum and count
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, [[0] * len(self.buckets), [0.0, 0]]
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            total[0] += value
+            total[1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the block in seconds, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        lines = []
+        for key, (counts, (total, count)) in self._values.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels({**labels, "le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(
+                f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}"
+            )
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    """Metrics exported on /metrics.
+
+    Besides metrics updated as events happen, collectors report values that already
+    exist elsewhere (cache hit counts, index sizes) when the metrics are scraped. A
+    collector returns (name, type, documentation, [(labels, value), ...]) tuples.
+    """
+
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.extend(
+                    f"{name}{_format_labels(labels)} {_format_value(value)}"
+                    for labels, value in samples
+                )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(
+    Counter(
+        "eduvisor_requests_total",
+        "HTTP requests by endpoint and status code.",
+        ("method", "endpoint", "status"),
+    )
+)
+REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "eduvisor_request_duration_seconds",
+        "HTTP request latency by endpoint.",
+        ("method", "endpoint"),
+    )
+)
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "eduvisor_stage_duration_seconds",
+        "Latency of the stages of answering a query and ingesting documents.",
+        ("stage",),
+    )
+)
+LLM_TOKENS = REGISTRY.register(
+    Counter(
+        "eduvisor_llm_tokens_total",
+        "Tokens sent to (prompt) and generated by (completion) each LLM model.",
+        ("model", "direction"),
+    )
+)
+LLM_CALLS = REGISTRY.register(
+    Counter(
+        "eduvisor_llm_calls_total",
+        "LLM calls per model of the cascade: answered, escalated or failed.",
+        ("model", "outcome"),
+    )
+)
+ANSWERS = REGISTRY.register(
+    Counter(
+        "eduvisor_answers_total",
+        "Answers by how they were produced: llm, response_cache, no_context or gated.",
+        ("source",),
+    )
+)
+LLM_TIMEOUTS = REGISTRY.register(
+    Counter(
+        "eduvisor_llm_timeouts_total",
+        "LLM calls abandoned at the LLM_TIMEOUT_SECONDS deadline.",
+    )
+)
+RETRIEVAL_BEST_DISTANCE = REGISTRY.register(
+    Histogram(
+        "eduvisor_retrieval_best_distance",
+        "Squared L2 distance of the best chunk per query, to calibrate "
+        "RETRIEVAL_GATE_MAX_DISTANCE.",
+        buckets=(0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 1.8, 2.0),
+    )
+)
+
+STREAM_FIRST_TOKEN_SECONDS = REGISTRY.register(
+    Histogram(
+        "eduvisor_stream_first_token_seconds",
+        "Time from the LLM call of a streamed response to its first token.",
+    )
+)
+SEARCH_BATCH_QUERIES = REGISTRY.register(
+    Histogram(
+        "eduvisor_search_batch_queries",
+        "Query vectors per batched FAISS search.",
+        buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+    )
+)
+SEARCH_QUEUE_SECONDS = REGISTRY.register(
+    Histogram(
+        "eduvisor_search_queue_seconds",
+        "Time a search waited to be batched with others, see SEARCH_BATCH_MAX_WAIT_MS.",
+        buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1),
+    )
+)
+
+
+def stage(name: str):
+    """Times a stage, e.g. `with stage("embed"): ...`."""
+    return STAGE_SECONDS.time(stage=name)
+
+
+def record_llm_tokens(prompt_tokens: int, completion_tokens: int, model: str):
+    LLM_TOKENS.inc(prompt_tokens, model=model, direction="prompt")
+    LLM_TOKENS.inc(completion_tokens, model=model, direction="completion")
@@ -0,0 +1,165 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy as np
+from services.logger import Logger
+
+logger = Logger()
+
+
+@dataclass
+class CachedResponse:
+    """A generated answer together with what it cost to produce."""
+
+    response: str
+    tokens_used: int
+    main_topic: str | None
+    latency: float
+    prompt_key: str
+    corpus_version: int
+    created_at: float
+    slot: int
+
+
+class SemanticResponseCache:
+    """Caches LLM answers keyed on the embedding of the query.
+
+    A lookup is a hit when a cached query has a cosine similarity of at least
+    `threshold` with the incoming query, has the same prompt key (system prompt and
+    course) and was answered against the same version of the corpus. Entries for an
+    older corpus version are dropped when they are found. Entries expire after
+    `ttl_seconds` and the least recently used entry is evicted once `max_entries` is
+    reached.
+    """
+
+    def __init__(self, threshold=0.97, ttl_seconds=3600, max_entries=1024):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[int, CachedResponse] = OrderedDict()
+        # Unit-normalised query embeddings, one row per slot. Allocated on first store
+        # since the embedding dimension depends on the configured model.
+        self._vectors: np.ndarray | None = None
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.tokens_saved = 0
+        self.latency_saved = 0.0
+
+    @staticmethod
+    def prompt_key(prompt: str, namespace: str | None = None) -> str:
+        return hashlib.sha256(f"{namespace}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, embedding, prompt_key: str, corpus_version: int):
+        """Return the cached answer for the closest matching query, or None."""
+        query = self._normalize(embedding)
+
+        with self._lock:
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            now = time.monotonic()
+            slots = np.fromiter(self._entries.keys(), dtype=np.int64)
+            scores = self._vectors[slots] @ query
+
+            for i in np.argsort(-scores):
+                if scores[i] < self.threshold:
+                    break
+                entry = self._entries[int(slots[i])]
+                if now - entry.created_at > self.ttl_seconds:
+                    self._evict(entry.slot)
+                    continue
+                if entry.prompt_key != prompt_key:
+                    continue
+                # Answers generated against an older corpus may miss newly uploaded material
+                if entry.corpus_version != corpus_version:
+                    self._evict(entry.slot)
+                    self.invalidations += 1
+                    continue
+
+                self._entries.move_to_end(entry.slot)
+                self.hits += 1
+                self.tokens_saved += entry.tokens_used
+                self.latency_saved += entry.latency
+                logger.debug(f"Response cache hit with similarity {scores[i]:.4f}")
+                return entry
+
+            self.misses += 1
+            return None
+
+    def store(
+        self,
+        embedding,
+        prompt_key: str,
+        corpus_version: int,
+        response: str,
+        tokens_used: int,
+        main_topic: str | None,
+        latency: float,
+    ):
+        vector = self._normalize(embedding)
+
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros(
+                    (self.max_entries, vector.shape[0]), dtype=np.float32
+                )
+            if not self._free_slots:
+                oldest_slot = next(iter(self._entries))
+                self._evict(oldest_slot)
+                self.evictions += 1
+
+            slot = self._free_slots.pop()
+            self._vectors[slot] = vector
+            self._entries[slot] = CachedResponse(
+                response=response,
+                tokens_used=tokens_used,
+                main_topic=main_topic,
+                latency=latency,
+                prompt_key=prompt_key,
+                corpus_version=corpus_version,
+                created_at=time.monotonic(),
+                slot=slot,
+            )
+
+    def invalidate(self):
+        """Drop every cached answer, e.g. after the course materials changed."""
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "tokens_saved": self.tokens_saved,
+            "latency_saved": round(self.latency_saved, 3),
+        }
+
+    def _clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+    def _evict(self, slot):
+        del self._entries[slot]
+        self._free_slots.append(slot)
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
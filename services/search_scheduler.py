@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+import numpy as np
+from services.logger import Logger
+from services.metrics import SEARCH_BATCH_QUERIES, SEARCH_QUEUE_SECONDS
+
+logger = Logger()
+
+
+class _Request:
+    __slots__ = ("queries", "k", "future", "enqueued")
+
+    def __init__(self, queries, k, future):
+        self.queries = queries
+        self.k = k
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class SearchScheduler:
+    """Coalesces FAISS searches from concurrent requests into batched searches.
+
+    FAISS searches a matrix of queries with one BLAS call, which is much cheaper than
+    as many single-vector searches. Searches against the same index that arrive within
+    `max_wait_ms` of the first one are stacked and run as one `index.search`, and each
+    caller gets its own rows back. A batch is flushed early once it holds
+    `max_batch_size` query vectors. Set max_wait_ms to 0 to search immediately.
+    """
+
+    def __init__(self, max_wait_ms=None, max_batch_size=None):
+        self.max_wait = (
+            max_wait_ms
+            if max_wait_ms is not None
+            else float(os.getenv("SEARCH_BATCH_MAX_WAIT_MS", "2"))
+        ) / 1000
+        self.max_batch_size = max_batch_size or int(
+            os.getenv("SEARCH_BATCH_MAX_SIZE", "64")
+        )
+
+        # Pending requests and flush timer per index, keyed by id() of the index. The
+        # index itself is kept with them so that the id cannot be reused meanwhile.
+        self._pending: dict[int, tuple[object, list[_Request]]] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        # Running batches. The event loop only holds weak references to tasks, so a
+        # batch whose callers were all cancelled could otherwise be collected mid-search.
+        self._tasks: set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.batched_queries = 0
+        self.max_batch_seen = 0
+        self.total_queue_delay = 0.0
+        self.max_queue_delay = 0.0
+
+    async def search(self, index, queries: np.ndarray, k: int):
+        """Searches a FAISS index, batched with concurrent searches of the same index.
+
+        Args:
+            index: The FAISS index.
+            queries (np.ndarray): float32 matrix of query vectors, one per row.
+            k (int): Number of neighbours per query.
+
+        Returns:
+            tuple: The distances and positions matrices, as returned by index.search.
+        """
+        if not self.max_wait:
+            return await asyncio.to_thread(index.search, queries, k)
+
+        loop = asyncio.get_running_loop()
+        request = _Request(queries, k, loop.create_future())
+        key = id(index)
+        _, requests = self._pending.setdefault(key, (index, []))
+        requests.append(request)
+
+        if sum(len(r.queries) for r in requests) >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await request.future
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "batches": self.batches,
+            "queries": self.batched_queries,
+            "mean_batch_size": round(self.batched_queries / max(1, self.batches), 2),
+            "max_batch_size": self.max_batch_seen,
+            "mean_queue_delay_ms": round(
+                1000 * self.total_queue_delay / max(1, self.batched_queries), 3
+            ),
+            "max_queue_delay_ms": round(1000 * self.max_queue_delay, 3),
+        }
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        index, requests = self._pending.pop(key)
+        task = asyncio.ensure_future(self._run(index, requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, index, requests: list[_Request]):
+        started = time.perf_counter()
+        queries = np.vstack([request.queries for request in requests])
+        # Every caller gets its rows cut to its own k. The first k neighbours of a
+        # search for more are the same as those of a search for k.
+        k = max(request.k for request in requests)
+
+        self.batches += 1
+        self.batched_queries += len(queries)
+        self.max_batch_seen = max(self.max_batch_seen, len(queries))
+        SEARCH_BATCH_QUERIES.observe(len(queries))
+        for request in requests:
+            delay = started - request.enqueued
+            SEARCH_QUEUE_SECONDS.observe(delay)
+            self.total_queue_delay += delay * len(request.queries)
+            self.max_queue_delay = max(self.max_queue_delay, delay)
+
+        try:
+            distances, positions = await asyncio.to_thread(index.search, queries, k)
+        except Exception as e:
+            logger.error(f"Batched search of {len(queries)} queries failed: {str(e)}")
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+
+        if len(requests) > 1:
+            logger.debug(
+                f"Searched {len(queries)} queries of {len(requests)} requests in one batch"
+            )
+        row = 0
+        for request in requests:
+            rows = slice(row, row + len(request.queries))
+            row += len(request.queries)
+            if not request.future.done():
+                request.future.set_result(
+                    (distances[rows, : request.k], positions[rows, : request.k])
+                )
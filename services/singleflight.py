@@ -0,0 +1,58 @@
+import asyncio
+from services.logger import Logger
+
+logger = Logger()
+
+
+class SingleFlight:
+    """Shares one execution between concurrent calls with the same key.
+
+    The first call for a key runs the work as a task; calls with the same key that
+    arrive while it is in flight await the same task instead of repeating the work.
+    Once it finishes the key is forgotten, so later calls run again (results are
+    cached elsewhere, e.g. by the response cache).
+
+    The task is shielded from the callers: a caller that is cancelled (e.g. its client
+    disconnected) stops waiting without cancelling the work for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: str, work):
+        """Runs work() unless a call with the same key is in flight, and returns its
+        result. Exceptions are raised to every caller sharing the call.
+
+        Args:
+            key (str): Identifies identical calls.
+            work: Coroutine function taking no arguments.
+        """
+        self.calls += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(work())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            self.shared += 1
+            logger.info(f"Sharing in-flight {self.name} call")
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Retrieve the exception so that asyncio does not log it as never retrieved
+        # when every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "in_flight": len(self._in_flight),
+        }
@@ -0,0 +1,45 @@
+import time
+from contextlib import contextmanager
+from services.logger import Logger
+
+logger = Logger()
+
+
+class Startup:
+    """Tracks the phases of service initialization and whether it has finished.
+
+    Phases are timed with `with startup.phase("name"): ...` and reported in the logs,
+    on /readyz and on /metrics.
+    """
+
+    def __init__(self):
+        self.phases: dict[str, float] = {}
+        self.ready = False
+        self.error: str | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = seconds
+        logger.info(f"Startup phase {name} took {seconds:.3f}s")
+
+    def mark_ready(self):
+        self.ready = True
+        logger.info(f"Startup finished in {sum(self.phases.values()):.3f}s")
+
+    def fail(self, error: Exception):
+        self.error = f"{type(error).__name__}: {error}"
+        logger.error(f"Startup failed: {self.error}")
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+        }
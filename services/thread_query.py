@@ -0,0 +1,208 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import numpy as np
+from services.logger import Logger
+from services.tokens import count_tokens, truncate_to_tokens
+
+logger = Logger()
+
+
+@dataclass
+class ThreadQuery:
+    """A forum thread prepared for retrieval and prompting."""
+
+    # Query text for the prompt, trimmed to the token budget
+    text: str
+    # Text embedded for each searched post (title and content, without the author)
+    post_texts: list[str]
+    # Retrieval weight of each searched post, highest for the latest one
+    weights: list[float]
+    # Identifies the thread across requests, see ThreadQueryBuilder.embed
+    thread_key: str
+    _post_keys: list[str] = field(default_factory=list, repr=False)
+
+    @classmethod
+    def from_text(cls, text: str) -> "ThreadQuery":
+        """Wraps a plain query string as a thread of one post."""
+        key = _hash(text)
+        return cls(text, [text], [1.0], key, [key])
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _format_post(number, post) -> str:
+    return (
+        f"Post number: {number}, Post title: {post.title}, "
+        f"Post content: {post.content}, Post author: {post.author} "
+    )
+
+
+class ThreadQueryBuilder:
+    """Builds retrieval and prompt queries from the posts of a thread.
+
+    Each post is embedded on its own, so that a long thread does not exceed the
+    embedding model's input limit and author names do not dilute the embedding. The
+    per-post search results are then fused, weighting later posts higher. The query
+    text in the prompt keeps the first and latest posts and as many replies in between
+    as fit the token budget.
+
+    Post embeddings are cached per thread (keyed by its first post), so a thread with
+    one new reply only embeds that reply.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        query_token_budget=None,
+        post_token_limit=None,
+        recency_decay=None,
+        max_threads=None,
+        max_posts=None,
+    ):
+        self.embeddings = embeddings
+        self.query_token_budget = query_token_budget or int(
+            os.getenv("THREAD_QUERY_TOKEN_BUDGET", "1500")
+        )
+        self.post_token_limit = post_token_limit or int(
+            os.getenv("THREAD_POST_TOKEN_LIMIT", "1000")
+        )
+        self.recency_decay = (
+            recency_decay
+            if recency_decay is not None
+            else float(os.getenv("THREAD_RECENCY_DECAY", "0.7"))
+        )
+        self.max_threads = max_threads or int(os.getenv("THREAD_CACHE_SIZE", "1024"))
+        # Long threads are searched with their first and latest posts only
+        self.max_posts = max_posts or int(os.getenv("THREAD_MAX_POSTS", "8"))
+
+        self._lock = threading.Lock()
+        # thread key -> {post key: embedding}, in LRU order
+        self._threads: OrderedDict[str, dict[str, list[float]]] = OrderedDict()
+
+        self.posts_embedded = 0
+        self.posts_reused = 0
+
+    def build(self, posts) -> ThreadQuery:
+        """Builds the query of a thread from its posts, oldest first."""
+        searched = range(len(posts))
+        if len(posts) > self.max_posts:
+            searched = [0, *range(len(posts) - self.max_posts + 1, len(posts))]
+        post_texts = [
+            truncate_to_tokens(
+                f"{posts[i].title}\n{posts[i].content}", self.post_token_limit
+            )
+            for i in searched
+        ]
+        weights = [self.recency_decay ** (len(posts) - 1 - i) for i in searched]
+        first = posts[0]
+        return ThreadQuery(
+            text=self._query_text(posts),
+            post_texts=post_texts,
+            weights=weights,
+            thread_key=_hash(f"{first.title}\0{first.content}\0{first.author}"),
+            _post_keys=[_hash(text) for text in post_texts],
+        )
+
+    async def embed(self, threads: list[ThreadQuery]) -> list[list[list[float]]]:
+        """Returns the post embeddings of each thread.
+
+        Posts that were embedded for the same thread before are reused. The others, of
+        all threads together, are embedded in one batch.
+        """
+        cached = []
+        missing: dict[str, str] = {}
+        with self._lock:
+            for thread in threads:
+                vectors = self._threads.get(thread.thread_key, {})
+                if thread.thread_key in self._threads:
+                    self._threads.move_to_end(thread.thread_key)
+                cached.append(vectors)
+                for key, text in zip(thread._post_keys, thread.post_texts):
+                    if key not in vectors:
+                        missing[key] = text
+
+        embedded = {}
+        if missing:
+            vectors = await self.embeddings.aembed_queries(list(missing.values()))
+            embedded = dict(zip(missing, vectors))
+
+        results = []
+        with self._lock:
+            for thread, vectors in zip(threads, cached):
+                post_vectors = [
+                    vectors[key] if key in vectors else embedded[key]
+                    for key in thread._post_keys
+                ]
+                # Merged rather than replaced, as a batch may hold the same thread at
+                # different lengths. Posts that were edited away age out.
+                vectors = self._threads.setdefault(thread.thread_key, {})
+                for key, vector in zip(thread._post_keys, post_vectors):
+                    vectors.pop(key, None)
+                    vectors[key] = vector
+                while len(vectors) > 2 * self.max_posts:
+                    del vectors[next(iter(vectors))]
+                self._threads.move_to_end(thread.thread_key)
+                results.append(post_vectors)
+            while len(self._threads) > self.max_threads:
+                self._threads.popitem(last=False)
+
+        total = sum(len(thread.post_texts) for thread in threads)
+        self.posts_embedded += len(missing)
+        self.posts_reused += total - len(missing)
+        if total > len(missing):
+            logger.debug(f"Reused {total - len(missing)} of {total} post embeddings")
+        return results
+
+    @staticmethod
+    def thread_embedding(post_vectors, weights) -> list[float]:
+        """Weighted mean of the normalized post embeddings, normalized. Used where a
+        single vector per thread is needed, e.g. for the response cache."""
+        vectors = np.asarray(post_vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        mean = np.asarray(weights, dtype=np.float32) @ vectors
+        norm = np.linalg.norm(mean)
+        return (mean / norm if norm else mean).tolist()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "threads": len(self._threads),
+            "posts_embedded": self.posts_embedded,
+            "posts_reused": self.posts_reused,
+        }
+
+    def _query_text(self, posts) -> str:
+        parts = [_format_post(i + 1, post) for i, post in enumerate(posts)]
+        tokens = [count_tokens(part) for part in parts]
+        budget = self.query_token_budget
+        if sum(tokens) <= budget:
+            return "".join(parts)
+
+        # The first post asks the question and the latest one is being answered
+        if len(parts) == 1:
+            return truncate_to_tokens(parts[0], budget)
+        if tokens[0] + tokens[-1] > budget:
+            first = truncate_to_tokens(parts[0], budget // 2)
+            last = truncate_to_tokens(parts[-1], budget - count_tokens(first))
+            omitted = len(parts) - 2
+            note = f"[{omitted} replies omitted] " if omitted else ""
+            return first + note + last
+
+        # Fill the rest of the budget with the most recent replies
+        used = tokens[0] + tokens[-1]
+        kept = []
+        for i in range(len(parts) - 2, 0, -1):
+            if used + tokens[i] > budget:
+                break
+            kept.append(i)
+            used += tokens[i]
+        kept.reverse()
+
+        omitted = len(parts) - 2 - len(kept)
+        middle = [f"[{omitted} earlier replies omitted] "] if omitted else []
+        return "".join([parts[0], *middle, *(parts[i] for i in kept), parts[-1]])
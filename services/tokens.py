@@ -0,0 +1,55 @@
+import os
+import threading
+from services.logger import Logger
+
+logger = Logger()
+
+_lock = threading.Lock()
+_encoding = None
+_encoding_loaded = False
+
+# Rough characters per token of English text, used if tiktoken cannot be loaded
+_CHARS_PER_TOKEN = 4
+
+
+def _get_encoding():
+    """Returns the tiktoken encoding of the chat model, or None if it is unavailable.
+
+    tiktoken downloads encodings on first use, so this can fail without network access.
+    Token counts then fall back to an estimate from the text length.
+    """
+    global _encoding, _encoding_loaded
+    with _lock:
+        if not _encoding_loaded:
+            try:
+                import tiktoken
+
+                model = os.getenv("TOKENIZER_MODEL", "gpt-4o-mini")
+                try:
+                    _encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logger.warning(f"tiktoken unavailable, estimating token counts: {str(e)}")
+            _encoding_loaded = True
+        return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Returns the longest prefix of text that fits in max_tokens tokens."""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[: max_tokens * _CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
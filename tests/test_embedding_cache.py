@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from models.embedding_cache import DiskEmbeddingStore
+
+
+def vector(value):
+    return np.full(4, value, dtype=np.float32)
+
+
+class DiskEmbeddingStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = self._tmp.name
+        self.vectors_path = os.path.join(self.directory, "test.f32")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_reopen(self):
+        DiskEmbeddingStore(self.directory, "test").put_many(
+            [("a", vector(1)), ("b", vector(2))]
+        )
+
+        store = DiskEmbeddingStore(self.directory, "test")
+        self.assertEqual(store.dim, 4)
+        np.testing.assert_array_equal(store.get("a"), vector(1))
+        np.testing.assert_array_equal(store.get("b"), vector(2))
+        self.assertIsNone(store.get("c"))
+
+    def test_torn_append(self):
+        DiskEmbeddingStore(self.directory, "test").put_many([("a", vector(1))])
+        # A crash after writing the vectors of an append but before its keys
+        with open(self.vectors_path, "ab") as f:
+            f.write(vector(9).tobytes())
+
+        store = DiskEmbeddingStore(self.directory, "test")
+        self.assertEqual(store.dim, 4)
+        store.put_many([("b", vector(2))])
+        np.testing.assert_array_equal(store.get("b"), vector(2))
+
+        store = DiskEmbeddingStore(self.directory, "test")
+        self.assertEqual(store.dim, 4)
+        np.testing.assert_array_equal(store.get("a"), vector(1))
+        np.testing.assert_array_equal(store.get("b"), vector(2))
+
+    def test_torn_append_of_partial_row(self):
+        DiskEmbeddingStore(self.directory, "test").put_many([("a", vector(1))])
+        with open(self.vectors_path, "ab") as f:
+            f.write(vector(9).tobytes()[:6])
+
+        store = DiskEmbeddingStore(self.directory, "test")
+        store.put_many([("b", vector(2))])
+
+        store = DiskEmbeddingStore(self.directory, "test")
+        self.assertEqual(store.dim, 4)
+        np.testing.assert_array_equal(store.get("b"), vector(2))
+
+    def test_appends_of_another_process(self):
+        first = DiskEmbeddingStore(self.directory, "test")
+        second = DiskEmbeddingStore(self.directory, "test")
+        first.put_many([("a", vector(1))])
+        second.put_many([("a", vector(1)), ("b", vector(2))])
+        first.put_many([("c", vector(3))])
+
+        store = DiskEmbeddingStore(self.directory, "test")
+        for key, value in (("a", 1), ("b", 2), ("c", 3)):
+            np.testing.assert_array_equal(store.get(key), vector(value))
+        self.assertEqual(os.path.getsize(self.vectors_path), 3 * 4 * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()